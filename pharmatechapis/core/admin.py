@@ -1,9 +1,12 @@
 from django.contrib import admin
 from django.urls import path
 from django.template.response import TemplateResponse
+from django.db import transaction
 from django.db.models import Count, Sum, Avg
 from oauth2_provider.models import Application
-from .models import User, Product, Cart, CartItem, Order, OrderItem, Payment, DeviceToken, Category, Inventory, Discount, Notification, Review, ReviewReply
+from .models import User, Product, Cart, CartItem, Order, OrderItem, Payment, DeviceToken, Category, Inventory, Discount, Notification, Review, ReviewReply, StripeEvent, RefundRequest, PromotionCampaign, EmailOutbox
+from .tasks import dispatch_order_transition
+from .notifications import unread_counter
 from firebase_admin import db
 from django.conf import settings
 import pyrebase
@@ -42,7 +45,7 @@ class PharmaTechAdminSite(admin.AdminSite):
         valid_discount_count = Discount.objects.filter(is_active=True).count()
         review_count = Review.objects.count()
         avg_rating = Review.objects.aggregate(avg_rating=Avg('rating'))['avg_rating'] or 0
-        unread_notification_count = Notification.objects.filter(is_read=False).count()
+        unread_notification_count = unread_counter.get_total()
 
         return TemplateResponse(request, 'admin/system_stats.html', {
             'product_stats': product_stats,
@@ -99,10 +102,29 @@ class CartItemAdmin(admin.ModelAdmin):
 
 # Tùy chỉnh giao diện quản trị cho Order
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('order_code', 'user', 'total_amount', 'discount_amount', 'status', 'created_at')
+    list_display = ('order_code', 'user', 'grand_total', 'discount_amount', 'status', 'created_at')
     list_filter = ('status', 'user')
     search_fields = ('order_code', 'user__username')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('items_subtotal', 'grand_total', 'created_at', 'updated_at')
+    actions = ('mark_processing', 'mark_completed', 'mark_cancelled')
+
+    def _transition(self, request, queryset, target_status):
+        updated_ids = Order.bulk_transition(queryset, target_status)
+        if updated_ids:
+            transaction.on_commit(lambda: dispatch_order_transition(updated_ids, target_status))
+        self.message_user(request, f"Đã chuyển {len(updated_ids)} đơn hàng sang '{target_status}'. Bỏ qua {queryset.count() - len(updated_ids)} đơn không hợp lệ.")
+
+    @admin.action(description="Chuyển sang Processing")
+    def mark_processing(self, request, queryset):
+        self._transition(request, queryset, 'processing')
+
+    @admin.action(description="Chuyển sang Completed")
+    def mark_completed(self, request, queryset):
+        self._transition(request, queryset, 'completed')
+
+    @admin.action(description="Hủy đơn hàng")
+    def mark_cancelled(self, request, queryset):
+        self._transition(request, queryset, 'cancelled')
 
 # Tùy chỉnh giao diện quản trị cho OrderItem
 class OrderItemAdmin(admin.ModelAdmin):
@@ -110,6 +132,24 @@ class OrderItemAdmin(admin.ModelAdmin):
     list_filter = ('order__user',)
     search_fields = ('product__name', 'order__order_code')
 
+    # Tổng tiền của đơn hàng được lưu sẵn nên phải tính lại mỗi khi sửa/xóa dòng sản phẩm
+    def save_model(self, request, obj, form, change):
+        previous_order_id = form.initial.get('order') if change else None
+        super().save_model(request, obj, form, change)
+        for order in Order.objects.filter(id__in={obj.order_id, previous_order_id} - {None}):
+            order.recalculate_totals()
+
+    def delete_model(self, request, obj):
+        order = obj.order
+        super().delete_model(request, obj)
+        order.recalculate_totals()
+
+    def delete_queryset(self, request, queryset):
+        order_ids = set(queryset.values_list('order_id', flat=True))
+        super().delete_queryset(request, queryset)
+        for order in Order.objects.filter(id__in=order_ids):
+            order.recalculate_totals()
+
 # Tùy chỉnh giao diện quản trị cho Payment
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('order', 'user', 'amount', 'payment_method', 'status', 'paid_at')
@@ -117,6 +157,20 @@ class PaymentAdmin(admin.ModelAdmin):
     search_fields = ('order__order_code', 'user__username')
     readonly_fields = ('created_at', 'paid_at', 'refunded_at')
 
+# Tùy chỉnh giao diện quản trị cho StripeEvent
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'event_type')
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'event_type', 'payload', 'received_at', 'processed_at')
+
+# Tùy chỉnh giao diện quản trị cho RefundRequest
+class RefundRequestAdmin(admin.ModelAdmin):
+    list_display = ('order', 'payment', 'amount', 'status', 'attempts', 'stripe_refund_id', 'created_at', 'processed_at')
+    list_filter = ('status',)
+    search_fields = ('order__order_code', 'stripe_refund_id')
+    readonly_fields = ('created_at', 'updated_at', 'processed_at', 'stripe_refund_id')
+
 # Tùy chỉnh giao diện quản trị cho DeviceToken
 class DeviceTokenAdmin(admin.ModelAdmin):
     list_display = ('user', 'token', 'device_type', 'created_at')
@@ -143,6 +197,20 @@ class NotificationAdmin(admin.ModelAdmin):
     search_fields = ('title', 'message', 'user__username')
     readonly_fields = ('created_at', 'updated_at')
 
+# Tùy chỉnh giao diện quản trị cho PromotionCampaign
+class PromotionCampaignAdmin(admin.ModelAdmin):
+    list_display = ('title', 'status', 'notified_count', 'pushed_count', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    search_fields = ('title', 'message')
+    readonly_fields = ('status', 'last_user_id', 'notified_count', 'pushed_count', 'error', 'created_at', 'heartbeat_at', 'finished_at')
+
+# Tùy chỉnh giao diện quản trị cho EmailOutbox
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('to_email', 'subject')
+    readonly_fields = ('attempts', 'last_error', 'created_at', 'updated_at', 'sent_at')
+
 # Tùy chỉnh giao diện quản trị cho Review
 class ReviewAdmin(admin.ModelAdmin):
     list_display = ('user', 'product', 'rating', 'comment', 'created_at')
@@ -169,10 +237,14 @@ admin_site.register(CartItem, CartItemAdmin)
 admin_site.register(Order, OrderAdmin)
 admin_site.register(OrderItem, OrderItemAdmin)
 admin_site.register(Payment, PaymentAdmin)
+admin_site.register(StripeEvent, StripeEventAdmin)
+admin_site.register(RefundRequest, RefundRequestAdmin)
 admin_site.register(DeviceToken, DeviceTokenAdmin)
 admin_site.register(Category, CategoryAdmin)
 admin_site.register(Discount, DiscountAdmin)
 admin_site.register(Notification, NotificationAdmin)
+admin_site.register(PromotionCampaign, PromotionCampaignAdmin)
+admin_site.register(EmailOutbox, EmailOutboxAdmin)
 admin_site.register(Review, ReviewAdmin)
 admin_site.register(ReviewReply, ReviewReplyAdmin)
 admin_site.register(Application, ApplicationAdmin)
\ No newline at end of file
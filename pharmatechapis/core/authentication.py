@@ -1,7 +1,9 @@
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
 from oauth2_provider.contrib.rest_framework import OAuth2Authentication
+from oauth2_provider.models import AccessToken
 from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.request import Request
 
 User = get_user_model()
 
@@ -44,4 +46,31 @@ class CustomOAuth2Authentication(OAuth2Authentication):
             raise AuthenticationFailed('Invalid user role.')
         if not user.is_active:
             raise AuthenticationFailed('User account is deactivated.')
-        return user_auth_tuple
\ No newline at end of file
+        return user_auth_tuple
+
+def authenticate_http_request(request):
+    """
+    Xác thực một HttpRequest thuần (view async không đi qua DRF) bằng đúng CustomOAuth2Authentication
+    mà các ViewSet dùng; trả về user hoặc None nếu thiếu/sai token.
+    """
+    try:
+        user_auth_tuple = CustomOAuth2Authentication().authenticate(Request(request))
+    except AuthenticationFailed:
+        return None
+    return user_auth_tuple[0] if user_auth_tuple else None
+
+def get_user_from_access_token(token):
+    """
+    Lấy user từ access token OAuth2 cho các kênh không đi qua DRF (WebSocket, view async).
+    Áp dụng cùng điều kiện với CustomOAuth2Authentication; trả về None nếu không hợp lệ.
+    """
+    try:
+        access_token = AccessToken.objects.select_related('user').get(token=token)
+    except AccessToken.DoesNotExist:
+        return None
+    if not access_token.is_valid():
+        return None
+    user = access_token.user
+    if user.role not in ['customer', 'distributor', 'admin'] or not user.is_active:
+        return None
+    return user
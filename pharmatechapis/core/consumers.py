@@ -1,7 +1,11 @@
 import json
 import uuid
+import asyncio
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .utils import call_gemini_api, save_message_to_firebase, get_messages_from_firebase, extract_main_guidance
+from .utils import call_gemini_api, save_message_to_firebase, get_messages_from_firebase, extract_main_guidance, order_status_group, payment_status_group
+from .authentication import get_user_from_access_token
+from .notifications import notification_group, mark_user_online, mark_user_offline, refresh_user_online
 from oauth2_provider.models import AccessToken
 from asgiref.sync import sync_to_async
 from firebase_admin import exceptions as firebase_exceptions
@@ -10,6 +14,21 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+async def get_websocket_user(scope):
+    """Lấy user từ session hoặc từ access token OAuth2 trong query string (?token=...)."""
+    user = scope['user']
+    if user.is_authenticated:
+        return user
+    query_string = scope.get('query_string', b'').decode()
+    token = None
+    for param in query_string.split('&'):
+        if param.startswith('token='):
+            token = param.split('=')[1]
+            break
+    if not token:
+        return None
+    return await sync_to_async(get_user_from_access_token)(token)
+
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Lấy conversation_id từ URL hoặc tạo mới nếu không có
@@ -132,7 +151,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'response': main_guidance
             }))
             # FCM đã bị vô hiệu hóa cho tính năng chat để tránh lỗi token thiết bị
-            # fcm_result = await send_fcm_v1(self.user, "Phản hồi chatbot", main_guidance)
+            # fcm_result = await asend_fcm_v1(self.user, "Phản hồi chatbot", main_guidance)
             # if not fcm_result['success']:
             #     logger.error(f"Lỗi gửi FCM: {fcm_result['message']}")
         except AiohttpClientError as e:
@@ -143,4 +162,72 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send(text_data=json.dumps({'error': f"Lỗi Firebase: {str(e)}"}))
         except Exception as e:
             logger.error(f"Lỗi không xác định: {str(e)}")
-            await self.send(text_data=json.dumps({'error': f"Lỗi không xác định: {str(e)}"}))
\ No newline at end of file
+            await self.send(text_data=json.dumps({'error': f"Lỗi không xác định: {str(e)}"}))
+
+class OrderStatusConsumer(AsyncWebsocketConsumer):
+    """Đẩy kết quả đặt hàng bất đồng bộ (order.status) tới khách hàng."""
+    async def connect(self):
+        self.user = await get_websocket_user(self.scope)
+        if not self.user:
+            await self.close(code=4001)
+            return
+        self.group_name = order_status_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'group_name', None):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def order_status(self, event):
+        await self.send(text_data=json.dumps(event['payload']))
+
+class PaymentStatusConsumer(AsyncWebsocketConsumer):
+    """Đẩy thay đổi trạng thái thanh toán (webhook, đối soát, hoàn tiền) tới khách hàng."""
+    async def connect(self):
+        self.user = await get_websocket_user(self.scope)
+        if not self.user:
+            await self.close(code=4001)
+            return
+        self.group_name = payment_status_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'group_name', None):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def payment_status(self, event):
+        await self.send(text_data=json.dumps(event['payload']))
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """Đẩy thông báo mới (notification.created) tới user ngay sau khi được tạo."""
+    async def connect(self):
+        self.user = await get_websocket_user(self.scope)
+        if not self.user:
+            await self.close(code=4001)
+            return
+        self.group_name = notification_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await sync_to_async(mark_user_online)(self.user.id)
+        self.presence_task = asyncio.create_task(self.refresh_presence())
+        await self.accept()
+
+    async def refresh_presence(self):
+        # Gia hạn key online trong lúc socket còn mở
+        while True:
+            await asyncio.sleep(settings.NOTIFICATION_ONLINE_TTL / 3)
+            try:
+                await sync_to_async(refresh_user_online)(self.user.id)
+            except Exception as e:
+                logger.warning(f"Không gia hạn được trạng thái online của user {self.user.id}: {str(e)}")
+
+    async def disconnect(self, close_code):
+        if getattr(self, 'presence_task', None):
+            self.presence_task.cancel()
+        if getattr(self, 'group_name', None):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await sync_to_async(mark_user_offline)(self.user.id)
+
+    async def notification_created(self, event):
+        await self.send(text_data=json.dumps(event['payload']))
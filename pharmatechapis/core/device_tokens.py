@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import DeviceToken
+
+DEVICE_TOKENS_PREFIX = 'device_tokens:'
+
+
+class DeviceTokenRegistry:
+    """
+    Danh sách token FCM của mỗi user được cache trên Redis (kể cả danh sách rỗng) để việc gửi push
+    không phải truy vấn DeviceToken mỗi lần. Mọi thay đổi DeviceToken đều xóa cache của user
+    liên quan sau khi commit (xem DeviceTokenQuerySet.delete, DeviceToken.save/delete).
+    """
+
+    def _key(self, user_id):
+        return f"{DEVICE_TOKENS_PREFIX}{user_id}"
+
+    def tokens_for(self, user_id):
+        tokens = cache.get(self._key(user_id))
+        if tokens is None:
+            tokens = list(DeviceToken.objects.filter(user_id=user_id).values_list('token', flat=True))
+            cache.set(self._key(user_id), tokens, timeout=settings.DEVICE_TOKEN_CACHE_TTL)
+        return tokens
+
+    def tokens_for_users(self, user_ids):
+        """{user_id: [token]} cho nhiều user: một MGET, các user chưa có trong cache nạp bằng một truy vấn."""
+        user_ids = list(set(user_ids))
+        cached = cache.get_many([self._key(user_id) for user_id in user_ids])
+        result = {user_id: cached[self._key(user_id)] for user_id in user_ids if self._key(user_id) in cached}
+        missing = [user_id for user_id in user_ids if user_id not in result]
+        if missing:
+            loaded = {user_id: [] for user_id in missing}
+            for user_id, token in DeviceToken.objects.filter(user_id__in=missing).values_list('user_id', 'token'):
+                loaded[user_id].append(token)
+            cache.set_many({self._key(user_id): tokens for user_id, tokens in loaded.items()}, timeout=settings.DEVICE_TOKEN_CACHE_TTL)
+            result.update(loaded)
+        return result
+
+    def invalidate(self, user_ids):
+        if user_ids:
+            cache.delete_many([self._key(user_id) for user_id in set(user_ids)])
+
+    def register(self, user, token, device_type='android'):
+        """
+        Lưu token cho user: một token chỉ thuộc về một user (thiết bị đổi tài khoản thì token cũ
+        bị gỡ khỏi user trước), và mỗi user giữ tối đa MAX_DEVICE_TOKENS_PER_USER token mới nhất.
+        """
+        with transaction.atomic():
+            DeviceToken.objects.filter(token=token).exclude(user=user).delete()
+            device_token, created = DeviceToken.objects.update_or_create(
+                user=user, token=token, defaults={'device_type': device_type}
+            )
+            stale_ids = list(
+                DeviceToken.objects.filter(user=user).order_by('-updated_at', '-id')
+                .values_list('id', flat=True)[settings.MAX_DEVICE_TOKENS_PER_USER:]
+            )
+            if stale_ids:
+                DeviceToken.objects.filter(id__in=stale_ids).delete()
+        return device_token, created
+
+
+device_token_registry = DeviceTokenRegistry()
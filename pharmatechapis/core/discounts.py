@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Discount
+
+DISCOUNT_CACHE_PREFIX = 'discount:code:'
+DISCOUNT_MISSING = '__missing__'
+ACTIVE_DISCOUNT_TABLE_KEY = 'discount:active_table'
+ACTIVE_DISCOUNT_FIELDS = (
+    'id', 'code', 'description', 'discount_type', 'discount_value', 'max_discount_amount',
+    'min_order_value', 'start_date', 'end_date', 'max_uses', 'uses_count',
+)
+
+
+class DiscountRegistry:
+    """
+    Tra cứu Discount theo code qua hai tầng cache: LRU trong process và Redis.
+    TTL trên Redis không vượt quá end_date của mã; Discount.save()/delete() xóa bản ghi cache.
+    Bản sao cục bộ chỉ sống DISCOUNT_LOCAL_CACHE_TTL giây vì không thể xóa chéo giữa các process.
+    uses_count trong cache chỉ để tham khảo; giá trị chuẩn luôn nằm trong DB.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._active_table = None
+        self._active_table_expires_at = 0
+
+    def _cache_key(self, code):
+        return f"{DISCOUNT_CACHE_PREFIX}{code}"
+
+    def _get_local(self, code):
+        with self._lock:
+            entry = self._local.get(code)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._local[code]
+                return None
+            self._local.move_to_end(code)
+            return entry
+
+    def _set_local(self, code, value):
+        with self._lock:
+            self._local[code] = (time.monotonic() + settings.DISCOUNT_LOCAL_CACHE_TTL, value)
+            self._local.move_to_end(code)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _redis_timeout(self, discount):
+        if discount is None:
+            return settings.DISCOUNT_MISSING_CACHE_TTL
+        remaining = int((discount.end_date - timezone.now()).total_seconds())
+        if remaining <= 0:
+            # Mã đã hết hạn không thể hợp lệ trở lại nếu không được sửa (sửa sẽ xóa cache)
+            return settings.DISCOUNT_CACHE_TTL
+        return max(1, min(settings.DISCOUNT_CACHE_TTL, remaining))
+
+    def _to_cache(self, discount):
+        return {field.attname: getattr(discount, field.attname) for field in Discount._meta.concrete_fields}
+
+    def _from_cache(self, data):
+        field_names = [field.attname for field in Discount._meta.concrete_fields]
+        return Discount.from_db('default', field_names, [data[name] for name in field_names])
+
+    def get(self, code):
+        """Trả về Discount (bản sao chỉ đọc) hoặc None nếu mã không tồn tại."""
+        if not code:
+            return None
+        entry = self._get_local(code)
+        if entry is not None:
+            data = entry[1]
+            return None if data == DISCOUNT_MISSING else self._from_cache(data)
+
+        data = cache.get(self._cache_key(code))
+        if data is None:
+            discount = Discount.objects.filter(code=code).first()
+            data = self._to_cache(discount) if discount else DISCOUNT_MISSING
+            cache.set(self._cache_key(code), data, timeout=self._redis_timeout(discount))
+        self._set_local(code, data)
+        return None if data == DISCOUNT_MISSING else self._from_cache(data)
+
+    def active_table(self):
+        """
+        Bảng (list các dict) các mã đang bật và chưa hết hạn, dựng sẵn một lần rồi lưu ở
+        Redis và trong process; dùng để đánh giá hàng loạt mã mà không truy vấn từng mã.
+        """
+        with self._lock:
+            if self._active_table is not None and self._active_table_expires_at >= time.monotonic():
+                return self._active_table
+
+        table = cache.get(ACTIVE_DISCOUNT_TABLE_KEY)
+        if table is None:
+            table = list(
+                Discount.objects.filter(is_active=True, end_date__gte=timezone.now())
+                .order_by('id').values(*ACTIVE_DISCOUNT_FIELDS)
+            )
+            cache.set(ACTIVE_DISCOUNT_TABLE_KEY, table, timeout=settings.DISCOUNT_ACTIVE_TABLE_TTL)
+
+        with self._lock:
+            self._active_table = table
+            self._active_table_expires_at = time.monotonic() + settings.DISCOUNT_LOCAL_CACHE_TTL
+        return table
+
+    def invalidate(self, code):
+        cache.delete_many([self._cache_key(code), ACTIVE_DISCOUNT_TABLE_KEY])
+        with self._lock:
+            self._local.pop(code, None)
+            self._active_table = None
+
+
+discount_registry = DiscountRegistry()
+
+
+def get_discount_by_code(code):
+    """Tra cứu Discount theo code qua registry; raise Discount.DoesNotExist nếu không có."""
+    discount = discount_registry.get(code)
+    if discount is None:
+        raise Discount.DoesNotExist(f"Discount with code {code!r} does not exist.")
+    return discount
+
+
+def rank_discounts(order_amount, codes=None):
+    """
+    Đánh giá mọi mã đang hiệu lực (hoặc chỉ các mã trong codes) với order_amount trong một lượt
+    trên bảng active_table(). Trả về (applicable, rejected): applicable xếp theo số tiền giảm
+    giảm dần; rejected chỉ gồm các mã được yêu cầu nhưng không áp dụng được, kèm lý do.
+    """
+    now = timezone.now()
+    table = discount_registry.active_table()
+    requested = None
+    if codes is not None:
+        requested = set(codes)
+        table = [row for row in table if row['code'] in requested]
+
+    applicable = []
+    rejected = []
+    for row in table:
+        if now < row['start_date'] or now > row['end_date']:
+            reason = "Discount is expired or not yet active."
+        elif row['max_uses'] and row['uses_count'] >= row['max_uses']:
+            reason = "Discount has reached maximum uses."
+        elif row['min_order_value'] and order_amount < row['min_order_value']:
+            reason = f"Order amount must be at least {row['min_order_value']}."
+        else:
+            discount_amount = min(order_amount, Discount.compute_amount(
+                row['discount_type'], row['discount_value'], row['max_discount_amount'], order_amount
+            ))
+            applicable.append({
+                'code': row['code'],
+                'description': row['description'],
+                'discount_type': row['discount_type'],
+                'discount_amount': discount_amount,
+                'total_after_discount': max(Decimal('0.00'), order_amount - discount_amount),
+            })
+            continue
+        if requested is not None:
+            rejected.append({'code': row['code'], 'reason': reason})
+
+    if requested is not None:
+        found = {row['code'] for row in table}
+        rejected.extend({'code': code, 'reason': "Mã giảm giá không tồn tại hoặc không còn hoạt động."} for code in requested - found)
+
+    applicable.sort(key=lambda item: item['discount_amount'], reverse=True)
+    return applicable, rejected
@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, Sum
+
+BATCH_SIZE = 1000
+
+
+def backfill_order_totals(apps, schema_editor):
+    """Tính items_subtotal/grand_total cho các đơn hàng cũ theo từng lô theo id."""
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+
+    last_id = 0
+    while True:
+        orders = list(
+            Order.objects.filter(id__gt=last_id).order_by('id').only('id', 'discount_amount')[:BATCH_SIZE]
+        )
+        if not orders:
+            break
+        subtotals = dict(
+            OrderItem.objects.filter(order_id__in=[order.id for order in orders])
+            .values('order_id')
+            .annotate(total=Sum(F('quantity') * F('price'), output_field=models.DecimalField(max_digits=12, decimal_places=2)))
+            .values_list('order_id', 'total')
+        )
+        for order in orders:
+            order.items_subtotal = subtotals.get(order.id) or Decimal('0.00')
+            order.grand_total = max(Decimal('0.00'), order.items_subtotal - order.discount_amount)
+        Order.objects.bulk_update(orders, ['items_subtotal', 'grand_total'])
+        last_id = orders[-1].id
+
+
+class Migration(migrations.Migration):
+    # Mỗi lô được commit riêng để không giữ khóa trên toàn bảng Order.
+    atomic = False
+
+    dependencies = [
+        ('core', '0002_order_items_subtotal_order_grand_total'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-19 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_order_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='discount',
+            index=models.Index(fields=['is_active', 'start_date', 'end_date'], name='core_discou_is_acti_2a47e2_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.6 on 2026-10-19 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicetoken',
+            index=models.Index(fields=['token'], name='core_device_token_3d6659_idx'),
+        ),
+    ]
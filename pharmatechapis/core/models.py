@@ -5,7 +5,47 @@ from cloudinary.models import CloudinaryField
 from decimal import Decimal
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from django.db import transaction
-from django.db.models import F
+from django.db.models import F, Q, Count, Exists, OuterRef, Subquery
+
+class FieldTrackerMixin:
+    """
+    Ghi nhớ giá trị của các field trong tracked_fields tại thời điểm load từ DB (from_db)
+    và sau mỗi lần save(), để signal so sánh giá trị cũ/mới mà không cần SELECT lại.
+    """
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._tracked_values = {
+            field: getattr(instance, field) for field in cls.tracked_fields if field in field_names
+        }
+        return instance
+
+    def previous_value(self, field):
+        """Giá trị của field lúc load từ DB; None nếu instance chưa được lưu."""
+        if self._state.adding or self.pk is None:
+            return None
+        tracked_values = getattr(self, '_tracked_values', {})
+        if field not in tracked_values:
+            # Field bị defer khi load (hoặc instance tự tạo với pk): đọc một lần từ DB
+            tracked_values[field] = type(self)._default_manager.filter(pk=self.pk).values_list(field, flat=True).first()
+            self._tracked_values = tracked_values
+        return tracked_values[field]
+
+    def has_field_changed(self, field):
+        if self._state.adding or self.pk is None:
+            return False
+        return self.previous_value(field) != getattr(self, field)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        tracked_values = getattr(self, '_tracked_values', {})
+        for field in self.tracked_fields:
+            if update_fields is None or field in update_fields:
+                tracked_values[field] = getattr(self, field)
+        self._tracked_values = tracked_values
 
 # Custom User Manager
 class CustomUserManager(BaseUserManager):
@@ -66,7 +106,7 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-class Product(models.Model):
+class Product(FieldTrackerMixin, models.Model):
     distributor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='products', limit_choices_to={'role': 'distributor'})
     name = models.CharField(max_length=100)
     description = models.TextField()
@@ -77,6 +117,8 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    tracked_fields = ('is_approved',)
+
     class Meta:
         indexes = [models.Index(fields=['distributor']), models.Index(fields=['created_at'])]
 
@@ -123,7 +165,37 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
-class Discount(models.Model):
+class DiscountQuerySet(models.QuerySet):
+    def currently_active(self):
+        now = timezone.now()
+        return self.filter(is_active=True, start_date__lte=now, end_date__gte=now)
+
+    def with_validity(self):
+        """Annotate is_currently_valid và validity_message (cùng thứ tự kiểm tra với is_valid) bằng SQL."""
+        now = timezone.now()
+        max_uses_reached = Q(max_uses__gt=0, uses_count__gte=F('max_uses'))
+        return self.annotate(
+            validity_message=models.Case(
+                models.When(is_active=False, then=models.Value("Discount is not active.")),
+                models.When(Q(start_date__gt=now) | Q(end_date__lt=now), then=models.Value("Discount is expired or not yet active.")),
+                models.When(max_uses_reached, then=models.Value("Discount has reached maximum uses.")),
+                default=models.Value("Discount is valid."),
+                output_field=models.CharField(),
+            ),
+            is_currently_valid=models.Case(
+                models.When(
+                    Q(is_active=True, start_date__lte=now, end_date__gte=now) & ~max_uses_reached,
+                    then=models.Value(True)
+                ),
+                default=models.Value(False),
+                output_field=models.BooleanField(),
+            ),
+        )
+
+    def expired_or_used_up(self):
+        return self.filter(Q(end_date__lt=timezone.now()) | Q(max_uses__gt=0, uses_count__gte=F('max_uses')))
+
+class Discount(FieldTrackerMixin, models.Model):
     code = models.CharField(max_length=50, unique=True)
     description = models.TextField(blank=True, null=True)
     discount_type = models.CharField(
@@ -164,14 +236,60 @@ class Discount(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = DiscountQuerySet.as_manager()
+
+    tracked_fields = ('code',)
+
     class Meta:
-        indexes = [models.Index(fields=['code', 'is_active'])]
+        indexes = [models.Index(fields=['code', 'is_active']), models.Index(fields=['is_active', 'start_date', 'end_date'])]
         verbose_name = "Discount"
         verbose_name_plural = "Discounts"
 
     def __str__(self):
         return self.code
 
+    def save(self, *args, **kwargs):
+        from .discounts import discount_registry
+        old_code = self.previous_value('code')
+        super().save(*args, **kwargs)
+        # Xóa cache sau khi ghi, kể cả mã cũ nếu code bị đổi
+        transaction.on_commit(lambda: [discount_registry.invalidate(code) for code in {old_code, self.code} if code])
+
+    def delete(self, *args, **kwargs):
+        from .discounts import discount_registry
+        code = self.code
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: discount_registry.invalidate(code))
+        return result
+
+    @staticmethod
+    def compute_amount(discount_type, discount_value, max_discount_amount, order_amount):
+        """Số tiền giảm cho order_amount theo loại giảm giá (percentage/fixed)."""
+        if discount_type == 'percentage':
+            discount_amount = order_amount * (discount_value / 100)
+            if max_discount_amount:
+                discount_amount = min(discount_amount, max_discount_amount)
+            return discount_amount
+        return discount_value
+
+    @classmethod
+    def reserve_use(cls, discount_id, code):
+        """
+        Giữ một lượt dùng bằng một câu UPDATE có điều kiện:
+        UPDATE ... SET uses_count = uses_count + 1 WHERE id = ? AND is_active AND trong thời hạn
+        AND (max_uses IS NULL OR uses_count < max_uses). Trả về False nếu mã đã hết lượt/hết hạn.
+        UPDATE không qua save() nên cache của mã được xóa sau commit tại đây.
+        """
+        from .discounts import discount_registry
+        now = timezone.now()
+        reserved = cls.objects.filter(
+            Q(max_uses__isnull=True) | Q(max_uses=0) | Q(uses_count__lt=F('max_uses')),
+            pk=discount_id, is_active=True, start_date__lte=now, end_date__gte=now
+        ).update(uses_count=F('uses_count') + 1) == 1
+        if reserved:
+            transaction.on_commit(lambda: discount_registry.invalidate(code))
+        return reserved
+
     def is_valid(self, order_amount):
         """Kiểm tra xem mã giảm giá có hợp lệ không."""
         now = timezone.now()
@@ -185,48 +303,118 @@ class Discount(models.Model):
             return False, f"Order amount must be at least {self.min_order_value}."
         return True, "Discount is valid."
 
-class Order(models.Model):
+class Order(FieldTrackerMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='orders', limit_choices_to={'role': 'customer'})
     order_code = models.CharField(max_length=20, unique=True)
     discount = models.ForeignKey(Discount, on_delete=models.SET_NULL, null=True, blank=True, related_name='orders')
     discount_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, validators=[MinValueValidator(0)])
-    status = models.CharField(max_length=20, choices=[('pending', 'Pending'), ('processing', 'Processing'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='pending')
+    items_subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0, validators=[MinValueValidator(0)])
+    grand_total = models.DecimalField(max_digits=12, decimal_places=2, default=0, validators=[MinValueValidator(0)])
+    status = models.CharField(max_length=20, choices=[('placing', 'Placing'), ('pending', 'Pending'), ('processing', 'Processing'), ('completed', 'Completed'), ('cancelled', 'Cancelled'), ('failed', 'Failed')], default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    tracked_fields = ('status',)
+
     class Meta:
-        indexes = [models.Index(fields=['user', 'status']), models.Index(fields=['created_at'])]
+        indexes = [
+            models.Index(fields=['user', 'status']), models.Index(fields=['created_at']),
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    # Các chuyển trạng thái hợp lệ (hủy đơn lẻ và chuyển hàng loạt dùng chung):
+    # trạng thái hiện tại -> các trạng thái đích; đơn đang xử lý không hủy được
+    STATUS_TRANSITIONS = {
+        'pending': ['processing', 'cancelled'],
+        'processing': ['completed'],
+    }
 
     def __str__(self):
         return f"Order {self.order_code}"
 
+    @classmethod
+    def allowed_source_statuses(cls, target_status):
+        return [source for source, targets in cls.STATUS_TRANSITIONS.items() if target_status in targets]
+
+    def can_transition_to(self, target_status):
+        return target_status in self.STATUS_TRANSITIONS.get(self.status, [])
+
+    @classmethod
+    @transaction.atomic
+    def bulk_transition(cls, queryset, target_status):
+        """
+        Chuyển trạng thái hàng loạt bằng một câu UPDATE ... WHERE status IN (...).
+        Không gọi save() nên không kích hoạt signal pre_save; trả về danh sách id đã chuyển.
+        """
+        sources = cls.allowed_source_statuses(target_status)
+        if not sources:
+            return []
+        order_ids = list(
+            queryset.filter(status__in=sources).select_for_update().values_list('id', flat=True)
+        )
+        if order_ids:
+            cls.objects.filter(id__in=order_ids).update(status=target_status, updated_at=timezone.now())
+        return order_ids
+
     @property
     def total_amount(self):
-        """Tính tổng số tiền từ các OrderItem, trừ đi discount_amount."""
-        items_total = sum(item.quantity * item.price for item in self.items.all())
-        return max(Decimal('0.00'), items_total - self.discount_amount)
+        """Tổng số tiền đã lưu của đơn hàng (giữ tên cũ cho client)."""
+        return self.grand_total
+
+    def set_totals(self, items_subtotal):
+        """Gán items_subtotal và tính lại grand_total từ discount_amount hiện tại."""
+        self.items_subtotal = items_subtotal
+        self.grand_total = max(Decimal('0.00'), items_subtotal - self.discount_amount)
+
+    def recalculate_totals(self):
+        """Tính lại tổng tiền từ OrderItem bằng một câu SUM() và lưu vào đơn hàng."""
+        items_subtotal = self.items.aggregate(
+            total=models.Sum(F('quantity') * F('price'), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+        )['total'] or Decimal('0.00')
+        self.set_totals(items_subtotal)
+        self.save(update_fields=['items_subtotal', 'grand_total', 'updated_at'])
+
+    @transaction.atomic
+    def place_from_cart(self, cart, discount=None):
+        """Tạo OrderItem từ giỏ hàng, lưu tổng tiền, áp dụng giảm giá và làm trống giỏ trong một transaction."""
+        items_subtotal = Decimal('0.00')
+        for cart_item in cart.items.select_related('product'):
+            OrderItem.objects.create(
+                order=self,
+                product=cart_item.product,
+                quantity=cart_item.quantity,
+                price=cart_item.product.price
+            )
+            items_subtotal += cart_item.quantity * cart_item.product.price
+        self.set_totals(items_subtotal)
+
+        if discount:
+            self.discount = discount
+            self.apply_discount()
+        else:
+            self.save(update_fields=['items_subtotal', 'grand_total', 'updated_at'])
+
+        cart.items.all().delete()
 
     @transaction.atomic
     def apply_discount(self):
         """Áp dụng mã giảm giá cho đơn hàng trong transaction."""
         if not self.discount:
             self.discount_amount = Decimal('0.00')
+            self.set_totals(self.items_subtotal)
             self.save()
             return
 
-        items_total = sum(item.quantity * item.price for item in self.items.all())
+        items_total = self.items_subtotal
         is_valid, message = self.discount.is_valid(items_total)
         if is_valid:
-            if self.discount.discount_type == 'percentage':
-                discount_amount = items_total * (self.discount.discount_value / 100)
-                if self.discount.max_discount_amount:
-                    discount_amount = min(discount_amount, self.discount.max_discount_amount)
-            else:  # fixed
-                discount_amount = self.discount.discount_value
-            self.discount_amount = discount_amount
-            self.discount.uses_count = F('uses_count') + 1
-            self.discount.save()
-            self.discount.refresh_from_db()
+            self.discount_amount = Discount.compute_amount(
+                self.discount.discount_type, self.discount.discount_value, self.discount.max_discount_amount, items_total
+            )
+            self.set_totals(items_total)
+            # Kiểm tra max_uses ở trên dựa trên uses_count có thể đã cũ; lượt dùng được giữ nguyên tử trong DB
+            if not Discount.reserve_use(self.discount.pk, self.discount.code):
+                raise ValueError("Discount has reached maximum uses.")
             self.save()
         else:
             raise ValueError(message)
@@ -255,7 +443,7 @@ class OrderItem(models.Model):
         inventory.save()
         super().save(*args, **kwargs)
 
-class Payment(models.Model):
+class Payment(FieldTrackerMixin, models.Model):
     order = models.OneToOneField(Order, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -274,12 +462,105 @@ class Payment(models.Model):
     refunded_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    tracked_fields = ('status',)
+
     class Meta:
         indexes = [models.Index(fields=['user', 'status']), models.Index(fields=['transaction_id'])]
 
     def __str__(self):
         return f"Payment for Order {self.order.order_code}"
 
+class StripeEvent(models.Model):
+    """Inbox các webhook event từ Stripe, khóa theo event id để loại bỏ event trùng lặp."""
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(
+        max_length=20,
+        choices=[('pending', 'Pending'), ('processed', 'Processed'), ('ignored', 'Ignored'), ('failed', 'Failed')],
+        default='pending'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'received_at'])]
+        ordering = ['received_at']
+
+    def __str__(self):
+        return f"{self.event_type} ({self.event_id})"
+
+class RefundRequest(models.Model):
+    """Hàng đợi hoàn tiền: mỗi Payment có tối đa một yêu cầu, worker Celery xử lý theo lô."""
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name='refund_request')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='refund_requests')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(
+        max_length=20,
+        choices=[('pending', 'Pending'), ('processing', 'Processing'), ('succeeded', 'Succeeded'), ('failed', 'Failed')],
+        default='pending'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    stripe_refund_id = models.CharField(max_length=100, blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created_at'])]
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"Refund for Order {self.order_id} ({self.status})"
+
+    @classmethod
+    def enqueue_for_orders(cls, order_ids):
+        """Tạo yêu cầu hoàn tiền cho các Payment đã hoàn tất của order_ids; bỏ qua Payment đã có yêu cầu."""
+        payments = Payment.objects.filter(order_id__in=order_ids, status='completed').values('id', 'order_id', 'amount')
+        created = cls.objects.bulk_create(
+            [cls(payment_id=row['id'], order_id=row['order_id'], amount=row['amount']) for row in payments],
+            ignore_conflicts=True
+        )
+        return len(created)
+
+class EmailOutbox(models.Model):
+    """Hàng đợi email: task gửi theo lô qua một kết nối SMTP, giới hạn tốc độ và thử lại có backoff."""
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    to_email = models.EmailField()
+    status = models.CharField(
+        max_length=20,
+        choices=[('queued', 'Queued'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')],
+        default='queued'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.subject} -> {self.to_email} ({self.status})"
+
+class DeviceTokenQuerySet(models.QuerySet):
+    def delete(self):
+        # Xóa hàng loạt (prune, giới hạn số token) không gọi delete() của instance nên xóa cache tại đây
+        from .device_tokens import device_token_registry
+        user_ids = set(self.values_list('user_id', flat=True))
+        result = super().delete()
+        if user_ids:
+            transaction.on_commit(lambda: device_token_registry.invalidate(user_ids), using=self.db)
+        return result
+
 class DeviceToken(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     token = models.CharField(max_length=200)
@@ -287,14 +568,40 @@ class DeviceToken(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = DeviceTokenQuerySet.as_manager()
+
     class Meta:
         unique_together = ('user', 'token')
-        indexes = [models.Index(fields=['user', 'token'])]
+        indexes = [models.Index(fields=['user', 'token']), models.Index(fields=['token'])]
 
     def __str__(self):
         return f"Device Token for {self.user.username}"
 
-class Notification(models.Model):
+    def save(self, *args, **kwargs):
+        from .device_tokens import device_token_registry
+        super().save(*args, **kwargs)
+        user_id = self.user_id
+        transaction.on_commit(lambda: device_token_registry.invalidate([user_id]))
+
+    def delete(self, *args, **kwargs):
+        from .device_tokens import device_token_registry
+        user_id = self.user_id
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: device_token_registry.invalidate([user_id]))
+        return result
+
+class NotificationQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create không gọi save() nên cập nhật bộ đếm chưa đọc tại đây
+        from .notifications import unread_counter, count_unread_by_user, notification_publisher
+        created = super().bulk_create(objs, *args, **kwargs)
+        counts = count_unread_by_user(created)
+        if counts:
+            transaction.on_commit(lambda: unread_counter.increment(counts), using=self.db)
+        notification_publisher.publish(created)
+        return created
+
+class Notification(FieldTrackerMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
     title = models.CharField(max_length=255)
     message = models.TextField()
@@ -314,6 +621,10 @@ class Notification(models.Model):
     related_order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='notifications')
     related_product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True, related_name='notifications')
 
+    objects = NotificationQuerySet.as_manager()
+
+    tracked_fields = ('is_read',)
+
     class Meta:
         indexes = [models.Index(fields=['user', 'is_read']), models.Index(fields=['created_at'])]
         ordering = ['-created_at']
@@ -321,6 +632,76 @@ class Notification(models.Model):
     def __str__(self):
         return f"{self.title} for {self.user.username}"
 
+    def save(self, *args, **kwargs):
+        from .notifications import unread_counter, notification_publisher
+        adding = self._state.adding
+        if adding:
+            delta = 0 if self.is_read else 1
+        elif self.has_field_changed('is_read'):
+            delta = -1 if self.is_read else 1
+        else:
+            delta = 0
+        super().save(*args, **kwargs)
+        if delta:
+            user_id = self.user_id
+            transaction.on_commit(lambda: unread_counter.increment({user_id: delta}))
+        if adding:
+            notification_publisher.publish([self])
+
+    def delete(self, *args, **kwargs):
+        from .notifications import unread_counter
+        was_unread = not self.previous_value('is_read') if self.pk else False
+        user_id = self.user_id
+        result = super().delete(*args, **kwargs)
+        if was_unread:
+            transaction.on_commit(lambda: unread_counter.decrement({user_id: 1}))
+        return result
+
+class PromotionCampaign(models.Model):
+    """Chiến dịch thông báo khuyến mãi cho một phân khúc user; last_user_id là checkpoint để chạy tiếp sau sự cố."""
+    title = models.CharField(max_length=255)
+    message = models.TextField()
+    segment = models.JSONField(default=dict, blank=True)
+    status = models.CharField(
+        max_length=20,
+        choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')],
+        default='queued'
+    )
+    last_user_id = models.BigIntegerField(default=0)
+    notified_count = models.PositiveIntegerField(default=0)
+    pushed_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='promotion_campaigns')
+    created_at = models.DateTimeField(auto_now_add=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.title} ({self.status})"
+
+    def segment_queryset(self):
+        """User thuộc phân khúc: role, số đơn đã hoàn thành (từ ordered_since) và danh mục đã từng mua."""
+        segment = self.segment or {}
+        users = User.objects.filter(is_active=True, role=segment.get('role', 'customer'))
+        completed_orders = Order.objects.filter(user=OuterRef('pk'), status='completed')
+        if segment.get('ordered_since'):
+            completed_orders = completed_orders.filter(created_at__date__gte=segment['ordered_since'])
+        if segment.get('min_completed_orders'):
+            order_counts = completed_orders.order_by().values('user').annotate(total=Count('id')).values('total')[:1]
+            users = users.annotate(completed_orders=Subquery(order_counts)).filter(
+                completed_orders__gte=segment['min_completed_orders']
+            )
+        elif segment.get('ordered_since'):
+            users = users.filter(Exists(completed_orders))
+        if segment.get('category_id'):
+            users = users.filter(Exists(OrderItem.objects.filter(
+                order__user=OuterRef('pk'), order__status='completed', product__category_id=segment['category_id']
+            )))
+        return users
+
 class Review(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews', limit_choices_to={'role': 'customer'})
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reviews')
@@ -0,0 +1,287 @@
+import weakref
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from .models import User, Notification
+from .utils import send_to_group
+
+UNREAD_COUNT_PREFIX = 'notifications:unread:'
+UNREAD_TOTAL_KEY = 'notifications:unread:total'
+UNREAD_RECONCILE_BATCH = 1000
+ONLINE_KEY_PREFIX = 'notifications:online:'
+COALESCE_KEY_PREFIX = 'notifications:coalesce:'
+MAX_NOTIFICATIONS_PER_EVENT = 20
+
+
+class UnreadCounter:
+    """
+    Đếm số thông báo chưa đọc trên Redis: một key cho mỗi user và một key tổng cho thống kê.
+    Key thiếu được tính lại từ SQL khi đọc; incr/decr chỉ áp dụng khi key đã tồn tại nên
+    không bao giờ tạo ra giá trị sai từ số 0. reconcile() định kỳ sửa các lệch còn sót.
+    """
+
+    def _user_key(self, user_id):
+        return f"{UNREAD_COUNT_PREFIX}{user_id}"
+
+    def _adjust(self, key, delta):
+        if not delta:
+            return
+        try:
+            value = cache.incr(key, delta) if delta > 0 else cache.decr(key, -delta)
+        except ValueError:
+            # Key chưa có trong cache: lần đọc sau sẽ tính lại từ SQL
+            return
+        if value < 0:
+            cache.delete(key)
+
+    def get(self, user_id):
+        count = cache.get(self._user_key(user_id))
+        if count is None:
+            count = Notification.objects.filter(user_id=user_id, is_read=False).count()
+            cache.add(self._user_key(user_id), count, timeout=settings.UNREAD_COUNT_TTL)
+        return count
+
+    def peek_many(self, user_ids):
+        """Đọc bộ đếm của nhiều user bằng một MGET, không tính lại từ SQL (None nếu chưa có)."""
+        cached = cache.get_many([self._user_key(user_id) for user_id in user_ids])
+        return {user_id: cached.get(self._user_key(user_id)) for user_id in user_ids}
+
+    def get_total(self):
+        count = cache.get(UNREAD_TOTAL_KEY)
+        if count is None:
+            count = Notification.objects.filter(is_read=False).count()
+            cache.add(UNREAD_TOTAL_KEY, count, timeout=settings.UNREAD_COUNT_TTL)
+        return count
+
+    def increment(self, counts):
+        """counts: {user_id: số thông báo chưa đọc mới}."""
+        for user_id, delta in counts.items():
+            if delta:
+                self._adjust(self._user_key(user_id), delta)
+        self._adjust(UNREAD_TOTAL_KEY, sum(counts.values()))
+
+    def decrement(self, counts):
+        """counts: {user_id: số thông báo vừa được đọc hoặc bị xóa}."""
+        self.increment({user_id: -delta for user_id, delta in counts.items()})
+
+    def reconcile(self):
+        """
+        Đối chiếu bộ đếm trên cache với SQL theo lô user (keyset theo id, một MGET và một GROUP BY
+        mỗi lô); chỉ sửa các key đang có trong cache. Không quét key nên chạy được trên mọi cache backend.
+        Trả về số key đã sửa.
+        """
+        fixed = 0
+        last_id = 0
+        while True:
+            user_ids = list(
+                User.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:UNREAD_RECONCILE_BATCH]
+            )
+            if not user_ids:
+                break
+            fixed += self._reconcile_users(user_ids)
+            last_id = user_ids[-1]
+        cache.set(UNREAD_TOTAL_KEY, Notification.objects.filter(is_read=False).count(), timeout=settings.UNREAD_COUNT_TTL)
+        return fixed
+
+    def _reconcile_users(self, user_ids):
+        actual = dict.fromkeys(user_ids, 0)
+        actual.update(
+            Notification.objects.filter(user_id__in=user_ids, is_read=False)
+            .values_list('user_id').annotate(total=Count('id')).order_by()
+        )
+        cached = cache.get_many([self._user_key(user_id) for user_id in user_ids])
+        wrong = {
+            self._user_key(user_id): count for user_id, count in actual.items()
+            if cached.get(self._user_key(user_id)) not in (None, count)
+        }
+        if wrong:
+            cache.set_many(wrong, timeout=settings.UNREAD_COUNT_TTL)
+        return len(wrong)
+
+
+unread_counter = UnreadCounter()
+
+
+def count_unread_by_user(notifications):
+    """Đếm số thông báo chưa đọc theo user_id trong một danh sách Notification."""
+    return Counter(notification.user_id for notification in notifications if not notification.is_read)
+
+
+def notification_group(user_id):
+    return f"notifications_{user_id}"
+
+def mark_user_online(user_id):
+    """
+    Đếm số kết nối WebSocket đang mở của user để chỉ publish cho user đang online. Key có TTL
+    NOTIFICATION_ONLINE_TTL và được NotificationConsumer gia hạn khi socket còn mở, nên worker
+    chết hoặc disconnect bị mất không để user "online" mãi.
+    """
+    key = f"{ONLINE_KEY_PREFIX}{user_id}"
+    cache.add(key, 0, timeout=settings.NOTIFICATION_ONLINE_TTL)
+    cache.incr(key)
+    cache.touch(key, settings.NOTIFICATION_ONLINE_TTL)
+
+def refresh_user_online(user_id):
+    key = f"{ONLINE_KEY_PREFIX}{user_id}"
+    if not cache.touch(key, settings.NOTIFICATION_ONLINE_TTL):
+        # Key đã hết hạn (Redis bị gián đoạn lâu hơn TTL): socket vẫn mở nên đánh dấu lại
+        cache.add(key, 1, timeout=settings.NOTIFICATION_ONLINE_TTL)
+
+def mark_user_offline(user_id):
+    key = f"{ONLINE_KEY_PREFIX}{user_id}"
+    try:
+        if cache.decr(key) <= 0:
+            cache.delete(key)
+    except ValueError:
+        pass
+
+def online_user_ids(user_ids):
+    cached = cache.get_many([f"{ONLINE_KEY_PREFIX}{user_id}" for user_id in user_ids])
+    return {user_id for user_id in user_ids if cached.get(f"{ONLINE_KEY_PREFIX}{user_id}")}
+
+
+def assign_missing_ids(notifications):
+    """
+    MySQL không trả id cho bulk_create: đọc lại id của các thông báo chưa có pk bằng một truy vấn
+    theo user và khoảng created_at, ghép theo (user, loại, tiêu đề, nội dung, created_at).
+    Chạy sau commit và chỉ cho thông báo sắp được publish (user đang online).
+    """
+    missing = [notification for notification in notifications if notification.pk is None]
+    if not missing:
+        return
+    rows = Notification.objects.filter(
+        user_id__in={notification.user_id for notification in missing},
+        created_at__gte=min(notification.created_at for notification in missing),
+        created_at__lte=max(notification.created_at for notification in missing),
+    ).order_by('id').values_list('id', 'user_id', 'notification_type', 'title', 'message', 'created_at')
+    ids_by_key = defaultdict(list)
+    for notification_id, *key in rows:
+        ids_by_key[tuple(key)].append(notification_id)
+    for notification in missing:
+        ids = ids_by_key.get((
+            notification.user_id, notification.notification_type, notification.title,
+            notification.message, notification.created_at
+        ))
+        if ids:
+            notification.pk = ids.pop(0)
+
+
+class NotificationPublisher:
+    """
+    Đẩy Notification mới tới group Channels của user sau khi transaction commit.
+    Mọi thông báo tạo trong cùng một transaction được gom lại thành một sự kiện cho mỗi user
+    (tối đa MAX_NOTIFICATIONS_PER_EVENT bản ghi kèm tổng số), và chỉ gửi cho user đang online.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def publish(self, notifications):
+        if not notifications:
+            return
+        # Thread-local chỉ giữ weakref: batch sống nhờ callback on_commit của transaction hiện tại.
+        # Transaction (hoặc savepoint) rollback thì Django bỏ callback, batch bị thu hồi và lần
+        # publish sau tạo batch mới thay vì gom vào batch của transaction đã hủy.
+        batch_ref = getattr(self._local, 'batch', None)
+        batch = batch_ref() if batch_ref is not None else None
+        if batch is not None:
+            for notification in notifications:
+                batch.add(notification)
+            return
+        batch = _NotificationBatch(self)
+        for notification in notifications:
+            batch.add(notification)
+        self._local.batch = weakref.ref(batch)
+        # robust: lỗi Redis/Channels khi publish không được làm hỏng request đã commit
+        transaction.on_commit(batch.flush, robust=True)
+
+    def send(self, by_user):
+        from .serializers import NotificationSerializer
+        online = online_user_ids(list(by_user))
+        if not online:
+            return
+        latest = {user_id: by_user[user_id][-MAX_NOTIFICATIONS_PER_EVENT:] for user_id in online}
+        assign_missing_ids([notification for items in latest.values() for notification in items])
+        unread_counts = unread_counter.peek_many(list(online))
+        for user_id in online:
+            send_to_group(notification_group(user_id), 'notification.created', {
+                'count': len(by_user[user_id]),
+                'unread_count': unread_counts.get(user_id),
+                'notifications': NotificationSerializer(latest[user_id], many=True).data,
+            })
+
+
+class _NotificationBatch:
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.by_user = defaultdict(list)
+
+    def add(self, notification):
+        self.by_user[notification.user_id].append(notification)
+
+    def flush(self):
+        batch_ref = getattr(self.publisher._local, 'batch', None)
+        if batch_ref is not None and batch_ref() is self:
+            self.publisher._local.batch = None
+        self.publisher.send(self.by_user)
+
+
+notification_publisher = NotificationPublisher()
+
+
+class NotificationCoalescer:
+    """
+    Gom các thông báo cùng loại, cùng user và cùng đối tượng (vd. đánh giá mới của một sản phẩm)
+    trong một cửa sổ thời gian: mỗi sự kiện chỉ tăng bộ đếm trên Redis, hết cửa sổ thì task flush
+    tạo một thông báo tổng hợp và một push. Chỉ có bộ đếm (số sự kiện, tổng giá trị) nên Redis
+    không phải giữ từng bản ghi.
+    """
+
+    def _key(self, kind, user_id, target_id, suffix):
+        return f"{COALESCE_KEY_PREFIX}{kind}:{user_id}:{target_id}:{suffix}"
+
+    def add(self, kind, user_id, target_id, value=0):
+        """Ghi nhận một sự kiện; trả về True nếu sự kiện mở cửa sổ mới (người gọi phải lên lịch flush)."""
+        # TTL dư ra so với cửa sổ để bộ đếm không mất nếu task flush chạy trễ
+        ttl = settings.NOTIFICATION_COALESCE_WINDOW * 10
+        for suffix, delta in (('count', 1), ('total', value)):
+            key = self._key(kind, user_id, target_id, suffix)
+            cache.add(key, 0, timeout=ttl)
+            if delta:
+                cache.incr(key, delta)
+        return self.open_window(kind, user_id, target_id)
+
+    def open_window(self, kind, user_id, target_id):
+        return cache.add(self._key(kind, user_id, target_id, 'window'), 1, timeout=settings.NOTIFICATION_COALESCE_WINDOW * 2)
+
+    def drain(self, kind, user_id, target_id):
+        """
+        Lấy và trừ đi số sự kiện đã gom (count, total). Dùng decr thay vì xóa key để các sự kiện
+        đến trong lúc flush vẫn được giữ lại cho cửa sổ sau.
+        """
+        drained = []
+        for suffix in ('count', 'total'):
+            key = self._key(kind, user_id, target_id, suffix)
+            value = cache.get(key) or 0
+            if value:
+                try:
+                    cache.decr(key, value)
+                except ValueError:
+                    pass
+            drained.append(value)
+        return tuple(drained)
+
+    def close_window(self, kind, user_id, target_id):
+        """Đóng cửa sổ sau khi flush; trả về True nếu còn sự kiện mới và đã mở cửa sổ tiếp theo."""
+        cache.delete(self._key(kind, user_id, target_id, 'window'))
+        if cache.get(self._key(kind, user_id, target_id, 'count')):
+            return self.open_window(kind, user_id, target_id)
+        return False
+
+
+notification_coalescer = NotificationCoalescer()
@@ -5,4 +5,7 @@ websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<conversation_id>[^/]+)/$', consumers.ChatConsumer.as_asgi()),
     re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi(), {'conversation_id': 'new'}),
     re_path(r'ws/chat/new/$', consumers.ChatConsumer.as_asgi(), {'conversation_id': 'new'}),
+    re_path(r'ws/orders/$', consumers.OrderStatusConsumer.as_asgi()),
+    re_path(r'ws/payments/$', consumers.PaymentStatusConsumer.as_asgi()),
+    re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -1,14 +1,16 @@
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
 from django.utils import timezone
+from django.db import transaction
 from decimal import Decimal
 from cloudinary.utils import cloudinary_url
-from .models import User, Product, Cart, CartItem, Order, OrderItem, Payment, DeviceToken, Category, Inventory, Discount, Notification, Review, ReviewReply
+from .models import User, Product, Cart, CartItem, Order, OrderItem, Payment, DeviceToken, Category, Inventory, Discount, Notification, Review, ReviewReply, PromotionCampaign
 from django.contrib.auth import get_user_model
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_decode
 from django.utils.encoding import force_str
 from asgiref.sync import async_to_sync
+from .discounts import get_discount_by_code
 
 # Serializer cho User
 class UserSerializer(ModelSerializer):
@@ -62,7 +64,7 @@ class UserDetailSerializer(ModelSerializer):
     carts = serializers.SerializerMethodField()
 
     def get_orders(self, obj):
-        orders = obj.orders.filter(status__in=['pending', 'processing', 'completed'])
+        orders = obj.orders.filter(status__in=['pending', 'processing', 'completed']).prefetch_related('items__product')
         return OrderSerializer(orders, many=True).data
 
     def get_carts(self, obj):
@@ -91,7 +93,9 @@ class ProductSerializer(ModelSerializer):
         read_only_fields = ['id', 'distributor', 'created_at', 'updated_at', 'is_approved', 'has_inventory']
 
     def get_total_stock(self, obj):
-        return obj.total_stock
+        # Dùng stock_total đã annotate (lịch sử đơn hàng ?expand=product) nếu có
+        stock_total = getattr(obj, 'stock_total', None)
+        return obj.total_stock if stock_total is None else stock_total
 
     def validate(self, data):
         user = self.context['request'].user
@@ -195,12 +199,16 @@ class OrderSerializer(ModelSerializer):
 
     class Meta:
         model = Order
-        fields = ['id', 'user', 'order_code', 'total_amount', 'discount_amount', 'status', 'items', 'created_at', 'updated_at', 'discount_code']
-        read_only_fields = ['id', 'user', 'order_code', 'total_amount', 'discount_amount', 'created_at', 'updated_at']
+        fields = ['id', 'user', 'order_code', 'items_subtotal', 'total_amount', 'discount_amount', 'status', 'items', 'created_at', 'updated_at', 'discount_code']
+        read_only_fields = ['id', 'user', 'order_code', 'items_subtotal', 'total_amount', 'discount_amount', 'created_at', 'updated_at']
 
     def get_items(self, obj):
+        # Dùng kết quả prefetch_related('items__product') nếu có; ProductSerializer đầy đủ chỉ khi ?expand=product
         items = obj.items.all()
-        return OrderItemSerializer(items, many=True).data
+        request = self.context.get('request')
+        if request is not None and request.query_params.get('expand') == 'product':
+            return OrderItemSerializer(items, many=True, context=self.context).data
+        return OrderItemCompactSerializer(items, many=True).data
 
     def validate(self, data):
         user = self.context['request'].user
@@ -234,7 +242,7 @@ class OrderSerializer(ModelSerializer):
 
         if discount_code:
             try:
-                discount = Discount.objects.get(code=discount_code)
+                discount = get_discount_by_code(discount_code)
             except Discount.DoesNotExist:
                 raise serializers.ValidationError("Mã giảm giá không tồn tại.")
 
@@ -251,24 +259,16 @@ class OrderSerializer(ModelSerializer):
 
         try:
             cart = Cart.objects.get(id=cart_id, user=user)
-            order_code = timezone.now().strftime('%Y%m%d%H%M%S') + str(user.id)
-            order = Order.objects.create(user=user, order_code=order_code)
+            from .utils import generate_order_code
+            order_code = generate_order_code()
+            order = Order.objects.create(user=user, order_code=order_code, status='placing')
 
-            for cart_item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    quantity=cart_item.quantity,
-                    price=cart_item.product.price
-                )
-
-            if discount_code:
-                discount = Discount.objects.get(code=discount_code)
-                order.discount = discount
-                order.apply_discount()
-
-            # Clear the cart after creating the order
-            cart.items.all().delete()
+            discount = get_discount_by_code(discount_code) if discount_code else None
+            with transaction.atomic():
+                order.place_from_cart(cart, discount)
+                # Giống place_order_async: 'placing' -> 'pending' kích hoạt thông báo "Đơn hàng được tạo"
+                order.status = 'pending'
+                order.save(update_fields=['status', 'updated_at'])
 
             return order
 
@@ -301,6 +301,23 @@ class OrderItemSerializer(ModelSerializer):
                 raise serializers.ValidationError(f"Số lượng vượt quá tồn kho ({product_instance.stock}).")
         return value
 
+# Serializer rút gọn cho OrderItem trong danh sách/lịch sử đơn hàng
+class OrderItemCompactSerializer(ModelSerializer):
+    product = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderItem
+        fields = ['id', 'product', 'quantity', 'price']
+        read_only_fields = fields
+
+    def get_product(self, obj):
+        product = obj.product
+        return {
+            'id': product.id,
+            'name': product.name,
+            'image': cloudinary_url(product.image.public_id)[0] if product.image else '',
+        }
+
 # Serializer cho Payment
 class PaymentSerializer(ModelSerializer):
     order_code = serializers.ReadOnlyField(source='order.order_code')
@@ -380,8 +397,11 @@ class DiscountSerializer(ModelSerializer):
         return data
 
     def get_is_valid_status(self, obj):
-        # We call is_valid with order_amount=0 to just check validity status without order context
-        valid, message = obj.is_valid(order_amount=0)
+        # Dùng annotation từ DiscountQuerySet.with_validity() nếu có; chỉ tính bằng Python cho instance đơn lẻ
+        if hasattr(obj, 'is_currently_valid'):
+            return {'valid': obj.is_currently_valid, 'message': obj.validity_message}
+        # Truyền min_order_value để bỏ qua điều kiện giá trị đơn hàng tối thiểu
+        valid, message = obj.is_valid(order_amount=obj.min_order_value or 0)
         return {'valid': valid, 'message': message}
 
 class NotificationSerializer(ModelSerializer):
@@ -404,6 +424,31 @@ class NotificationSerializer(ModelSerializer):
             instance.is_read = True
         return super().update(instance, validated_data)
 
+class PromotionSegmentSerializer(serializers.Serializer):
+    role = serializers.ChoiceField(choices=['customer', 'distributor', 'admin'], default='customer')
+    category_id = serializers.IntegerField(required=False, min_value=1)
+    min_completed_orders = serializers.IntegerField(required=False, min_value=1)
+    ordered_since = serializers.DateField(required=False)
+
+    def validate_category_id(self, value):
+        if not Category.objects.filter(id=value).exists():
+            raise serializers.ValidationError("Danh mục không tồn tại.")
+        return value
+
+class PromotionCampaignSerializer(ModelSerializer):
+    segment = PromotionSegmentSerializer(required=False)
+
+    class Meta:
+        model = PromotionCampaign
+        fields = ['id', 'title', 'message', 'segment', 'status', 'notified_count', 'pushed_count', 'error', 'created_at', 'finished_at']
+        read_only_fields = ['id', 'status', 'notified_count', 'pushed_count', 'error', 'created_at', 'finished_at']
+
+    def create(self, validated_data):
+        segment = validated_data.pop('segment', {})
+        if segment.get('ordered_since'):
+            segment['ordered_since'] = segment['ordered_since'].isoformat()
+        return PromotionCampaign.objects.create(segment=segment, **validated_data)
+
 class ReviewReplySerializer(ModelSerializer):
     review_id = serializers.SerializerMethodField()
     product_name = serializers.SerializerMethodField()
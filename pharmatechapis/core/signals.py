@@ -1,13 +1,17 @@
 from django.db.models.signals import post_migrate, pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
 from django.contrib.auth import get_user_model
+from django.conf import settings
 from .models import User, Product, Order, Payment, Notification, Review, ReviewReply
-from .tasks import send_payment_confirmation_email, process_order_refunded, update_inventory_stock, notify_product_approval, send_notification_task
-from .utils import send_fcm_v1
+from .tasks import enqueue_refunds, restock_orders, update_inventory_stock, notify_product_approval, send_notification_task, coalesce_review_notification, create_order_notification, send_payment_confirmation_email
 
 # Tạo superuser mặc định sau khi migrate
 @receiver(post_migrate)
 def create_default_superuser(sender, **kwargs):
+    # Mật khẩu mặc định chỉ dùng cho môi trường phát triển
+    if not settings.DEBUG:
+        return
     User = get_user_model()
     if not User.objects.filter(username='admin').exists():
         User.objects.create_superuser(
@@ -17,51 +21,37 @@ def create_default_superuser(sender, **kwargs):
             full_name='Admin User'
         )
 
-# Cập nhật trạng thái is_approved của Product trước khi lưu
+# Gửi thông báo khi Product được duyệt (sau commit để task đọc được trạng thái mới)
 @receiver(pre_save, sender=Product)
 def update_product_status(sender, instance, **kwargs):
-    if instance.pk:
-        old_product = Product.objects.get(pk=instance.pk)
-        if old_product.is_approved != instance.is_approved and instance.is_approved:
-            notify_product_approval.delay(instance.id)
+    if instance.has_field_changed('is_approved') and instance.is_approved:
+        product_id = instance.id
+        transaction.on_commit(lambda: notify_product_approval.delay(product_id))
 
-# Cập nhật stock của Product khi Order được tạo
+# Tạo thông báo "Đơn hàng được tạo" khi đơn chuyển 'placing' -> 'pending' (đặt hàng đồng bộ và
+# place_order_async đều đi qua bước này); tồn kho đã được trừ trong OrderItem.save()
 @receiver(post_save, sender=Order)
-def update_product_stock(sender, instance, created, **kwargs):
-    if created:
-        for item in instance.items.all():
-            update_inventory_stock.delay(item.product.id, item.quantity, is_increase=False)
-
-        # Signal mới: Tạo Notification khi đơn hàng được tạo
-        Notification.objects.create(
-            user=instance.user,
-            title="Đơn hàng được tạo",
-            message=f"Đơn hàng {instance.order_code} đã được tạo.",
-            notification_type="order",
-            related_order=instance
-        )
-        send_notification_task.delay(instance.user.id, "Đơn hàng được tạo", f"Đơn hàng {instance.order_code} đã được tạo.", "order", order_id=instance.id)
+def notify_order_created(sender, instance, created, **kwargs):
+    if not created and instance.has_field_changed('status') and instance.previous_value('status') == 'placing' and instance.status == 'pending':
+        order_id = instance.id
+        transaction.on_commit(lambda: create_order_notification.delay(order_id))
 
-# Cập nhật stock của Product và xử lý hoàn tiền khi Order bị hủy
-@receiver(pre_save, sender=Order)
-def handle_order_cancellation(sender, instance, **kwargs):
-    if instance.pk is not None:
-        try:
-            old_order = Order.objects.get(pk=instance.pk)
-            if old_order.status != 'cancelled' and instance.status == 'cancelled':
-                for item in instance.items.all():
-                    update_inventory_stock.delay(item.product.id, item.quantity, is_increase=True)
-                process_order_refunded.delay(instance.id)
-        except Order.DoesNotExist:
-            pass
+# Hoàn kho và xếp yêu cầu hoàn tiền khi một Order bị hủy qua save() (hủy hàng loạt dùng
+# Order.bulk_transition + process_order_transition_batch)
+@receiver(post_save, sender=Order)
+def handle_order_cancellation(sender, instance, created, **kwargs):
+    # post_save chạy trước khi FieldTrackerMixin cập nhật snapshot nên vẫn thấy giá trị cũ
+    if not created and instance.has_field_changed('status') and instance.status == 'cancelled':
+        restock_orders([instance.id])
+        enqueue_refunds([instance.id])
 
-# Gửi thông báo FCM và email khi Payment được xác nhận
+# Gửi email khi Payment chuyển sang completed qua save() (admin...). apply_payment_outcomes lưu bằng
+# bulk_update nên không đi qua receiver này và tự gửi email cho webhook, đối soát, confirm-payment
 @receiver(post_save, sender=Payment)
 def notify_payment_confirmation(sender, instance, created, **kwargs):
-    if not created and instance.status:
-        old_payment = Payment.objects.get(pk=instance.pk)
-        if not old_payment.status:
-            send_payment_confirmation_email.delay(instance.user.id, instance.order.order_code)
+    if not created and instance.has_field_changed('status') and instance.status == 'completed':
+        user_id, order_code = instance.user_id, instance.order.order_code
+        transaction.on_commit(lambda: send_payment_confirmation_email.delay(user_id, order_code))
 
 # Cập nhật stock khi Order bị xóa
 @receiver(post_delete, sender=Order)
@@ -73,14 +63,9 @@ def revert_product_stock_on_order_delete(sender, instance, **kwargs):
 @receiver(post_save, sender=Review)
 def create_notification_on_review(sender, instance, created, **kwargs):
     if created:
-        Notification.objects.create(
-            user=instance.product.distributor,
-            title="Đánh giá mới",
-            message=f"Sản phẩm {instance.product.name} nhận được đánh giá {instance.rating} sao.",
-            notification_type="product",
-            related_product=instance.product
-        )
-        send_notification_task.delay(instance.product.distributor.id, "Đánh giá mới", f"Sản phẩm {instance.product.name} nhận được đánh giá {instance.rating} sao.", "product", product_id=instance.product.id)
+        # Gom đánh giá theo sản phẩm: nhà phân phối nhận một thông báo tổng hợp cho mỗi cửa sổ.
+        # robust: lỗi Redis/Celery không được làm hỏng request tạo đánh giá đã commit
+        transaction.on_commit(lambda: coalesce_review_notification(instance), robust=True)
 
 # Signal mới: Tạo Notification khi ReviewReply được tạo
 @receiver(post_save, sender=ReviewReply)
@@ -0,0 +1,202 @@
+import time
+import uuid
+import random
+import logging
+import threading
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Lỗi tạm thời (mạng, 429, 5xx) mới được thử lại; lỗi 4xx trả về ngay
+RETRYABLE_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError)
+
+
+class StripeUnavailableError(stripe.error.APIConnectionError):
+    """Circuit breaker đang mở: từ chối ngay thay vì chờ Stripe. Kế thừa StripeError để các handler cũ vẫn bắt được."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker theo process: mở sau `failure_threshold` lỗi liên tiếp, sau `reset_timeout`
+    giây cho đúng một request thử (half-open); thành công thì đóng lại, lỗi thì mở tiếp.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                raise StripeUnavailableError("Stripe tạm thời không khả dụng, vui lòng thử lại sau.")
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f"Stripe circuit breaker opened after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class ThreadLocalSession:
+    """
+    Mỗi thread một requests.Session (Session không được requests đảm bảo thread-safe; refund chạy
+    trong ThreadPoolExecutor), tất cả dùng chung một HTTPAdapter: pool kết nối urllib3 bên trong
+    adapter là thread-safe nên vẫn giữ keep-alive và giới hạn pool_maxsize cho cả process.
+    """
+
+    def __init__(self, adapter):
+        self._adapter = adapter
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+            self._local.session = session
+        return session
+
+    def request(self, *args, **kwargs):
+        return self._session().request(*args, **kwargs)
+
+    def close(self):
+        self._adapter.close()
+
+
+class StripeGateway:
+    """
+    Điểm gọi Stripe duy nhất của hệ thống: dùng chung một HTTP session keep-alive, timeout
+    rõ ràng, retry có jitter (chỉ cho lời gọi idempotent) và circuit breaker.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, max_retries, pool_size, breaker, api_base=''):
+        self.max_retries = max_retries
+        self.breaker = breaker
+        session = ThreadLocalSession(HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        # Client riêng của gateway: không đụng tới stripe.api_key/default_http_client toàn cục
+        # nên các chỗ khác dùng thư viện stripe trong cùng process không bị ảnh hưởng.
+        # Retry do gateway đảm nhiệm (max_network_retries=0) để breaker thấy được từng lần lỗi
+        self.client = stripe.StripeClient(
+            settings.STRIPE_SECRET_KEY,
+            http_client=stripe.RequestsClient(timeout=(connect_timeout, read_timeout), session=session),
+            max_network_retries=0,
+            base_addresses={'api': api_base} if api_base else {},
+        )
+
+    def _backoff(self, attempt):
+        # Full jitter: ngẫu nhiên trong [0, 0.25 * 2^attempt] giây, tối đa 2 giây
+        return random.uniform(0, min(2.0, 0.25 * (2 ** attempt)))
+
+    def _call(self, func, *args, **kwargs):
+        self.breaker.before_call()
+        for attempt in range(self.max_retries + 1):
+            outcome = None
+            try:
+                result = func(*args, **kwargs)
+                outcome = 'success'
+                return result
+            except RETRYABLE_ERRORS as e:
+                outcome = 'failure'
+                self.breaker.record_failure()
+                if attempt == self.max_retries or self.breaker.state != 'closed':
+                    raise
+                logger.warning(f"Stripe call {func.__qualname__} failed (attempt {attempt + 1}): {str(e)}")
+            except stripe.error.StripeError:
+                # Lỗi 4xx nghĩa là Stripe vẫn phản hồi bình thường
+                outcome = 'success'
+                raise
+            finally:
+                if outcome == 'success':
+                    self.breaker.record_success()
+                elif outcome is None:
+                    # Lỗi ngoài Stripe (kể cả BaseException) cũng tính là lỗi, nếu không probe
+                    # half-open giữ _probing=True mãi và breaker không bao giờ đóng lại
+                    self.breaker.record_failure()
+            time.sleep(self._backoff(attempt))
+
+    def create_checkout_session(self, idempotency_key=None, **params):
+        # Khóa idempotency cố định cho mọi lần retry để Stripe không tạo trùng session
+        return self._call(
+            self.client.v1.checkout.sessions.create,
+            params=params,
+            options={'idempotency_key': idempotency_key or f"checkout-{uuid.uuid4().hex}"},
+        )
+
+    def retrieve_checkout_session(self, session_id, **params):
+        return self._call(self.client.v1.checkout.sessions.retrieve, session_id, params=params)
+
+    def _list_params(self, created_gte, limit, starting_after, expand):
+        params = {'created': {'gte': created_gte}, 'limit': limit}
+        if starting_after:
+            params['starting_after'] = starting_after
+        if expand:
+            params['expand'] = expand
+        return params
+
+    def _iter_pages(self, list_page, created_gte, page_size, expand):
+        starting_after = None
+        while True:
+            page = list_page(created_gte, page_size, starting_after, expand)
+            yield from page.data
+            if not page.has_more or not page.data:
+                return
+            starting_after = page.data[-1].id
+
+    def list_checkout_sessions(self, created_gte, limit=100, starting_after=None, expand=None):
+        return self._call(
+            self.client.v1.checkout.sessions.list, params=self._list_params(created_gte, limit, starting_after, expand)
+        )
+
+    def iter_checkout_sessions(self, created_gte, page_size=100, expand=None):
+        """Duyệt mọi Checkout Session tạo từ `created_gte` (unix time), mỗi trang là một lời gọi có retry/breaker."""
+        return self._iter_pages(self.list_checkout_sessions, created_gte, page_size, expand)
+
+    def list_payment_intents(self, created_gte, limit=100, starting_after=None, expand=None):
+        return self._call(
+            self.client.v1.payment_intents.list, params=self._list_params(created_gte, limit, starting_after, expand)
+        )
+
+    def iter_payment_intents(self, created_gte, page_size=100, expand=None):
+        """Duyệt mọi PaymentIntent tạo từ `created_gte` (unix time), kể cả PaymentIntent do Checkout Session sinh ra."""
+        return self._iter_pages(self.list_payment_intents, created_gte, page_size, expand)
+
+    def create_refund(self, idempotency_key, **params):
+        return self._call(self.client.v1.refunds.create, params=params, options={'idempotency_key': idempotency_key})
+
+stripe_gateway = StripeGateway(
+    connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+    read_timeout=settings.STRIPE_READ_TIMEOUT,
+    max_retries=settings.STRIPE_MAX_RETRIES,
+    pool_size=settings.STRIPE_POOL_SIZE,
+    breaker=CircuitBreaker(settings.STRIPE_BREAKER_THRESHOLD, settings.STRIPE_BREAKER_RESET_TIMEOUT),
+    api_base=settings.STRIPE_API_BASE,
+)
@@ -1,73 +1,191 @@
 from celery import shared_task
 from django.utils import timezone
-from .models import User, Product, Order, Payment, Notification, Review, ReviewReply
-from .utils import send_fcm_v1, process_stripe_refund
-from django.core.mail import send_mail
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F, Q, Sum
+from .models import User, Product, Order, OrderItem, Payment, Notification, Review, ReviewReply, Cart, Discount, Inventory, StripeEvent, RefundRequest, PromotionCampaign, DeviceToken, EmailOutbox
+from .utils import send_fcm_v1, send_fcm_batch, send_fcm_multicast, prune_device_tokens, find_invalid_device_tokens, FCM_BATCH_LIMIT, process_stripe_refund, send_to_group, order_status_group, publish_payment_status
+from .discounts import get_discount_by_code, discount_registry
+from .stripe_gateway import stripe_gateway
+from .notifications import unread_counter, notification_coalescer
+from django.core.mail import get_connection, EmailMessage
+import smtplib
+import random
+from django.core.cache import cache
 from django.conf import settings
 from .utils import scrape_website, store_scraped_data
 import logging
 import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp
 
 logger = logging.getLogger(__name__)
 
+EMAIL_BATCH_SIZE = 50
+EMAIL_MAX_ATTEMPTS = 5
+EMAIL_STALE_AFTER = timedelta(minutes=10)
+# Lỗi do địa chỉ người nhận: thử lại cũng không thành công
+EMAIL_PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)
+
+def queue_emails(emails):
+    """
+    Xếp email vào EmailOutbox ([{'subject', 'body', 'to_email'}]) và lên lịch task gửi sau khi commit.
+    Thay cho send_mail trực tiếp: không mở kết nối SMTP trong request hay trong từng task.
+    """
+    rows = [
+        EmailOutbox(
+            subject=email['subject'], body=email['body'], to_email=email['to_email'],
+            from_email=email.get('from_email') or settings.EMAIL_HOST_USER
+        )
+        for email in emails if email.get('to_email')
+    ]
+    if rows:
+        EmailOutbox.objects.bulk_create(rows)
+        transaction.on_commit(schedule_email_sending)
+    return len(rows)
+
+def queue_email(subject, body, to_email, from_email=None):
+    return queue_emails([{'subject': subject, 'body': body, 'to_email': to_email, 'from_email': from_email}])
+
+def schedule_email_sending():
+    """Gom các email được xếp liên tiếp vào một lần chạy send_queued_emails."""
+    if cache.add('email_outbox:scheduled', 1, timeout=10):
+        send_queued_emails.apply_async(countdown=1)
+
+def reserve_email_quota(wanted):
+    """
+    Giới hạn số email mỗi phút theo quota của nhà cung cấp (đếm chung trên Redis cho mọi worker).
+    Trả về (key, granted): key dùng để trả lại phần quota không dùng tới.
+    """
+    key = f"email_outbox:quota:{int(time.time() // 60)}"
+    cache.add(key, 0, timeout=120)
+    used = cache.incr(key, wanted)
+    granted = max(0, min(wanted, settings.EMAIL_RATE_LIMIT_PER_MINUTE - (used - wanted)))
+    if granted < wanted:
+        cache.decr(key, wanted - granted)
+    return key, granted
+
+def release_email_quota(key, unused):
+    if unused > 0:
+        try:
+            cache.decr(key, unused)
+        except ValueError:
+            # Key của phút trước đã hết hạn: không còn gì để trả lại
+            pass
+
+def email_retry_delay(attempts):
+    # Backoff lũy thừa có jitter: ~1, 2, 4, 8 phút..., tối đa 1 giờ
+    return timedelta(seconds=min(3600, 60 * (2 ** (attempts - 1))) * random.uniform(0.8, 1.2))
+
+def claimable_emails(now):
+    """Email đến hạn gửi và email kẹt ở 'sending' quá EMAIL_STALE_AFTER (worker chết giữa chừng)."""
+    return EmailOutbox.objects.filter(
+        Q(status='queued', next_attempt_at__lte=now) | Q(status='sending', updated_at__lt=now - EMAIL_STALE_AFTER)
+    )
+
+def claim_queued_emails(limit):
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = list(
+            claimable_emails(now).select_for_update(skip_locked=True)
+            .order_by('next_attempt_at').values_list('id', flat=True)[:limit]
+        )
+        EmailOutbox.objects.filter(id__in=claimed).update(status='sending', updated_at=now)
+    return list(EmailOutbox.objects.filter(id__in=claimed))
+
+@shared_task
+def send_queued_emails(batch_size=EMAIL_BATCH_SIZE):
+    """Gửi một lô email trong EmailOutbox qua một kết nối SMTP duy nhất, tôn trọng quota và backoff."""
+    cache.delete('email_outbox:scheduled')
+    due = claimable_emails(timezone.now())
+    quota_key, quota = reserve_email_quota(min(batch_size, due.count()))
+    if not quota:
+        return 0
+    emails = claim_queued_emails(quota)
+    # Worker khác đã giành một phần các email đếm được: trả lại quota chưa dùng
+    release_email_quota(quota_key, quota - len(emails))
+    if not emails:
+        return 0
+
+    now = timezone.now()
+    sent = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+        for email in emails:
+            message = EmailMessage(email.subject, email.body, email.from_email, [email.to_email], connection=connection)
+            email.attempts += 1
+            email.updated_at = now
+            try:
+                try:
+                    message.send()
+                except smtplib.SMTPServerDisconnected:
+                    # Server đóng kết nối giữa chừng (timeout, giới hạn số lệnh): mở lại một lần
+                    connection.close()
+                    connection.open()
+                    message.send()
+            except Exception as e:
+                email.last_error = str(e)
+                if isinstance(e, EMAIL_PERMANENT_ERRORS) or email.attempts >= EMAIL_MAX_ATTEMPTS:
+                    email.status = 'failed'
+                else:
+                    email.status = 'queued'
+                    email.next_attempt_at = now + email_retry_delay(email.attempts)
+                logger.warning(f"Error sending email {email.id} to {email.to_email}: {str(e)}")
+            else:
+                email.status = 'sent'
+                email.sent_at = timezone.now()
+                email.last_error = None
+                sent += 1
+    except Exception as e:
+        # Không mở được kết nối: trả cả lô về hàng đợi với backoff
+        logger.error(f"Error opening SMTP connection: {str(e)}")
+        for email in emails:
+            if email.status == 'sending':
+                email.attempts += 1
+                email.updated_at = now
+                email.status = 'queued' if email.attempts < EMAIL_MAX_ATTEMPTS else 'failed'
+                email.next_attempt_at = now + email_retry_delay(email.attempts)
+                email.last_error = str(e)
+    finally:
+        connection.close()
+
+    EmailOutbox.objects.bulk_update(
+        emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at', 'updated_at']
+    )
+    if len(emails) == batch_size and claimable_emails(timezone.now()).exists():
+        send_queued_emails.delay(batch_size)
+    return sent
+
 @shared_task
 def send_payment_confirmation_email(user_id, order_code):
     """Gửi email xác nhận thanh toán."""
     try:
         user = User.objects.get(id=user_id)
-        send_mail(
+        queue_email(
             subject=f"Thanh toán thành công cho đơn hàng {order_code}",
-            message=f"Kính gửi {user.username},\n\nThanh toán cho đơn hàng {order_code} qua Stripe đã được xác nhận.\n\nTrân trọng!",
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[user.email],
-            fail_silently=False,
+            body=f"Kính gửi {user.username},\n\nThanh toán cho đơn hàng {order_code} qua Stripe đã được xác nhận.\n\nTrân trọng!",
+            to_email=user.email,
         )
     except Exception as e:
         print(f"Error sending payment confirmation email: {str(e)}")
 
 @shared_task
 def process_order_refunded(order_id):
-    """Xử lý hoàn tiền khi đơn hàng bị hủy."""
-    try:
-        order = Order.objects.get(id=order_id)
-        payment = Payment.objects.get(order=order)
-        if payment.status == 'completed':
-            result = process_stripe_refund(payment)
-            if result['success']:
-                payment.status = 'refunded'
-                payment.refunded_at = timezone.now()
-                payment.save()
-                send_fcm_v1(
-                    user=order.user,
-                    title="Hoàn tiền thành công",
-                    body=f"Đơn hàng {order.order_code} đã được hoàn tiền {payment.amount} VND qua Stripe.",
-                    data={"order_id": str(order.id)}
-                )
-                send_mail(
-                    subject=f"Hoàn tiền cho đơn hàng {order.order_code}",
-                    message=f"Kính gửi {order.user.username},\n\nHoàn tiền cho đơn hàng {order.order_code} đã được xử lý qua Stripe.\n\nTrân trọng!",
-                    from_email=settings.EMAIL_HOST_USER,
-                    recipient_list=[order.user.email],
-                    fail_silently=False,
-                )
-            else:
-                print(f"Refund failed for order {order.id}: {result['message']}")
-    except Payment.DoesNotExist:
-        pass
-    except Exception as e:
-        print(f"Error processing refund for order {order.id}: {str(e)}")
+    """Giữ tương thích cho các task cũ còn trong hàng đợi: chuyển đơn hàng sang hàng đợi RefundRequest."""
+    enqueue_refunds([order_id])
 
 @shared_task
 def update_inventory_stock(product_id, quantity_change, is_increase=True):
     """Cập nhật số lượng tồn kho của sản phẩm."""
     try:
         product = Product.objects.get(id=product_id)
-        if is_increase:
-            product.stock += quantity_change
-        else:
-            product.stock -= quantity_change
-        product.save()
+        # Tồn kho nằm ở Inventory (Product không có cột stock): cập nhật nguyên tử bằng F()
+        delta = quantity_change if is_increase else -quantity_change
+        Inventory.objects.filter(product=product, distributor_id=product.distributor_id).update(
+            quantity=F('quantity') + delta
+        )
     except Exception as e:
         print(f"Error updating inventory for product {product_id}: {str(e)}")
 
@@ -83,12 +201,10 @@ def notify_product_approval(product_id):
                 body=f"Sản phẩm {product.name} đã được duyệt và sẵn sàng bán.",
                 data={"product_id": str(product.id)}
             )
-            send_mail(
+            queue_email(
                 subject=f"Sản phẩm {product.name} được duyệt",
-                message=f"Kính gửi {product.distributor.username},\n\nSản phẩm {product.name} đã được duyệt.\n\nTrân trọng!",
-                from_email=settings.EMAIL_HOST_USER,
-                recipient_list=[product.distributor.email],
-                fail_silently=False,
+                body=f"Kính gửi {product.distributor.username},\n\nSản phẩm {product.name} đã được duyệt.\n\nTrân trọng!",
+                to_email=product.distributor.email,
             )
     except Exception as e:
         print(f"Error notifying product approval for product {product_id}: {str(e)}")
@@ -130,37 +246,64 @@ def create_order_notification(order_id):
             body=f"Đơn hàng {order.order_code} đã được tạo.",
             data={"order_id": str(order.id)}
         )
-        send_mail(
+        queue_email(
             subject=f"Đơn hàng {order.order_code} được tạo",
-            message=f"Kính gửi {order.user.username},\n\nĐơn hàng {order.order_code} đã được tạo.\n\nTrân trọng!",
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[order.user.email],
-            fail_silently=False,
+            body=f"Kính gửi {order.user.username},\n\nĐơn hàng {order.order_code} đã được tạo.\n\nTrân trọng!",
+            to_email=order.user.email,
         )
     except Exception as e:
         print(f"Error creating order notification for order {order_id}: {str(e)}")
 
+def coalesce_review_notification(review):
+    """
+    Ghi nhận đánh giá mới vào bộ gom của nhà phân phối; đánh giá đầu tiên trong cửa sổ lên lịch
+    flush_review_digest sau NOTIFICATION_COALESCE_WINDOW giây thay vì tạo thông báo và push ngay.
+    """
+    user_id = review.product.distributor_id
+    if notification_coalescer.add('review', user_id, review.product_id, review.rating):
+        flush_review_digest.apply_async(args=[user_id, review.product_id], countdown=settings.NOTIFICATION_COALESCE_WINDOW)
+
 @shared_task
 def notify_review_creation(review_id):
-    """Thông báo cho nhà phân phối khi có đánh giá mới."""
+    """Thông báo cho nhà phân phối khi có đánh giá mới (gom thành bản tổng hợp theo sản phẩm)."""
     try:
-        review = Review.objects.get(id=review_id)
-        Notification.objects.create(
-            user=review.product.distributor,
-            title="Đánh giá mới",
-            message=f"Sản phẩm {review.product.name} nhận được đánh giá {review.rating} sao.",
-            notification_type="product",
-            related_product=review.product
-        )
-        send_fcm_v1(
-            user=review.product.distributor,
-            title="Đánh giá mới",
-            body=f"Sản phẩm {review.product.name} nhận được đánh giá {review.rating} sao.",
-            data={"product_id": str(review.product.id)}
-        )
+        review = Review.objects.select_related('product').get(id=review_id)
+        coalesce_review_notification(review)
     except Exception as e:
         print(f"Error notifying review creation for review {review_id}: {str(e)}")
 
+@shared_task
+def flush_review_digest(user_id, product_id):
+    """Tạo một thông báo và một push cho mọi đánh giá mới của sản phẩm đã gom trong cửa sổ."""
+    count, rating_total = notification_coalescer.drain('review', user_id, product_id)
+    try:
+        if count:
+            product = Product.objects.get(id=product_id)
+            if count == 1:
+                message = f"Sản phẩm {product.name} nhận được đánh giá {rating_total} sao."
+            else:
+                message = f"Sản phẩm {product.name} nhận được {count} đánh giá mới (trung bình {rating_total / count:.1f} sao)."
+            Notification.objects.create(
+                user_id=user_id,
+                title="Đánh giá mới",
+                message=message,
+                notification_type="product",
+                related_product=product
+            )
+            send_fcm_batch([{
+                'user_id': user_id,
+                'title': "Đánh giá mới",
+                'body': message,
+                'data': {'product_id': product_id, 'type': 'review_digest', 'count': count},
+            }])
+    except Product.DoesNotExist:
+        pass
+    finally:
+        # Đánh giá đến trong lúc flush được gom vào cửa sổ tiếp theo
+        if notification_coalescer.close_window('review', user_id, product_id):
+            flush_review_digest.apply_async(args=[user_id, product_id], countdown=settings.NOTIFICATION_COALESCE_WINDOW)
+    return count
+
 @shared_task
 def notify_review_reply(review_reply_id):
     """Thông báo cho khách hàng khi có phản hồi đánh giá."""
@@ -183,6 +326,624 @@ def notify_review_reply(review_reply_id):
     except Exception as e:
         print(f"Error notifying review reply for reply {review_reply_id}: {str(e)}")
 
+def order_status_result(order, message=None):
+    return {'order_id': order.id, 'user_id': order.user_id, 'order_code': order.order_code, 'status': order.status, 'message': message}
+
+@shared_task
+def place_order_async(order_id, cart_id, discount_code=None):
+    """Thực hiện phần transaction của việc đặt hàng cho đơn đang ở trạng thái 'placing'."""
+    order = Order.objects.get(id=order_id)
+    if order.status != 'placing':
+        return order_status_result(order)
+
+    message = None
+    try:
+        with transaction.atomic():
+            # Khóa đơn để fail_stuck_placing_orders không đánh dấu failed giữa chừng
+            order = Order.objects.select_for_update().get(id=order_id)
+            if order.status != 'placing':
+                return order_status_result(order)
+            cart = Cart.objects.get(id=cart_id, user_id=order.user_id)
+            discount = get_discount_by_code(discount_code) if discount_code else None
+            order.place_from_cart(cart, discount)
+            order.status = 'pending'
+            order.save(update_fields=['status', 'updated_at'])
+    except Cart.DoesNotExist:
+        message = "Giỏ hàng không tồn tại hoặc không thuộc về người dùng này."
+    except Discount.DoesNotExist:
+        message = "Mã giảm giá không hợp lệ."
+    except Inventory.DoesNotExist:
+        message = "Sản phẩm chưa có tồn kho."
+    except ValueError as e:
+        message = str(e)
+    except Exception as e:
+        # Lỗi DB, SoftTimeLimitExceeded...: không để đơn kẹt ở 'placing' và client chờ mãi
+        logger.exception(f"Unexpected error placing order {order.order_code}: {str(e)}")
+        message = "Không thể đặt hàng, vui lòng thử lại."
+
+    if message:
+        Order.objects.filter(id=order.id, status='placing').update(status='failed', updated_at=timezone.now())
+        order.status = Order.objects.filter(id=order.id).values_list('status', flat=True).first()
+        logger.info(f"Async placement failed for order {order.order_code}: {message}")
+
+    return order_status_result(order, message)
+
+@shared_task
+def fail_stuck_placing_orders():
+    """
+    Đánh dấu failed các đơn kẹt ở 'placing' quá ORDER_PLACING_TIMEOUT_MINUTES (worker chết, hết
+    hard time limit, mất task) và đẩy trạng thái tới client (chạy định kỳ).
+    """
+    cutoff = timezone.now() - timedelta(minutes=settings.ORDER_PLACING_TIMEOUT_MINUTES)
+    stuck = list(Order.objects.filter(status='placing', created_at__lt=cutoff).only('id', 'user_id', 'order_code'))
+    failed = 0
+    for order in stuck:
+        # Điều kiện status='placing' chờ khóa của place_order_async nếu đơn vẫn đang được đặt
+        if Order.objects.filter(id=order.id, status='placing').update(status='failed', updated_at=timezone.now()):
+            order.status = 'failed'
+            send_to_group(order_status_group(order.user_id), 'order.status', order_status_result(order, "Đặt hàng quá thời gian, vui lòng thử lại."))
+            failed += 1
+    if failed:
+        logger.warning(f"Marked {failed} stuck placing orders as failed")
+    return failed
+
+@shared_task
+def publish_order_status(result):
+    """Đẩy kết quả đặt hàng tới client qua Channels (thông báo "Đơn hàng được tạo" do signal notify_order_created tạo)."""
+    send_to_group(order_status_group(result['user_id']), 'order.status', result)
+    return result
+
+ORDER_TRANSITION_CHUNK_SIZE = 500
+
+ORDER_STATUS_MESSAGES = {
+    'processing': "Đơn hàng {code} đang được xử lý.",
+    'completed': "Đơn hàng {code} đã hoàn thành.",
+    'cancelled': "Đơn hàng {code} đã bị hủy.",
+}
+
+def dispatch_order_transition(order_ids, target_status):
+    """Chia các đơn vừa chuyển trạng thái thành từng lô và xếp một task cho mỗi lô."""
+    for start in range(0, len(order_ids), ORDER_TRANSITION_CHUNK_SIZE):
+        process_order_transition_batch.delay(order_ids[start:start + ORDER_TRANSITION_CHUNK_SIZE], target_status)
+
+def restock_orders(order_ids):
+    """Hoàn kho cho các đơn bị hủy: một UPDATE cho mỗi cặp (sản phẩm, nhà phân phối)."""
+    restocks = OrderItem.objects.filter(order_id__in=order_ids).values(
+        'product_id', 'product__distributor_id'
+    ).annotate(total_quantity=Sum('quantity'))
+    for row in restocks:
+        Inventory.objects.filter(
+            product_id=row['product_id'], distributor_id=row['product__distributor_id']
+        ).update(quantity=F('quantity') + row['total_quantity'])
+
+@shared_task
+def process_order_transition_batch(order_ids, target_status):
+    """Xử lý tác dụng phụ (hoàn kho, hoàn tiền, thông báo) cho một lô đơn hàng đã chuyển trạng thái."""
+    orders = list(Order.objects.filter(id__in=order_ids).select_related('user'))
+
+    if target_status == 'cancelled':
+        restock_orders(order_ids)
+        enqueue_refunds(order_ids)
+
+    message_template = ORDER_STATUS_MESSAGES.get(target_status)
+    if not message_template:
+        return len(orders)
+    Notification.objects.bulk_create([
+        Notification(
+            user=order.user,
+            title="Cập nhật đơn hàng",
+            message=message_template.format(code=order.order_code),
+            notification_type="order",
+            related_order=order
+        )
+        for order in orders
+    ])
+    send_fcm_batch([
+        {
+            'user_id': order.user_id,
+            'title': "Cập nhật đơn hàng",
+            'body': message_template.format(code=order.order_code),
+            'data': {"order_id": str(order.id)},
+        }
+        for order in orders
+    ])
+    return len(orders)
+
+@shared_task
+def deactivate_invalid_discounts():
+    """Tắt hàng loạt các mã giảm giá đã hết hạn hoặc hết lượt dùng (chạy định kỳ)."""
+    queryset = Discount.objects.filter(is_active=True).expired_or_used_up()
+    codes = list(queryset.values_list('code', flat=True))
+    if not codes:
+        return 0
+    updated = Discount.objects.filter(code__in=codes, is_active=True).update(is_active=False, updated_at=timezone.now())
+    for code in codes:
+        discount_registry.invalidate(code)
+    logger.info(f"Deactivated {updated} expired or used-up discounts")
+    return updated
+
+STRIPE_EVENT_BATCH_SIZE = 200
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+STRIPE_EVENT_DEBOUNCE = 2
+STRIPE_PAID_EVENTS = {'checkout.session.completed', 'checkout.session.async_payment_succeeded'}
+STRIPE_FAILED_EVENTS = {'checkout.session.async_payment_failed', 'checkout.session.expired'}
+
+def schedule_stripe_event_processing():
+    """Gom các webhook đến gần nhau vào một lần chạy process_stripe_events."""
+    if cache.add('stripe_events:scheduled', 1, timeout=STRIPE_EVENT_DEBOUNCE * 5):
+        process_stripe_events.apply_async(countdown=STRIPE_EVENT_DEBOUNCE)
+
+def apply_payment_outcomes(payments, outcomes, now, batch_size=500):
+    """
+    Đổi trạng thái Payment theo kết quả từ Stripe ({transaction_id: 'completed' | 'failed'}), lưu bằng
+    bulk_update theo lô, hoàn tất các đơn hàng đã thanh toán; trả về danh sách Payment đã thay đổi.
+    `payments` phải được đọc bằng select_for_update trong transaction hiện tại: webhook, đối soát,
+    confirm-payment và trang success chạy song song, chỉ lời gọi thực sự đổi trạng thái mới gửi email.
+    """
+    changed = []
+    for session_id, outcome in outcomes.items():
+        payment = payments.get(session_id)
+        if payment is None:
+            continue
+        if outcome == 'completed' and payment.status in ['pending', 'failed']:
+            payment.status = 'completed'
+            payment.paid_at = now
+            changed.append(payment)
+        elif outcome == 'failed' and payment.status == 'pending':
+            payment.status = 'failed'
+            changed.append(payment)
+    Payment.objects.bulk_update(changed, ['status', 'paid_at'], batch_size=batch_size)
+
+    completed = [payment for payment in changed if payment.status == 'completed']
+    order_ids = [payment.order_id for payment in completed]
+    for start in range(0, len(order_ids), batch_size):
+        Order.objects.filter(id__in=order_ids[start:start + batch_size]).exclude(status='cancelled').update(
+            status='completed', updated_at=now
+        )
+    for payment in changed:
+        transaction.on_commit(lambda payment=payment: publish_payment_status(payment))
+    for payment in completed:
+        transaction.on_commit(
+            lambda payment=payment: send_payment_confirmation_email.delay(payment.user_id, payment.order.order_code)
+        )
+    return changed
+
+def apply_session_outcome(session_id, outcome):
+    """Áp dụng kết quả của một Checkout Session (confirm-payment, trang success) dưới khóa hàng; trả về Payment mới nhất."""
+    with transaction.atomic():
+        payments = {
+            payment.transaction_id: payment
+            for payment in Payment.objects.select_for_update().filter(transaction_id=session_id).select_related('order')
+        }
+        if session_id not in payments:
+            raise Payment.DoesNotExist(f"Payment with transaction_id {session_id} not found.")
+        apply_payment_outcomes(payments, {session_id: outcome}, timezone.now())
+    return payments[session_id]
+
+def apply_stripe_events(events):
+    """
+    Áp dụng một lô StripeEvent lên Payment/Order bằng bulk_update; trả về các Payment đã đổi trạng thái.
+    Phải chạy trong transaction (process_stripe_events) để khóa các Payment liên quan.
+    """
+    outcomes = {}
+    for event in events:
+        session = event.payload.get('data', {}).get('object', {})
+        session_id = session.get('id')
+        if event.event_type in STRIPE_PAID_EVENTS and session.get('payment_status') in ['paid', 'no_payment_required']:
+            outcomes[session_id] = 'completed'
+        elif event.event_type in STRIPE_FAILED_EVENTS and outcomes.get(session_id) != 'completed':
+            outcomes[session_id] = 'failed'
+
+    now = timezone.now()
+    payments = {
+        payment.transaction_id: payment
+        for payment in Payment.objects.select_for_update().filter(transaction_id__in=outcomes.keys()).select_related('order')
+    }
+    changed = apply_payment_outcomes(payments, outcomes, now)
+
+    for event in events:
+        session_id = event.payload.get('data', {}).get('object', {}).get('id')
+        event.attempts += 1
+        if session_id not in outcomes:
+            event.status = 'ignored'
+        elif session_id in payments:
+            event.status = 'processed'
+        elif event.attempts >= STRIPE_EVENT_MAX_ATTEMPTS:
+            # Không tìm thấy Payment tương ứng sau nhiều lần thử
+            event.status = 'failed'
+            event.error = f"Payment with transaction_id {session_id} not found."
+        else:
+            # Webhook có thể đến trước khi Payment được tạo: giữ lại cho lần chạy sau
+            continue
+        event.processed_at = now
+    StripeEvent.objects.bulk_update(events, ['status', 'attempts', 'error', 'processed_at'])
+    return changed
+
+@shared_task
+def process_stripe_events():
+    """Xử lý inbox StripeEvent theo lô; nhiều worker có thể chạy song song nhờ SKIP LOCKED."""
+    cache.delete('stripe_events:scheduled')
+    with transaction.atomic():
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='pending').order_by('received_at')[:STRIPE_EVENT_BATCH_SIZE]
+        )
+        if not events:
+            return 0
+        apply_stripe_events(events)
+    if StripeEvent.objects.filter(status='pending', attempts=0).exists():
+        process_stripe_events.delay()
+    return len(events)
+
+STRIPE_RECONCILE_CHUNK_SIZE = 500
+
+def stripe_session_outcome(session):
+    """Suy ra trạng thái Payment từ một Checkout Session (đã expand payment_intent); None nếu còn dang dở."""
+    payment_intent = session.get('payment_intent')
+    intent_status = payment_intent.get('status') if isinstance(payment_intent, dict) else None
+    if session.get('payment_status') in ['paid', 'no_payment_required'] or intent_status == 'succeeded':
+        return 'completed'
+    if session.get('status') == 'expired':
+        return 'failed'
+    return None
+
+def stripe_payment_intent_outcome(intent):
+    """Suy ra trạng thái Payment từ một PaymentIntent tạo trực tiếp (không qua Checkout); None nếu còn dang dở."""
+    if intent.get('status') == 'succeeded':
+        return 'completed'
+    if intent.get('status') == 'canceled':
+        return 'failed'
+    return None
+
+def iter_stripe_outcomes(created_gte, report):
+    """
+    Duyệt Checkout Session rồi PaymentIntent tạo từ `created_gte`, trả về (id, outcome, số tiền) để ghép với
+    Payment.transaction_id. PaymentIntent do một session trong cửa sổ sinh ra đã được đối soát qua session đó nên bỏ qua.
+    """
+    session_intents = set()
+    for session in stripe_gateway.iter_checkout_sessions(created_gte, expand=['data.payment_intent']):
+        report['checked_sessions'] += 1
+        payment_intent = session.get('payment_intent')
+        if payment_intent:
+            session_intents.add(payment_intent['id'] if isinstance(payment_intent, dict) else payment_intent)
+        yield session['id'], stripe_session_outcome(session), session.get('amount_total')
+    for intent in stripe_gateway.iter_payment_intents(created_gte):
+        if intent['id'] in session_intents:
+            continue
+        report['checked_payment_intents'] += 1
+        yield intent['id'], stripe_payment_intent_outcome(intent), intent.get('amount')
+
+@shared_task
+def reconcile_stripe_payments(lookback_hours=None):
+    """
+    Đối soát Payment pending/failed với Stripe: duyệt Checkout Session và PaymentIntent bằng list API theo
+    thời gian tạo, ghép với Payment.transaction_id bằng dict trong bộ nhớ (hash join), cập nhật bằng bulk_update theo lô
+    và ghi báo cáo các điểm lệch vào cache.
+    """
+    lookback_hours = lookback_hours or settings.STRIPE_RECONCILE_LOOKBACK_HOURS
+    since = timezone.now() - timedelta(hours=lookback_hours)
+    payments = {
+        payment.transaction_id: payment
+        for payment in Payment.objects.filter(
+            payment_method='stripe', status__in=['pending', 'failed'], created_at__gte=since
+        ).only('id', 'transaction_id', 'status', 'amount', 'created_at')
+    }
+    report = {
+        'checked_sessions': 0,
+        'checked_payment_intents': 0,
+        'updated': 0,
+        'amount_mismatches': [],
+        'paid_but_failed': [],
+        'missing_in_stripe': [],
+        'paid_without_payment': [],
+    }
+    if not payments:
+        cache.set('stripe_reconciliation:last_report', report, timeout=None)
+        return report
+
+    # Session được tạo ngay trước Payment nên lùi mốc thời gian thêm vài phút
+    created_gte = int(min(payment.created_at for payment in payments.values()).timestamp()) - 300
+    outcomes = {}
+    seen = set()
+    unmatched_paid = []
+    for object_id, outcome, stripe_amount in iter_stripe_outcomes(created_gte, report):
+        payment = payments.get(object_id)
+        if payment is None:
+            if outcome == 'completed':
+                unmatched_paid.append(object_id)
+            continue
+        seen.add(object_id)
+        if stripe_amount is not None and stripe_amount != int(payment.amount):
+            report['amount_mismatches'].append(
+                {'payment_id': payment.id, 'stripe_amount': stripe_amount, 'local_amount': str(payment.amount)}
+            )
+        if outcome == 'completed' and payment.status == 'failed':
+            report['paid_but_failed'].append(payment.id)
+        if outcome:
+            outcomes[object_id] = outcome
+
+    report['missing_in_stripe'] = [payment.id for txn, payment in payments.items() if txn not in seen]
+    # Session/PaymentIntent đã thanh toán nhưng không có Payment nào (kể cả đã completed) trong hệ thống
+    for start in range(0, len(unmatched_paid), STRIPE_RECONCILE_CHUNK_SIZE):
+        chunk = unmatched_paid[start:start + STRIPE_RECONCILE_CHUNK_SIZE]
+        known = set(Payment.objects.filter(transaction_id__in=chunk).values_list('transaction_id', flat=True))
+        report['paid_without_payment'].extend(txn for txn in chunk if txn not in known)
+
+    transaction_ids = list(outcomes)
+    now = timezone.now()
+    for start in range(0, len(transaction_ids), STRIPE_RECONCILE_CHUNK_SIZE):
+        chunk = transaction_ids[start:start + STRIPE_RECONCILE_CHUNK_SIZE]
+        with transaction.atomic():
+            # Khóa và đọc lại để không ghi đè cập nhật từ webhook trong lúc đang đối soát
+            locked = {
+                payment.transaction_id: payment
+                for payment in Payment.objects.select_for_update().filter(transaction_id__in=chunk).select_related('order')
+            }
+            report['updated'] += len(apply_payment_outcomes(
+                locked, {txn: outcomes[txn] for txn in chunk}, now, STRIPE_RECONCILE_CHUNK_SIZE
+            ))
+
+    if report['amount_mismatches'] or report['paid_but_failed'] or report['paid_without_payment']:
+        logger.warning(f"Stripe reconciliation mismatches: {report}")
+    logger.info(
+        f"Stripe reconciliation checked {report['checked_sessions']} sessions and {report['checked_payment_intents']} "
+        f"payment intents, updated {report['updated']} payments"
+    )
+    cache.set('stripe_reconciliation:last_report', report, timeout=None)
+    return report
+
+REFUND_BATCH_SIZE = 100
+REFUND_MAX_ATTEMPTS = 5
+REFUND_STALE_AFTER = timedelta(minutes=10)
+
+def enqueue_refunds(order_ids):
+    """Đưa các đơn đã hủy vào hàng đợi hoàn tiền; task xử lý được lên lịch sau khi transaction commit."""
+    created = RefundRequest.enqueue_for_orders(order_ids)
+    if created:
+        transaction.on_commit(schedule_refund_processing)
+    return created
+
+def schedule_refund_processing():
+    """Gom nhiều lần hủy đơn liên tiếp vào một lần chạy process_refund_requests."""
+    if cache.add('refund_requests:scheduled', 1, timeout=10):
+        process_refund_requests.apply_async(countdown=1)
+
+def claim_refund_requests(batch_size):
+    """Giành một lô yêu cầu pending (hoặc processing bị treo do worker chết) bằng SKIP LOCKED."""
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = list(
+            RefundRequest.objects.select_for_update(skip_locked=True)
+            .filter(Q(status='pending') | Q(status='processing', updated_at__lt=now - REFUND_STALE_AFTER))
+            .order_by('created_at').values_list('id', flat=True)[:batch_size]
+        )
+        RefundRequest.objects.filter(id__in=claimed).update(status='processing', updated_at=now)
+    return list(RefundRequest.objects.filter(id__in=claimed).select_related('payment', 'order__user'))
+
+def refund_payment_safely(payment):
+    # Chạy trong thread pool: chỉ gọi Stripe, không truy cập DB
+    try:
+        return process_stripe_refund(payment)
+    except Exception as e:
+        return {'success': False, 'message': str(e)}
+
+def notify_refunds(refund_requests):
+    """Gửi thông báo in-app, push và xếp email cho một lô hoàn tiền thành công."""
+    if not refund_requests:
+        return
+    messages = {
+        refund_request.id: f"Đơn hàng {refund_request.order.order_code} đã được hoàn tiền {refund_request.amount} VND qua Stripe."
+        for refund_request in refund_requests
+    }
+    Notification.objects.bulk_create([
+        Notification(
+            user=refund_request.order.user,
+            title="Hoàn tiền thành công",
+            message=messages[refund_request.id],
+            notification_type="order",
+            related_order=refund_request.order
+        )
+        for refund_request in refund_requests
+    ])
+    send_fcm_batch([
+        {
+            'user_id': refund_request.order.user_id,
+            'title': "Hoàn tiền thành công",
+            'body': messages[refund_request.id],
+            'data': {"order_id": str(refund_request.order_id)},
+        }
+        for refund_request in refund_requests
+    ])
+    queue_emails([
+        {
+            'subject': f"Hoàn tiền cho đơn hàng {refund_request.order.order_code}",
+            'body': f"Kính gửi {refund_request.order.user.username},\n\nHoàn tiền cho đơn hàng {refund_request.order.order_code} đã được xử lý qua Stripe.\n\nTrân trọng!",
+            'to_email': refund_request.order.user.email,
+        }
+        for refund_request in refund_requests if refund_request.order.user.email
+    ])
+
+@shared_task
+def process_refund_requests(batch_size=REFUND_BATCH_SIZE):
+    """
+    Xử lý một lô RefundRequest: gọi Stripe song song trong thread pool giới hạn (khóa idempotency
+    theo payment nên retry không hoàn tiền hai lần), lưu kết quả bằng bulk_update rồi gửi thông báo theo lô.
+    """
+    cache.delete('refund_requests:scheduled')
+    refund_requests = claim_refund_requests(batch_size)
+    if not refund_requests:
+        return 0
+
+    refundable = [refund_request for refund_request in refund_requests if refund_request.payment.status == 'completed']
+    with ThreadPoolExecutor(max_workers=settings.REFUND_WORKERS) as pool:
+        results = dict(zip(
+            [refund_request.id for refund_request in refundable],
+            pool.map(refund_payment_safely, [refund_request.payment for refund_request in refundable])
+        ))
+
+    now = timezone.now()
+    payments = []
+    succeeded = []
+    for refund_request in refund_requests:
+        refund_request.attempts += 1
+        refund_request.updated_at = now
+        result = results.get(refund_request.id)
+        if result is None:
+            # Payment đã được hoàn ở nơi khác (admin hoàn thủ công) hoặc không còn hoàn được
+            if refund_request.payment.status == 'refunded':
+                refund_request.status = 'succeeded'
+            else:
+                refund_request.status = 'failed'
+                refund_request.error = f"Payment status is {refund_request.payment.status}."
+        elif result['success']:
+            refund_request.status = 'succeeded'
+            refund_request.stripe_refund_id = result['refund_id']
+            refund_request.error = None
+            refund_request.payment.status = 'refunded'
+            refund_request.payment.refunded_at = now
+            payments.append(refund_request.payment)
+            succeeded.append(refund_request)
+        else:
+            logger.error(f"Refund failed for order {refund_request.order_id}: {result['message']}")
+            refund_request.error = result['message']
+            refund_request.status = 'failed' if refund_request.attempts >= REFUND_MAX_ATTEMPTS else 'pending'
+        if refund_request.status != 'pending':
+            refund_request.processed_at = now
+
+    with transaction.atomic():
+        Payment.objects.bulk_update(payments, ['status', 'refunded_at'])
+        RefundRequest.objects.bulk_update(
+            refund_requests, ['status', 'attempts', 'stripe_refund_id', 'error', 'processed_at', 'updated_at']
+        )
+    for payment in payments:
+        publish_payment_status(payment)
+    notify_refunds(succeeded)
+
+    # Yêu cầu lỗi tạm thời sẽ được beat quét lại; chỉ chạy tiếp ngay nếu còn yêu cầu mới
+    if RefundRequest.objects.filter(status='pending', attempts=0).exists():
+        process_refund_requests.delay(batch_size)
+    return len(refund_requests)
+
+PROMOTION_CHUNK_SIZE = 5000
+PROMOTION_STALE_AFTER = timedelta(minutes=5)
+
+def iterate_id_chunks(queryset, last_id, size):
+    """
+    Duyệt id của queryset theo lô tăng dần bằng keyset (id > last_id LIMIT size), giống aiterate_in_batches:
+    iterator() không giữ bộ nhớ cố định trên MySQL vì driver đọc toàn bộ kết quả về client.
+    """
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+def claim_promotion_campaign(campaign_id):
+    """Giành quyền chạy chiến dịch (queued hoặc running nhưng mất heartbeat) bằng một UPDATE có điều kiện."""
+    now = timezone.now()
+    return PromotionCampaign.objects.filter(id=campaign_id).filter(
+        Q(status='queued') | Q(status='running', heartbeat_at__lt=now - PROMOTION_STALE_AFTER)
+    ).update(status='running', heartbeat_at=now) == 1
+
+@shared_task
+def fan_out_promotion(campaign_id):
+    """
+    Gửi thông báo khuyến mãi cho toàn bộ phân khúc: duyệt user id tăng dần theo keyset, mỗi lô
+    bulk_create Notification và lưu checkpoint trong cùng transaction, rồi gửi FCM multicast 500 token/lần
+    qua thread pool giới hạn. Nếu worker chết, resume_promotion_campaigns chạy tiếp từ last_user_id.
+    """
+    if not claim_promotion_campaign(campaign_id):
+        return 0
+    campaign = PromotionCampaign.objects.get(id=campaign_id)
+    data = {"campaign_id": str(campaign.id), "type": "promotion"}
+    processed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=settings.PROMOTION_PUSH_WORKERS) as pool:
+            for chunk in iterate_id_chunks(campaign.segment_queryset(), campaign.last_user_id, PROMOTION_CHUNK_SIZE):
+                with transaction.atomic():
+                    Notification.objects.bulk_create([
+                        Notification(user_id=user_id, title=campaign.title, message=campaign.message, notification_type='promotion')
+                        for user_id in chunk
+                    ], batch_size=1000)
+                    PromotionCampaign.objects.filter(id=campaign.id).update(
+                        last_user_id=chunk[-1], notified_count=F('notified_count') + len(chunk), heartbeat_at=timezone.now()
+                    )
+                processed += len(chunk)
+
+                # Push gửi sau checkpoint: sự cố giữa chừng có thể bỏ sót push của một lô nhưng không gửi trùng
+                tokens = list(DeviceToken.objects.filter(user_id__in=chunk).values_list('token', flat=True))
+                batches = [tokens[start:start + FCM_BATCH_LIMIT] for start in range(0, len(tokens), FCM_BATCH_LIMIT)]
+                sent = 0
+                invalid_tokens = []
+                for batch_sent, batch_invalid in pool.map(
+                    lambda batch: send_fcm_multicast(batch, campaign.title, campaign.message, data, prune=False), batches
+                ):
+                    sent += batch_sent
+                    invalid_tokens.extend(batch_invalid)
+                prune_device_tokens(invalid_tokens)
+                PromotionCampaign.objects.filter(id=campaign.id).update(pushed_count=F('pushed_count') + sent)
+    except Exception as e:
+        logger.error(f"Promotion campaign {campaign.id} failed: {str(e)}")
+        PromotionCampaign.objects.filter(id=campaign.id).update(status='failed', error=str(e), finished_at=timezone.now())
+        raise
+
+    PromotionCampaign.objects.filter(id=campaign.id).update(status='completed', finished_at=timezone.now())
+    logger.info(f"Promotion campaign {campaign.id} notified {processed} users")
+    return processed
+
+@shared_task
+def resume_promotion_campaigns():
+    """Xếp lại các chiến dịch bị bỏ dở (worker chết, task bị mất) để chạy tiếp từ checkpoint."""
+    stale = timezone.now() - PROMOTION_STALE_AFTER
+    campaign_ids = list(PromotionCampaign.objects.filter(
+        Q(status='queued', created_at__lt=stale) | Q(status='running', heartbeat_at__lt=stale)
+    ).values_list('id', flat=True))
+    for campaign_id in campaign_ids:
+        fan_out_promotion.delay(campaign_id)
+    return len(campaign_ids)
+
+@shared_task
+def reconcile_unread_counts():
+    """Đối chiếu bộ đếm thông báo chưa đọc trên Redis với SQL (chạy định kỳ)."""
+    fixed = unread_counter.reconcile()
+    if fixed:
+        logger.info(f"Reconciled {fixed} unread notification counters")
+    return fixed
+
+@shared_task
+def send_welcome_push(token):
+    """Push chào mừng tới thiết bị vừa đăng ký token (chạy nền để không chặn request đăng nhập)."""
+    send_fcm_multicast(
+        [token],
+        title="Chào mừng bạn!",
+        body="Đăng nhập thành công. Bạn sẽ nhận thông báo từ hệ thống.",
+        data={"type": "welcome"}
+    )
+
+DEVICE_TOKEN_PRUNE_CHUNK = 5000
+
+@shared_task
+def prune_invalid_device_tokens():
+    """Kiểm tra mọi token FCM bằng dry-run multicast theo lô và xóa hàng loạt các token đã chết (chạy định kỳ)."""
+    last_id = 0
+    checked = 0
+    pruned = 0
+    while True:
+        rows = list(
+            DeviceToken.objects.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'token')[:DEVICE_TOKEN_PRUNE_CHUNK]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        invalid_tokens = find_invalid_device_tokens([token for _, token in rows])
+        prune_device_tokens(invalid_tokens)
+        checked += len(rows)
+        pruned += len(invalid_tokens)
+    logger.info(f"Checked {checked} device tokens, pruned {pruned}")
+    return pruned
+
 @shared_task
 def scrape_and_store_websites(urls):
     """
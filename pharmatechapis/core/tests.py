@@ -1,3 +1,1546 @@
-from django.test import TestCase
+import json
+import hmac
+import time
+import smtplib
+import hashlib
+import asyncio
+import threading
+import multiprocessing
+from decimal import Decimal
+from datetime import timedelta
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-# Create your tests here.
+import stripe
+import firebase_admin
+from firebase_admin import messaging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.contrib.admin.sites import AdminSite
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+from oauth2_provider.models import AccessToken, Application
+
+from .models import DeviceToken, User, PromotionCampaign, Category, Discount, Cart, CartItem, Product, Inventory, Order, OrderItem, Payment, RefundRequest, StripeEvent, Review, Notification, EmailOutbox
+from . import signals
+from .admin import OrderItemAdmin
+from .device_tokens import device_token_registry
+from .discounts import DiscountRegistry, get_discount_by_code, rank_discounts
+from .notifications import assign_missing_ids, notification_publisher, unread_counter, mark_user_online, mark_user_offline, refresh_user_online, online_user_ids
+from .stripe_gateway import CircuitBreaker, StripeGateway, StripeUnavailableError, ThreadLocalSession
+from .tasks import prune_invalid_device_tokens, process_refund_requests, enqueue_refunds, REFUND_MAX_ATTEMPTS, REFUND_STALE_AFTER, deactivate_invalid_discounts, apply_session_outcome, fan_out_promotion, reconcile_unread_counts, publish_order_status, process_stripe_events, reconcile_stripe_payments, queue_emails, send_queued_emails, flush_review_digest, place_order_async, fail_stuck_placing_orders
+from .utils import send_fcm_multicast, send_fcm_batch, send_fcm_v1, asend_fcm_v1, FCM_BATCH_LIMIT, process_stripe_refund, idempotent_request, payment_status_group, aiterate_in_batches, stream_export_response, generate_order_code, OrderCodeGenerator, ORDER_CODE_WORKER_LEASE
+
+
+def stripe_signature(payload, secret, timestamp=None):
+    """Header Stripe-Signature giống Stripe: t=..., v1=HMAC-SHA256 của "t.payload"."""
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode('utf-8'), f"{timestamp}.{payload}".encode('utf-8'), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'core-tests'}}
+
+
+class CoreTestMixin:
+    """Factory dùng chung cho các test của core; cache LocMem được xóa trước mỗi test."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @staticmethod
+    def create_user(username, role='customer'):
+        return User.objects.create_user(
+            username=username, email=f"{username}@pharmatech.test", password='secret123', full_name=username, role=role
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CoreTestCase(CoreTestMixin, TestCase):
+    pass
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CoreTransactionTestCase(CoreTestMixin, TransactionTestCase):
+    pass
+
+
+class StripeWebhookTests(CoreTestCase):
+    url = '/stripe/webhook/'
+    event = {
+        'id': 'evt_test_checkout_completed',
+        'object': 'event',
+        'type': 'checkout.session.completed',
+        'data': {'object': {'id': 'cs_test_webhook', 'object': 'checkout.session', 'payment_status': 'paid'}},
+    }
+
+    def post_event(self, secret):
+        payload = json.dumps(self.event)
+        return self.client.post(
+            self.url, data=payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=stripe_signature(payload, secret),
+        )
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='')
+    def test_rejects_events_when_secret_not_configured(self):
+        # Chữ ký HMAC với khóa rỗng ai cũng tạo được
+        response = self.post_event('')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_rejects_forged_signature(self):
+        response = self.post_event('whsec_other')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_duplicate_delivery_stored_once(self):
+        for _ in range(2):
+            self.assertEqual(self.post_event('whsec_test').status_code, 200)
+        self.assertEqual(StripeEvent.objects.filter(event_id=self.event['id']).count(), 1)
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+@mock.patch('core.tasks.publish_payment_status')
+@mock.patch('core.tasks.send_payment_confirmation_email.delay')
+@mock.patch('core.views.schedule_stripe_event_processing')
+class StripeWebhookReplayTests(CoreTestCase):
+    """Phát lại tools/stripe_webhook_fixtures.json (giống tools/replay_stripe_webhooks.py) qua endpoint thật."""
+
+    def setUp(self):
+        super().setUp()
+        with open(settings.BASE_DIR / 'tools' / 'stripe_webhook_fixtures.json', encoding='utf-8') as f:
+            self.events = json.load(f)
+        self.customer = self.create_user('replay_customer')
+        self.order = Order.objects.create(user=self.customer, order_code='REPLAY-1', items_subtotal=150000, grand_total=150000)
+        self.payment = Payment.objects.create(
+            order=self.order, user=self.customer, amount=150000, status='pending', transaction_id='cs_test_replay'
+        )
+
+    def replay(self, repeat=1):
+        for _ in range(repeat):
+            for event in self.events:
+                payload = json.dumps(event)
+                response = self.client.post(
+                    '/stripe/webhook/', data=payload, content_type='application/json',
+                    HTTP_STRIPE_SIGNATURE=stripe_signature(payload, 'whsec_test'),
+                )
+                self.assertEqual(response.status_code, 200)
+
+    def test_completed_then_expired_keeps_payment_completed(self, schedule, send_email, publish):
+        self.replay(repeat=2)
+        self.assertEqual(StripeEvent.objects.count(), len(self.events))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_stripe_events(), len(self.events))
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.order.status, 'completed')
+        send_email.assert_called_once_with(self.customer.id, 'REPLAY-1')
+        self.assertFalse(StripeEvent.objects.filter(status='pending').exists())
+
+    def test_tampered_payload_rejected(self, schedule, send_email, publish):
+        payload = json.dumps(self.events[0])
+        signature = stripe_signature(payload, 'whsec_test')
+        response = self.client.post(
+            '/stripe/webhook/', data=payload.replace('"paid"', '"unpaid"'), content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=signature,
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+
+@mock.patch('core.tasks.publish_payment_status')
+@mock.patch('core.tasks.send_payment_confirmation_email.delay')
+class StripeReconciliationTests(CoreTestCase):
+    """Thay cho việc đối soát thủ công với danh sách session của tools/fake_stripe_server.py."""
+
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('reconcile_customer')
+        self.payments = {}
+        for session_id, status in [('cs_paid', 'pending'), ('cs_expired', 'pending'), ('cs_late_paid', 'failed'), ('cs_missing', 'pending')]:
+            order = Order.objects.create(
+                user=self.customer, order_code=f"REC-{session_id}", items_subtotal=100000, grand_total=100000
+            )
+            self.payments[session_id] = Payment.objects.create(
+                order=order, user=self.customer, amount=100000, status=status, transaction_id=session_id
+            )
+
+    def test_applies_outcomes_and_reports_mismatches(self, send_email, publish):
+        sessions = [
+            {'id': 'cs_paid', 'payment_status': 'paid', 'status': 'complete', 'amount_total': 100000,
+             'payment_intent': 'pi_from_cs_paid'},
+            {'id': 'cs_expired', 'payment_status': 'unpaid', 'status': 'expired', 'amount_total': 100000},
+            {'id': 'cs_late_paid', 'payment_status': 'unpaid', 'status': 'complete', 'amount_total': 90000,
+             'payment_intent': {'status': 'succeeded'}},
+            {'id': 'cs_unknown', 'payment_status': 'paid', 'status': 'complete', 'amount_total': 50000},
+        ]
+        # PaymentIntent do Checkout sinh ra đã được đối soát qua session, không bị báo là thiếu Payment
+        intents = [{'id': 'pi_from_cs_paid', 'status': 'succeeded', 'amount': 100000}]
+        with mock.patch('core.tasks.stripe_gateway.iter_checkout_sessions', return_value=iter(sessions)), \
+                mock.patch('core.tasks.stripe_gateway.iter_payment_intents', return_value=iter(intents)):
+            with self.captureOnCommitCallbacks(execute=True):
+                report = reconcile_stripe_payments()
+
+        statuses = dict(Payment.objects.values_list('transaction_id', 'status'))
+        self.assertEqual(statuses, {
+            'cs_paid': 'completed', 'cs_expired': 'failed', 'cs_late_paid': 'completed', 'cs_missing': 'pending'
+        })
+        self.assertEqual(report['checked_sessions'], 4)
+        self.assertEqual(report['checked_payment_intents'], 0)
+        self.assertEqual(report['updated'], 3)
+        self.assertEqual(report['paid_but_failed'], [self.payments['cs_late_paid'].id])
+        self.assertEqual([item['payment_id'] for item in report['amount_mismatches']], [self.payments['cs_late_paid'].id])
+        self.assertEqual(report['missing_in_stripe'], [self.payments['cs_missing'].id])
+        self.assertEqual(report['paid_without_payment'], ['cs_unknown'])
+        self.assertEqual(send_email.call_count, 2)
+        self.assertEqual(cache.get('stripe_reconciliation:last_report'), report)
+
+    def test_reconciles_direct_payment_intents(self, send_email, publish):
+        for intent_id, status in [('pi_paid', 'pending'), ('pi_canceled', 'pending'), ('pi_processing', 'pending')]:
+            order = Order.objects.create(
+                user=self.customer, order_code=f"REC-{intent_id}", items_subtotal=100000, grand_total=100000
+            )
+            self.payments[intent_id] = Payment.objects.create(
+                order=order, user=self.customer, amount=100000, status=status, transaction_id=intent_id
+            )
+        intents = [
+            {'id': 'pi_paid', 'status': 'succeeded', 'amount': 100000},
+            {'id': 'pi_canceled', 'status': 'canceled', 'amount': 100000},
+            {'id': 'pi_processing', 'status': 'processing', 'amount': 80000},
+            {'id': 'pi_unknown', 'status': 'succeeded', 'amount': 10000},
+        ]
+        with mock.patch('core.tasks.stripe_gateway.iter_checkout_sessions', return_value=iter([])), \
+                mock.patch('core.tasks.stripe_gateway.iter_payment_intents', return_value=iter(intents)):
+            with self.captureOnCommitCallbacks(execute=True):
+                report = reconcile_stripe_payments()
+
+        statuses = dict(Payment.objects.filter(transaction_id__startswith='pi_').values_list('transaction_id', 'status'))
+        self.assertEqual(statuses, {'pi_paid': 'completed', 'pi_canceled': 'failed', 'pi_processing': 'pending'})
+        self.assertEqual(report['checked_payment_intents'], 4)
+        self.assertEqual(report['updated'], 2)
+        self.assertEqual([item['payment_id'] for item in report['amount_mismatches']], [self.payments['pi_processing'].id])
+        self.assertEqual(report['paid_without_payment'], ['pi_unknown'])
+        self.assertEqual(send_email.call_count, 1)
+
+
+@mock.patch('core.tasks.publish_payment_status')
+@mock.patch('core.tasks.send_payment_confirmation_email.delay')
+class PaymentOutcomeTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('payment_customer')
+        self.order = Order.objects.create(user=self.customer, order_code='PAY-1', items_subtotal=100000, grand_total=100000)
+        self.payment = Payment.objects.create(
+            order=self.order, user=self.customer, amount=100000, status='pending', transaction_id='cs_test_outcome'
+        )
+
+    def test_confirmation_email_sent_once(self, send_email, publish):
+        # Webhook và trang success cùng xác nhận: chỉ lần đổi trạng thái thật sự gửi email
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_session_outcome('cs_test_outcome', 'completed')
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_session_outcome('cs_test_outcome', 'completed')
+        send_email.assert_called_once_with(self.customer.id, 'PAY-1')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'completed')
+
+    def test_failed_outcome_does_not_overwrite_completed(self, send_email, publish):
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_session_outcome('cs_test_outcome', 'completed')
+            payment = apply_session_outcome('cs_test_outcome', 'failed')
+        self.assertEqual(payment.status, 'completed')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PaymentStatusLongPollTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('longpoll_customer')
+        order = Order.objects.create(user=self.customer, order_code='POLL-1', items_subtotal=100000, grand_total=100000)
+        self.payment = Payment.objects.create(
+            order=order, user=self.customer, amount=100000, status='pending', transaction_id='cs_test_longpoll'
+        )
+        self.url = f"/payments/{self.payment.id}/status/"
+        application = Application.objects.create(
+            name='longpoll', client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_PASSWORD,
+        )
+        AccessToken.objects.create(
+            user=self.customer, application=application, token='longpoll-token',
+            expires=timezone.now() + timedelta(hours=1), scope='read write',
+        )
+        self.headers = {'Authorization': 'Bearer longpoll-token'}
+
+    def test_rejects_missing_or_invalid_token(self):
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.assertEqual(self.client.get(self.url, headers={'Authorization': 'Bearer wrong'}).status_code, 401)
+
+    def test_returns_immediately_when_status_already_changed(self):
+        response = self.client.get(self.url, {'since': 'failed'}, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'pending')
+        self.assertTrue(response.json()['changed'])
+
+    def test_times_out_without_change(self):
+        response = self.client.get(self.url, {'timeout': 0.2}, headers=self.headers)
+        self.assertFalse(response.json()['changed'])
+        self.assertFalse(get_channel_layer().groups.get(payment_status_group(self.customer.id)))
+
+    async def test_wakes_on_group_message_for_this_payment(self):
+        layer = get_channel_layer()
+        group_name = payment_status_group(self.customer.id)
+        started = time.monotonic()
+        request = asyncio.ensure_future(self.async_client.get(self.url, {'timeout': 10}, headers=self.headers))
+        while not layer.groups.get(group_name):
+            self.assertLess(time.monotonic() - started, 5)
+            await asyncio.sleep(0.01)
+        # Sự kiện của thanh toán khác cùng user không được đánh thức request
+        await layer.group_send(group_name, {'type': 'payment.status', 'payload': {'payment_id': 0, 'status': 'completed'}})
+        await layer.group_send(group_name, {'type': 'payment.status', 'payload': {
+            'payment_id': self.payment.id, 'order_id': self.payment.order_id, 'status': 'completed',
+            'paid_at': None, 'refunded_at': None,
+        }})
+        response = await request
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(response.json()['payment_id'], self.payment.id)
+        self.assertEqual(response.json()['status'], 'completed')
+        self.assertTrue(response.json()['changed'])
+        self.assertFalse(layer.groups.get(group_name))
+
+
+class ExportTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.create_user('export_admin', role='admin'))
+
+    def test_invalid_distributor_returns_400(self):
+        response = self.client.get('/exports/inventory/', {'distributor': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_payments_export_skips_orders_shared_with_other_distributors(self):
+        customer = self.create_user('export_customer')
+        products = {}
+        for name in ['export_dist_a', 'export_dist_b']:
+            distributor = self.create_user(name, role='distributor')
+            products[name] = Product.objects.create(distributor=distributor, name=f"SP {name}", description='-', price=10000)
+            Inventory.objects.create(distributor=distributor, product=products[name], quantity=100)
+        own = Order.objects.create(user=customer, order_code='EXP-OWN')
+        OrderItem.objects.create(order=own, product=products['export_dist_a'], quantity=1, price=10000)
+        shared = Order.objects.create(user=customer, order_code='EXP-SHARED')
+        OrderItem.objects.create(order=shared, product=products['export_dist_a'], quantity=1, price=10000)
+        OrderItem.objects.create(order=shared, product=products['export_dist_b'], quantity=1, price=10000)
+        for order in (own, shared):
+            Payment.objects.create(order=order, user=customer, amount=order.items.count() * 10000, transaction_id=f"cs_{order.order_code}")
+
+        response = self.client.get('/exports/payments/', {
+            'distributor': products['export_dist_a'].distributor_id, 'export_format': 'ndjson'
+        })
+        self.assertEqual(response.status_code, 200)
+        rows = [json.loads(line) for line in b''.join(async_to_sync(self.collect)(response)).splitlines()]
+        self.assertEqual([row['order_code'] for row in rows], ['EXP-OWN'])
+
+    @staticmethod
+    async def collect(response):
+        return [chunk async for chunk in response.streaming_content]
+
+    async def test_streams_rows_in_batches_asynchronously(self):
+        await Category.objects.abulk_create([Category(name=f"Category {i}") for i in range(5)])
+        response = stream_export_response(
+            ['name'], aiterate_in_batches(Category.objects.all(), ['name'], batch_size=2), 'csv', 'categories'
+        )
+        # Nội dung async: Daphne stream từng lô thay vì gom toàn bộ vào bộ nhớ
+        self.assertTrue(response.is_async)
+        lines = [line async for line in response.streaming_content]
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1], b'Category 0\r\n')
+
+
+@mock.patch('core.tasks.schedule_refund_processing')
+class SignalTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.distributor = self.create_user('signal_distributor', role='distributor')
+        self.customer = self.create_user('signal_customer')
+        self.product = Product.objects.create(distributor=self.distributor, name='Vitamin C', description='-', price=50000)
+        self.inventory = Inventory.objects.create(distributor=self.distributor, product=self.product, quantity=10)
+        self.order = Order.objects.create(user=self.customer, order_code='SIG-1')
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=3, price=50000)
+
+    @mock.patch('core.signals.notify_product_approval.delay')
+    def test_product_approval_notifies_after_commit(self, notify, schedule_refunds):
+        product = Product.objects.get(pk=self.product.pk)
+        product.is_approved = True
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        product.save()
+        notify.assert_called_once_with(product.id)
+
+    def test_cancellation_restocks_and_enqueues_refund_once(self, schedule_refunds):
+        Payment.objects.create(order=self.order, user=self.customer, amount=150000, status='completed', transaction_id='cs_signal')
+        order = Order.objects.get(pk=self.order.pk)
+        order.status = 'cancelled'
+        order.save()
+        order.save()
+        self.inventory.refresh_from_db()
+        self.assertEqual(self.inventory.quantity, 10)
+        self.assertEqual(RefundRequest.objects.filter(order=self.order).count(), 1)
+
+    def test_receivers_registered_by_app_config(self, schedule_refunds):
+        # disconnect() trả về True chỉ khi receiver đang được kết nối (CoreConfig.ready đã import signals)
+        for receiver, sender in [
+            (signals.handle_order_cancellation, Order), (signals.notify_order_created, Order),
+            (signals.notify_payment_confirmation, Payment),
+        ]:
+            self.assertTrue(post_save.disconnect(receiver, sender=sender))
+            post_save.connect(receiver, sender=sender)
+
+    def test_default_superuser_only_created_in_debug(self, schedule_refunds):
+        with override_settings(DEBUG=False):
+            signals.create_default_superuser(sender=None)
+        self.assertFalse(User.objects.filter(username='admin').exists())
+        with override_settings(DEBUG=True):
+            signals.create_default_superuser(sender=None)
+        self.assertTrue(User.objects.get(username='admin').is_superuser)
+
+    @mock.patch('core.tasks.send_payment_confirmation_email.delay')
+    def test_payment_save_sends_confirmation_email_once(self, send_email, schedule_refunds):
+        payment = Payment.objects.create(order=self.order, user=self.customer, amount=150000, transaction_id='cs_signal')
+        payment = Payment.objects.get(pk=payment.pk)
+        payment.status = 'completed'
+        with self.captureOnCommitCallbacks(execute=True):
+            payment.save()
+            payment.save()
+        send_email.assert_called_once_with(self.customer.id, 'SIG-1')
+
+    @mock.patch('core.tasks.create_order_notification.delay')
+    def test_sync_order_creation_notifies_once(self, notify, schedule_refunds):
+        cart = Cart.objects.create(user=self.customer)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        client = APIClient()
+        client.force_authenticate(self.customer)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/orders/', {'cart_id': cart.id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], 'pending')
+        notify.assert_called_once_with(response.data['id'])
+
+    @mock.patch('core.tasks.send_to_group')
+    @mock.patch('core.tasks.create_order_notification.delay')
+    def test_async_order_placement_notifies_once(self, notify, send_to_group, schedule_refunds):
+        cart = Cart.objects.create(user=self.customer)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        order = Order.objects.create(user=self.customer, order_code='SIG-2', status='placing')
+        with self.captureOnCommitCallbacks(execute=True):
+            result = place_order_async(order.id, cart.id)
+        publish_order_status(result)
+        self.assertEqual(result['status'], 'pending')
+        notify.assert_called_once_with(order.id)
+
+
+@override_settings(NOTIFICATION_COALESCE_WINDOW=300)
+@mock.patch('core.tasks.send_fcm_batch')
+@mock.patch('core.tasks.flush_review_digest.apply_async')
+class ReviewDigestTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.distributor = self.create_user('digest_distributor', role='distributor')
+        self.product = Product.objects.create(distributor=self.distributor, name='Omega 3', description='-', price=120000)
+
+    def create_reviews(self, ratings):
+        with self.captureOnCommitCallbacks(execute=True):
+            for index, rating in enumerate(ratings):
+                Review.objects.create(user=self.create_user(f"digest_reviewer_{index}"), product=self.product, rating=rating)
+
+    def test_reviews_in_window_produce_one_digest(self, schedule_flush, send_push):
+        self.create_reviews([5, 4, 3])
+        # Chỉ đánh giá đầu tiên mở cửa sổ và lên lịch flush; chưa có thông báo nào được tạo
+        schedule_flush.assert_called_once_with(args=[self.distributor.id, self.product.id], countdown=300)
+        self.assertFalse(Notification.objects.filter(user=self.distributor).exists())
+
+        self.assertEqual(flush_review_digest(self.distributor.id, self.product.id), 3)
+        notification = Notification.objects.get(user=self.distributor)
+        self.assertIn('3 đánh giá mới', notification.message)
+        self.assertIn('4.0 sao', notification.message)
+        send_push.assert_called_once()
+
+    def test_single_review_keeps_original_message(self, schedule_flush, send_push):
+        self.create_reviews([5])
+        flush_review_digest(self.distributor.id, self.product.id)
+        notification = Notification.objects.get(user=self.distributor)
+        self.assertEqual(notification.message, "Sản phẩm Omega 3 nhận được đánh giá 5 sao.")
+
+
+def generate_order_codes(count):
+    # Chạy trong process con: generator tự nhận worker id riêng sau fork
+    return [generate_order_code() for _ in range(count)]
+
+
+class OrderCodeGeneratorTests(SimpleTestCase):
+    # Dùng cache mặc định (Redis): các process con phải thấy chung lease worker id.
+    # SimpleTestCase: không mở kết nối DB nào trước khi fork, process con chỉ dùng Redis
+    PROCESSES = 8
+    CODES_PER_PROCESS = 20000
+
+    def test_codes_unique_across_processes(self):
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=self.PROCESSES, mp_context=context) as pool:
+            batches = list(pool.map(generate_order_codes, [self.CODES_PER_PROCESS] * self.PROCESSES))
+        codes = [code for batch in batches for code in batch]
+        self.assertEqual(len(codes), self.PROCESSES * self.CODES_PER_PROCESS)
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertTrue(all(len(code) <= 20 for code in codes))
+
+    def test_reclaims_worker_id_when_lease_taken_over(self):
+        generator = OrderCodeGenerator()
+        generator.next_code()
+        worker_id = generator._worker_id
+        # Lease đã hết hạn và process khác giành được cùng worker id
+        cache.set(generator._lease_key(worker_id), 'other-host:1:token', timeout=60)
+        generator._lease_renewed_at -= ORDER_CODE_WORKER_LEASE * 0.6
+        generator.next_code()
+        self.assertNotEqual(generator._worker_id, worker_id)
+        cache.delete_many([generator._lease_key(worker_id), generator._lease_key(generator._worker_id)])
+
+    def test_reclaims_worker_id_after_idling_past_lease(self):
+        generator = OrderCodeGenerator()
+        generator.next_code()
+        worker_id = generator._worker_id
+        generator._lease_renewed_at -= ORDER_CODE_WORKER_LEASE
+        generator.next_code()
+        self.assertNotEqual(generator._worker_id, worker_id)
+        cache.delete_many([generator._lease_key(worker_id), generator._lease_key(generator._worker_id)])
+
+
+class DiscountCacheTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        distributor = self.create_user('cache_distributor', role='distributor')
+        self.customer = self.create_user('cache_customer')
+        self.product = Product.objects.create(distributor=distributor, name='Kẽm', description='-', price=100000)
+        Inventory.objects.create(distributor=distributor, product=self.product, quantity=10)
+        self.discount = Discount.objects.create(
+            code='LAST1', discount_type='fixed', discount_value=Decimal('10000'),
+            end_date=timezone.now() + timedelta(days=1), max_uses=1
+        )
+
+    def test_exhausted_code_rejected_from_cache_after_last_use(self):
+        # Nạp mã vào registry khi còn lượt
+        self.assertEqual(get_discount_by_code('LAST1').uses_count, 0)
+        order = Order.objects.create(user=self.customer, order_code='DSC-1', items_subtotal=Decimal('100000'))
+        order.discount = get_discount_by_code('LAST1')
+        with self.captureOnCommitCallbacks(execute=True):
+            order.apply_discount()
+
+        cached = get_discount_by_code('LAST1')
+        self.assertEqual(cached.uses_count, 1)
+        self.assertEqual(cached.is_valid(Decimal('100000')), (False, "Discount has reached maximum uses."))
+
+        cart = Cart.objects.create(user=self.customer)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        client = APIClient()
+        client.force_authenticate(self.customer)
+        response = client.post('/orders/', {'cart_id': cart.id, 'discount_code': 'LAST1'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Discount has reached maximum uses.", str(response.data))
+        self.assertEqual(Order.objects.filter(user=self.customer).count(), 1)
+
+
+class DiscountReservationTests(CoreTransactionTestCase):
+    """200 checkout song song dùng cùng một mã: số lượt dùng không bao giờ vượt max_uses."""
+    # 20 thread x 10 checkout: mỗi thread giữ một kết nối DB, vừa với max_connections mặc định của MySQL
+    WORKERS = 20
+    CHECKOUTS_PER_WORKER = 10
+    MAX_USES = 50
+
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('discount_customer')
+        self.discount = Discount.objects.create(
+            code='FLASH50', discount_type='fixed', discount_value=Decimal('10000'),
+            end_date=timezone.now() + timedelta(days=1), max_uses=self.MAX_USES
+        )
+        self.barrier = threading.Barrier(self.WORKERS, timeout=60)
+
+    def checkout_batch(self, worker):
+        try:
+            # Discount đọc một lần khi uses_count còn 0 nên is_valid() luôn qua: chỉ reserve_use chặn
+            stale_discount = Discount.objects.get(pk=self.discount.pk)
+            orders = [
+                Order.objects.create(user=self.customer, order_code=generate_order_code(), items_subtotal=Decimal('100000'))
+                for _ in range(self.CHECKOUTS_PER_WORKER)
+            ]
+            self.barrier.wait()
+            results = []
+            for order in orders:
+                order.discount = stale_discount
+                try:
+                    order.apply_discount()
+                    results.append(True)
+                except ValueError:
+                    results.append(False)
+            return results
+        finally:
+            connection.close()
+
+    def test_parallel_checkouts_do_not_oversell(self):
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as pool:
+            results = [result for batch in pool.map(self.checkout_batch, range(self.WORKERS)) for result in batch]
+        self.discount.refresh_from_db()
+        self.assertEqual(len(results), self.WORKERS * self.CHECKOUTS_PER_WORKER)
+        self.assertEqual(results.count(True), self.MAX_USES)
+        self.assertEqual(self.discount.uses_count, self.MAX_USES)
+        self.assertEqual(Order.objects.filter(discount=self.discount).count(), self.MAX_USES)
+
+
+class OrderTotalsTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        distributor = self.create_user('totals_distributor', role='distributor')
+        self.product = Product.objects.create(distributor=distributor, name='Paracetamol', description='-', price=20000)
+        Inventory.objects.create(distributor=distributor, product=self.product, quantity=100)
+        self.order = Order.objects.create(user=self.create_user('totals_customer'), order_code='TOT-1')
+        self.item = OrderItem.objects.create(order=self.order, product=self.product, quantity=2, price=20000)
+        self.admin = OrderItemAdmin(OrderItem, AdminSite())
+
+    def test_recalculate_totals_sums_items(self):
+        self.order.recalculate_totals()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.items_subtotal, Decimal('40000'))
+        self.assertEqual(self.order.grand_total, Decimal('40000'))
+
+    def test_admin_delete_recalculates_totals(self):
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=1, price=20000)
+        self.order.recalculate_totals()
+        self.admin.delete_model(None, self.item)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.items_subtotal, Decimal('20000'))
+
+
+class BulkTransitionTests(CoreTestCase):
+    url = '/orders/bulk-transition/'
+
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('bulk_customer')
+        self.pending = Order.objects.create(user=self.customer, order_code='BLK-1')
+        self.processing = Order.objects.create(user=self.customer, order_code='BLK-2', status='processing')
+        self.client = APIClient()
+        self.client.force_authenticate(self.create_user('bulk_admin', role='admin'))
+
+    def test_string_ids_reported_as_updated(self):
+        response = self.client.post(
+            self.url, {'order_ids': [str(self.pending.id), str(self.processing.id)], 'status': 'cancelled'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated_ids'], [self.pending.id])
+        # Đơn đang xử lý không hủy được, giống action cancel
+        self.assertEqual(response.data['skipped_ids'], [self.processing.id])
+
+    def test_invalid_ids_rejected(self):
+        for order_ids in (['abc'], [True], [1.5], [{'id': 1}]):
+            response = self.client.post(self.url, {'order_ids': order_ids, 'status': 'processing'}, format='json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_single_cancel_uses_same_rule(self):
+        client = APIClient()
+        client.force_authenticate(self.customer)
+        self.assertEqual(client.post(f"/orders/{self.processing.id}/cancel/").status_code, 400)
+        with mock.patch('core.signals.enqueue_refunds'):
+            self.assertEqual(client.post(f"/orders/{self.pending.id}/cancel/").status_code, 200)
+
+
+class OrderPlacementTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('placing_customer')
+        self.cart = Cart.objects.create(user=self.customer)
+
+    @mock.patch('core.models.Order.place_from_cart', side_effect=RuntimeError('database went away'))
+    def test_unexpected_error_marks_order_failed(self, place_from_cart):
+        order = Order.objects.create(user=self.customer, order_code='PLC-1', status='placing')
+        result = place_order_async(order.id, self.cart.id)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'failed')
+        self.assertEqual(result['status'], 'failed')
+        self.assertTrue(result['message'])
+
+    @mock.patch('core.tasks.send_to_group')
+    def test_sweeper_fails_only_stale_placing_orders(self, send_to_group):
+        stale = Order.objects.create(user=self.customer, order_code='PLC-2', status='placing')
+        fresh = Order.objects.create(user=self.customer, order_code='PLC-3', status='placing')
+        Order.objects.filter(id=stale.id).update(created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(fail_stuck_placing_orders(), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(stale.status, 'failed')
+        self.assertEqual(fresh.status, 'placing')
+        send_to_group.assert_called_once()
+
+
+class NotificationPublishTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user(f"publish_user_{i}") for i in range(3)]
+
+    def test_assign_missing_ids_after_bulk_create(self):
+        notifications = Notification.objects.bulk_create([
+            Notification(user=user, title="Khuyến mãi", message="Giảm 10%", notification_type='promotion')
+            for user in self.users
+        ])
+        expected = {notification.user_id: notification.pk for notification in notifications}
+        if None in expected.values():
+            expected = dict(Notification.objects.values_list('user_id', 'id'))
+        # Giống MySQL: bulk_create không gán pk cho object
+        for notification in notifications:
+            notification.pk = None
+        assign_missing_ids(notifications)
+        self.assertEqual({notification.user_id: notification.pk for notification in notifications}, expected)
+
+    @mock.patch('core.notifications.send_to_group')
+    @mock.patch('core.notifications.online_user_ids')
+    def test_published_payload_carries_ids(self, online_user_ids, send_to_group):
+        online_user_ids.side_effect = lambda user_ids: set(user_ids)
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.bulk_create([
+                Notification(user=user, title="Cập nhật đơn hàng", message="Đơn hàng đã hoàn thành.", notification_type='order')
+                for user in self.users
+            ])
+        self.assertEqual(send_to_group.call_count, len(self.users))
+        for call in send_to_group.call_args_list:
+            payload = call.args[2]
+            self.assertTrue(all(item['id'] for item in payload['notifications']))
+
+
+    @mock.patch('core.notifications.send_to_group')
+    @mock.patch('core.notifications.online_user_ids')
+    def test_rolled_back_batch_not_reused(self, online_user_ids, send_to_group):
+        online_user_ids.side_effect = lambda user_ids: set(user_ids)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Notification.objects.create(user=self.users[0], title="Hủy", message="Rollback", notification_type='order')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            Notification.objects.create(user=self.users[1], title="Mới", message="Đã commit", notification_type='order')
+        send_to_group.assert_called_once()
+        group, _, payload = send_to_group.call_args.args
+        self.assertEqual(group, f"notifications_{self.users[1].id}")
+        self.assertEqual([item['message'] for item in payload['notifications']], ["Đã commit"])
+
+    @override_settings(NOTIFICATION_ONLINE_TTL=60)
+    def test_online_flag_expires_without_refresh(self):
+        user_id = self.users[0].id
+        mark_user_online(user_id)
+        mark_user_online(user_id)
+        mark_user_offline(user_id)
+        self.assertEqual(online_user_ids([user_id]), {user_id})
+        now = time.time()
+        with mock.patch('time.time', return_value=now + 50):
+            refresh_user_online(user_id)
+        with mock.patch('time.time', return_value=now + 100):
+            # Đã gia hạn ở giây thứ 50 nên vẫn online
+            self.assertEqual(online_user_ids([user_id]), {user_id})
+        with mock.patch('time.time', return_value=now + 200):
+            # Worker chết, không còn ai gia hạn: key tự hết hạn
+            self.assertEqual(online_user_ids([user_id]), set())
+
+
+class UnreadCounterTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.users = [self.create_user(f"unread_user_{i}") for i in range(3)]
+
+    def notify(self, user, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.bulk_create([
+                Notification(user=user, title="Khuyến mãi", message=f"Ưu đãi {i}", notification_type='promotion')
+                for i in range(count)
+            ])
+
+    def test_reconcile_fixes_drifted_counts_without_key_scan(self):
+        self.notify(self.users[0], 3)
+        self.notify(self.users[1], 2)
+        self.assertEqual(unread_counter.get(self.users[0].id), 3)
+        self.assertEqual(unread_counter.get(self.users[1].id), 2)
+        cache.set(unread_counter._user_key(self.users[0].id), 7)
+        with mock.patch('core.notifications.UNREAD_RECONCILE_BATCH', 2):
+            self.assertEqual(reconcile_unread_counts(), 1)
+        self.assertEqual(unread_counter.get(self.users[0].id), 3)
+        # User chưa có key trong cache thì không tạo key mới
+        self.assertIsNone(cache.get(unread_counter._user_key(self.users[2].id)))
+        self.assertEqual(unread_counter.get_total(), 5)
+
+    def test_counter_follows_create_and_mark_read(self):
+        self.assertEqual(unread_counter.get(self.users[0].id), 0)
+        self.notify(self.users[0], 2)
+        notification = Notification.objects.filter(user=self.users[0]).first()
+        notification.is_read = True
+        with self.captureOnCommitCallbacks(execute=True):
+            notification.save()
+        self.assertEqual(unread_counter.get(self.users[0].id), 1)
+
+
+@mock.patch('core.tasks.PROMOTION_CHUNK_SIZE', 2)
+@mock.patch('core.tasks.send_fcm_multicast', return_value=(0, []))
+class PromotionFanOutTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customers = [self.create_user(f"promo_customer_{i}") for i in range(5)]
+        self.create_user('promo_distributor', role='distributor')
+
+    def test_notifies_segment_in_keyset_chunks(self, send_push):
+        campaign = PromotionCampaign.objects.create(title="Flash sale", message="Giảm 20%", segment={'role': 'customer'})
+        self.assertEqual(fan_out_promotion(campaign.id), 5)
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.status, campaign.notified_count), ('completed', 5))
+        self.assertEqual(campaign.last_user_id, self.customers[-1].id)
+        self.assertEqual(
+            set(Notification.objects.filter(notification_type='promotion').values_list('user_id', flat=True)),
+            {customer.id for customer in self.customers}
+        )
+
+    def test_resumes_after_checkpoint(self, send_push):
+        campaign = PromotionCampaign.objects.create(
+            title="Flash sale", message="Giảm 20%", segment={'role': 'customer'}, last_user_id=self.customers[2].id
+        )
+        self.assertEqual(fan_out_promotion(campaign.id), 2)
+        self.assertEqual(
+            sorted(Notification.objects.values_list('user_id', flat=True)), [customer.id for customer in self.customers[3:]]
+        )
+
+
+class StripeGatewayTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        self.gateway = StripeGateway.__new__(StripeGateway)
+        self.gateway.max_retries = 0
+        self.gateway.breaker = self.breaker
+
+    def open_breaker(self):
+        with self.assertRaises(stripe.error.APIConnectionError):
+            self.gateway._call(mock.Mock(side_effect=stripe.error.APIConnectionError("down"), __qualname__='call'))
+
+    def test_unexpected_error_during_probe_releases_breaker(self):
+        self.open_breaker()
+        self.assertEqual(self.breaker.state, 'half-open')
+        with self.assertRaises(KeyError):
+            self.gateway._call(mock.Mock(side_effect=KeyError('boom')))
+        self.assertFalse(self.breaker._probing)
+        # Probe tiếp theo vẫn được phép và đóng breaker khi thành công
+        self.assertEqual(self.gateway._call(mock.Mock(return_value='ok')), 'ok')
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_open_breaker_rejects_calls(self):
+        self.breaker.reset_timeout = 60
+        self.open_breaker()
+        func = mock.Mock()
+        with self.assertRaises(StripeUnavailableError):
+            self.gateway._call(func)
+        func.assert_not_called()
+
+    def test_retry_reuses_idempotency_key(self):
+        self.gateway.max_retries = 2
+        self.breaker.failure_threshold = 5
+        func = mock.Mock(side_effect=[stripe.error.APIConnectionError("reset"), {'id': 're_1'}], __qualname__='create')
+        self.gateway.client = mock.Mock()
+        self.gateway.client.v1.refunds.create = func
+        with mock.patch('core.stripe_gateway.time.sleep'):
+            self.assertEqual(self.gateway.create_refund('refund-1', payment_intent='pi_1'), {'id': 're_1'})
+        self.assertEqual([call.kwargs['options']['idempotency_key'] for call in func.call_args_list], ['refund-1', 'refund-1'])
+        self.assertEqual(func.call_args.kwargs['params'], {'payment_intent': 'pi_1'})
+
+    def test_gateway_does_not_configure_global_stripe(self):
+        with mock.patch.object(stripe, 'api_key', None), mock.patch.object(stripe, 'default_http_client', None), \
+                mock.patch.object(stripe, 'max_network_retries', 2):
+            gateway = StripeGateway(
+                connect_timeout=1, read_timeout=2, max_retries=0, pool_size=1,
+                breaker=self.breaker, api_base='http://stripe-mock:12111',
+            )
+            self.assertIsNone(stripe.api_key)
+            self.assertIsNone(stripe.default_http_client)
+            self.assertEqual(stripe.max_network_retries, 2)
+        self.assertIsInstance(gateway.client, stripe.StripeClient)
+
+    def test_gives_up_after_max_retries(self):
+        self.gateway.max_retries = 2
+        self.breaker.failure_threshold = 5
+        func = mock.Mock(side_effect=stripe.error.APIError("503"), __qualname__='retrieve')
+        with mock.patch('core.stripe_gateway.time.sleep') as sleep, self.assertRaises(stripe.error.APIError):
+            self.gateway._call(func)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_client_errors_not_retried(self):
+        self.gateway.max_retries = 2
+        func = mock.Mock(side_effect=stripe.error.InvalidRequestError("No such session", 'id'))
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            self.gateway._call(func)
+        func.assert_called_once()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_each_thread_gets_its_own_session(self):
+        adapter = mock.Mock()
+        sessions = ThreadLocalSession(adapter)
+        barrier = threading.Barrier(2)
+
+        def session_in_thread(_):
+            session = sessions._session()
+            barrier.wait(timeout=5)
+            return session
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first, second = executor.map(session_in_thread, range(2))
+        self.assertIsNot(first, second)
+        self.assertIs(sessions._session(), sessions._session())
+        self.assertIs(first.get_adapter('https://api.stripe.com'), adapter)
+        self.assertIs(second.get_adapter('https://api.stripe.com'), adapter)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', EMAIL_RATE_LIMIT_PER_MINUTE=60)
+@mock.patch('core.tasks.send_queued_emails.delay')
+class EmailOutboxTests(CoreTestCase):
+    """Các kiểm tra trước đây làm tay với tools/local_smtp_server.py."""
+
+    def queue(self, count):
+        return queue_emails([
+            {'subject': f"Email {i}", 'body': "Nội dung", 'to_email': f"customer{i}@pharmatech.test"}
+            for i in range(count)
+        ])
+
+    def test_batch_sent_over_one_connection(self, delay):
+        self.queue(3)
+        with mock.patch('core.tasks.get_connection', wraps=mail.get_connection) as get_connection:
+            self.assertEqual(send_queued_emails(), 3)
+        get_connection.assert_called_once()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(EmailOutbox.objects.filter(status='sent').count(), 3)
+
+    @override_settings(EMAIL_RATE_LIMIT_PER_MINUTE=2)
+    def test_rate_limit_leaves_rest_queued(self, delay):
+        self.queue(3)
+        self.assertEqual(send_queued_emails(), 2)
+        self.assertEqual(send_queued_emails(), 0)
+        self.assertEqual(EmailOutbox.objects.filter(status='sent').count(), 2)
+        self.assertEqual(EmailOutbox.objects.filter(status='queued').count(), 1)
+
+    def test_temporary_error_retried_with_backoff_and_permanent_error_failed(self, delay):
+        queue_emails([
+            {'subject': "Tạm thời", 'body': "Nội dung", 'to_email': 'busy@pharmatech.test'},
+            {'subject': "Vĩnh viễn", 'body': "Nội dung", 'to_email': 'missing@pharmatech.test'},
+        ])
+
+        def send_messages(messages):
+            if messages[0].to == ['busy@pharmatech.test']:
+                raise smtplib.SMTPDataError(451, b"Temporary failure, try again later")
+            raise smtplib.SMTPRecipientsRefused({'missing@pharmatech.test': (550, b"No such user")})
+
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        with mock.patch('core.tasks.get_connection', return_value=connection):
+            self.assertEqual(send_queued_emails(), 0)
+        connection.close.assert_called()
+
+        busy = EmailOutbox.objects.get(to_email='busy@pharmatech.test')
+        self.assertEqual((busy.status, busy.attempts), ('queued', 1))
+        self.assertGreater(busy.next_attempt_at, timezone.now())
+        self.assertEqual(EmailOutbox.objects.get(to_email='missing@pharmatech.test').status, 'failed')
+        # Email đang chờ backoff không bị gửi lại ngay
+        self.assertEqual(send_queued_emails(), 0)
+
+    def test_stale_sending_email_reclaimed_without_queued_mail(self, delay):
+        self.queue(1)
+        EmailOutbox.objects.update(status='sending', updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(send_queued_emails(), 1)
+        self.assertEqual(EmailOutbox.objects.get().status, 'sent')
+
+    def test_unclaimed_quota_released(self, delay):
+        self.queue(3)
+        # Worker khác đã giành hết các email giữa lúc đếm và lúc claim
+        with mock.patch('core.tasks.claim_queued_emails', return_value=[]):
+            self.assertEqual(send_queued_emails(), 0)
+        self.assertEqual(cache.get(f"email_outbox:quota:{int(time.time() // 60)}"), 0)
+
+
+class IdempotentEchoView:
+    def __init__(self, status_code=201):
+        self.status_code = status_code
+        self.calls = 0
+
+    @idempotent_request('test-echo')
+    def create(self, request):
+        self.calls += 1
+        return Response({'call': self.calls, 'data': request.data}, status=self.status_code)
+
+
+class IdempotencyKeyTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('idempotent_customer')
+        self.view = IdempotentEchoView()
+
+    def post(self, data, key='key-1', user=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        request = Request(APIRequestFactory().post('/', data, format='json', **headers), parsers=[JSONParser()])
+        request.user = user or self.customer
+        return self.view.create(request)
+
+    def test_replays_stored_response(self):
+        first = self.post({'cart': 1})
+        second = self.post({'cart': 1})
+        self.assertEqual(self.view.calls, 1)
+        self.assertEqual((second.status_code, second.data), (first.status_code, first.data))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+
+    def test_same_key_with_different_body_conflicts(self):
+        self.post({'cart': 1})
+        response = self.post({'cart': 2})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.view.calls, 1)
+
+    def test_key_scoped_per_user(self):
+        self.post({'cart': 1})
+        self.post({'cart': 1}, user=self.create_user('idempotent_other'))
+        self.assertEqual(self.view.calls, 2)
+
+    def test_without_key_always_runs(self):
+        self.post({'cart': 1}, key=None)
+        self.post({'cart': 1}, key=None)
+        self.assertEqual(self.view.calls, 2)
+
+    def test_server_errors_not_stored(self):
+        self.view.status_code = 503
+        self.post({'cart': 1})
+        self.view.status_code = 201
+        response = self.post({'cart': 1})
+        self.assertEqual((response.status_code, self.view.calls), (201, 2))
+
+    @mock.patch('core.utils.IDEMPOTENCY_WAIT_TIMEOUT', 0)
+    def test_in_flight_duplicate_gets_conflict(self):
+        key_hash = hashlib.sha256(b'key-1').hexdigest()
+        cache.add(f"idempotency:test-echo:{self.customer.pk}:{key_hash}:lock", 1)
+        response = self.post({'cart': 1})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.view.calls, 0)
+
+
+class OrderListQueryTests(CoreTestCase):
+    """Số query của danh sách/lịch sử đơn hàng không phụ thuộc số đơn và số dòng."""
+    LINES_PER_ORDER = 10
+
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('history_customer')
+        distributor = self.create_user('history_distributor', role='distributor')
+        category = Category.objects.create(name='Thực phẩm chức năng')
+        self.products = []
+        for index in range(self.LINES_PER_ORDER):
+            product = Product.objects.create(
+                distributor=distributor, category=category, name=f"SP {index}", description='-', price=10000
+            )
+            Inventory.objects.create(distributor=distributor, product=product, quantity=5 + index)
+            self.products.append(product)
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def create_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(
+                user=self.customer, order_code=generate_order_code(), items_subtotal=100000, grand_total=100000
+            )
+            OrderItem.objects.bulk_create(
+                OrderItem(order=order, product=product, quantity=1, price=10000) for product in self.products
+            )
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'page_size': 20})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data['results']
+
+    def test_query_count_constant_in_orders_and_lines(self):
+        for url in ['/orders/', '/orders/history/', '/orders/?expand=product', '/orders/history/?expand=product']:
+            with self.subTest(url=url):
+                Order.objects.all().delete()
+                self.create_orders(2)
+                small, _ = self.count_queries(url)
+                self.create_orders(18)
+                large, results = self.count_queries(url)
+                self.assertEqual(len(results), 20)
+                self.assertEqual(small, large)
+                self.assertLessEqual(large, 6)
+
+    def test_compact_items_by_default(self):
+        self.create_orders(1)
+        _, results = self.count_queries('/orders/history/')
+        item = results[0]['items'][0]
+        self.assertEqual(set(item), {'id', 'product', 'quantity', 'price'})
+        self.assertEqual(set(item['product']), {'id', 'name', 'image'})
+
+    def test_expand_product_renders_full_product_with_stock(self):
+        self.create_orders(1)
+        _, results = self.count_queries('/orders/?expand=product')
+        stock = {item['product']['id']: item['product']['total_stock'] for item in results[0]['items']}
+        self.assertEqual(stock, {product.id: product.total_stock for product in self.products})
+        self.assertEqual(results[0]['items'][0]['product']['category_name'], 'Thực phẩm chức năng')
+
+
+class DiscountRankingTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        # Registry mới cho mỗi test: bảng mã cục bộ của process không bị giữ lại giữa các test
+        patcher = mock.patch('core.discounts.discount_registry', DiscountRegistry())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now = timezone.now()
+        for code, fields in {
+            'PCT10': {'discount_type': 'percentage', 'discount_value': Decimal('10')},
+            'PCT50CAP': {'discount_type': 'percentage', 'discount_value': Decimal('50'), 'max_discount_amount': Decimal('30000')},
+            'FIXED25': {'discount_type': 'fixed', 'discount_value': Decimal('25000')},
+            'MIN500': {'discount_type': 'fixed', 'discount_value': Decimal('90000'), 'min_order_value': Decimal('500000')},
+            'USEDUP': {'discount_type': 'fixed', 'discount_value': Decimal('90000'), 'max_uses': 1, 'uses_count': 1},
+            'FUTURE': {'discount_type': 'fixed', 'discount_value': Decimal('90000'), 'start_date': now + timedelta(days=1)},
+            'EXPIRED': {'discount_type': 'fixed', 'discount_value': Decimal('90000'), 'end_date': now - timedelta(days=1)},
+            'INACTIVE': {'discount_type': 'fixed', 'discount_value': Decimal('90000'), 'is_active': False},
+        }.items():
+            Discount.objects.create(code=code, **{'end_date': now + timedelta(days=7), **fields})
+
+    def test_ranks_applicable_discounts_by_amount(self):
+        applicable, rejected = rank_discounts(Decimal('200000'))
+        self.assertEqual(
+            [(item['code'], item['discount_amount']) for item in applicable],
+            [('PCT50CAP', Decimal('30000')), ('FIXED25', Decimal('25000')), ('PCT10', Decimal('20000'))]
+        )
+        self.assertEqual(applicable[0]['total_after_discount'], Decimal('170000'))
+        self.assertEqual(rejected, [])
+
+    def test_requested_codes_report_rejection_reasons(self):
+        applicable, rejected = rank_discounts(Decimal('200000'), ['PCT10', 'MIN500', 'USEDUP', 'FUTURE', 'EXPIRED', 'INACTIVE', 'NOPE'])
+        self.assertEqual([item['code'] for item in applicable], ['PCT10'])
+        reasons = {item['code']: item['reason'] for item in rejected}
+        self.assertEqual(reasons['MIN500'], "Order amount must be at least 500000.00.")
+        self.assertEqual(reasons['USEDUP'], "Discount has reached maximum uses.")
+        self.assertEqual(reasons['FUTURE'], "Discount is expired or not yet active.")
+        for code in ['EXPIRED', 'INACTIVE', 'NOPE']:
+            self.assertEqual(reasons[code], "Mã giảm giá không tồn tại hoặc không còn hoạt động.")
+
+    def test_fixed_discount_capped_at_order_amount(self):
+        applicable, _ = rank_discounts(Decimal('10000'), ['FIXED25'])
+        self.assertEqual(applicable[0]['discount_amount'], Decimal('10000'))
+        self.assertEqual(applicable[0]['total_after_discount'], Decimal('0.00'))
+
+    def test_active_table_loaded_once(self):
+        rank_discounts(Decimal('200000'))
+        with self.assertNumQueries(0):
+            rank_discounts(Decimal('50000'))
+            rank_discounts(Decimal('300000'), ['PCT10'])
+
+    def test_best_endpoint_uses_cart_total(self):
+        customer = self.create_user('ranking_customer')
+        distributor = self.create_user('ranking_distributor', role='distributor')
+        product = Product.objects.create(distributor=distributor, name='Canxi', description='-', price=50000)
+        cart = Cart.objects.create(user=customer)
+        CartItem.objects.create(cart=cart, product=product, quantity=4)
+        client = APIClient()
+        client.force_authenticate(customer)
+        response = client.post('/discounts/best/', {'cart_id': cart.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(response.data['cart_total']), Decimal('200000'))
+        self.assertEqual(response.data['best']['code'], 'PCT50CAP')
+        self.assertEqual(client.post('/discounts/best/', {'cart_id': cart.id, 'codes': 'PCT10'}, format='json').status_code, 400)
+
+
+class DiscountValidityTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        week = now + timedelta(days=7)
+        self.discounts = {
+            code: Discount.objects.create(code=code, discount_type='fixed', discount_value=Decimal('10000'), **fields)
+            for code, fields in {
+                'VALID': {'end_date': week, 'max_uses': 5, 'uses_count': 4},
+                'UNLIMITED_NULL': {'end_date': week, 'max_uses': None, 'uses_count': 100},
+                'UNLIMITED_ZERO': {'end_date': week, 'max_uses': 0, 'uses_count': 100},
+                'INACTIVE': {'end_date': week, 'is_active': False},
+                'FUTURE': {'end_date': week, 'start_date': now + timedelta(days=1)},
+                'EXPIRED': {'end_date': now - timedelta(days=1), 'start_date': now - timedelta(days=2)},
+                'USEDUP': {'end_date': week, 'max_uses': 3, 'uses_count': 3},
+            }.items()
+        }
+
+    def test_annotation_matches_is_valid(self):
+        for discount in Discount.objects.with_validity():
+            with self.subTest(code=discount.code):
+                valid, message = discount.is_valid(order_amount=discount.min_order_value or 0)
+                self.assertEqual((discount.is_currently_valid, discount.validity_message), (valid, message))
+
+    def test_list_uses_annotation_instead_of_is_valid(self):
+        with mock.patch.object(Discount, 'is_valid', side_effect=AssertionError("is_valid gọi cho từng dòng")):
+            response = APIClient().get('/discounts/')
+        self.assertEqual(response.status_code, 200)
+        statuses = {item['code']: item['is_valid_status']['valid'] for item in response.data['results']}
+        # Danh sách chỉ gồm mã đang bật và trong thời hạn; mã hết lượt vẫn hiện nhưng không hợp lệ
+        self.assertEqual(statuses, {'VALID': True, 'UNLIMITED_NULL': True, 'UNLIMITED_ZERO': True, 'USEDUP': False})
+
+    @mock.patch('core.tasks.discount_registry')
+    def test_deactivates_expired_and_used_up_in_bulk(self, registry):
+        self.assertEqual(deactivate_invalid_discounts(), 2)
+        active = set(Discount.objects.filter(is_active=True).values_list('code', flat=True))
+        self.assertEqual(active, {'VALID', 'UNLIMITED_NULL', 'UNLIMITED_ZERO', 'FUTURE'})
+        self.assertEqual({call.args[0] for call in registry.invalidate.call_args_list}, {'EXPIRED', 'USEDUP'})
+        # Chạy lại không còn gì để tắt
+        self.assertEqual(deactivate_invalid_discounts(), 0)
+
+    def test_validity_window_index_declared(self):
+        self.assertIn(['is_active', 'start_date', 'end_date'], [index.fields for index in Discount._meta.indexes])
+
+
+@mock.patch('core.tasks.process_refund_requests.delay')
+@mock.patch('core.tasks.publish_payment_status')
+@mock.patch('core.tasks.send_fcm_batch')
+@mock.patch('core.tasks.process_stripe_refund')
+class RefundQueueTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('refund_customer')
+        self.payments = []
+        for index in range(3):
+            order = Order.objects.create(
+                user=self.customer, order_code=f"RF-{index}", items_subtotal=100000, grand_total=100000, status='cancelled'
+            )
+            self.payments.append(Payment.objects.create(
+                order=order, user=self.customer, amount=100000, status='completed', transaction_id=f"pi_refund_{index}"
+            ))
+        self.order_ids = [payment.order_id for payment in self.payments]
+
+    def test_enqueue_is_idempotent_per_payment(self, refund, send_fcm_batch, publish, delay):
+        enqueue_refunds(self.order_ids)
+        enqueue_refunds(self.order_ids)
+        self.assertEqual(RefundRequest.objects.count(), 3)
+
+    def test_batch_refunds_and_notifies_once(self, refund, send_fcm_batch, publish, delay):
+        refund.side_effect = lambda payment: {'success': True, 'refund_id': f"re_{payment.id}"}
+        enqueue_refunds(self.order_ids)
+        self.assertEqual(process_refund_requests(), 3)
+
+        self.assertEqual(sorted(call.args[0].id for call in refund.call_args_list), sorted(p.id for p in self.payments))
+        self.assertEqual(set(Payment.objects.values_list('status', flat=True)), {'refunded'})
+        for refund_request in RefundRequest.objects.all():
+            self.assertEqual(refund_request.status, 'succeeded')
+            self.assertEqual(refund_request.stripe_refund_id, f"re_{refund_request.payment_id}")
+            self.assertIsNotNone(refund_request.processed_at)
+        send_fcm_batch.assert_called_once()
+        self.assertEqual(len(send_fcm_batch.call_args.args[0]), 3)
+        self.assertEqual(Notification.objects.filter(title="Hoàn tiền thành công").count(), 3)
+        self.assertEqual(EmailOutbox.objects.count(), 3)
+        # Lô đã xử lý xong không bị giành lại
+        self.assertEqual(process_refund_requests(), 0)
+        self.assertEqual(refund.call_count, 3)
+
+    def test_transient_failure_retried_until_max_attempts(self, refund, send_fcm_batch, publish, delay):
+        refund.return_value = {'success': False, 'message': "Stripe tạm thời không khả dụng"}
+        enqueue_refunds(self.order_ids[:1])
+        process_refund_requests()
+        refund_request = RefundRequest.objects.get()
+        self.assertEqual((refund_request.status, refund_request.attempts), ('pending', 1))
+        self.assertEqual(refund_request.error, "Stripe tạm thời không khả dụng")
+        self.assertIsNone(refund_request.processed_at)
+
+        for _ in range(REFUND_MAX_ATTEMPTS - 1):
+            process_refund_requests()
+        refund_request.refresh_from_db()
+        self.assertEqual((refund_request.status, refund_request.attempts), ('failed', REFUND_MAX_ATTEMPTS))
+        self.assertEqual(Payment.objects.get(id=refund_request.payment_id).status, 'completed')
+        send_fcm_batch.assert_not_called()
+
+    def test_stale_processing_request_reclaimed(self, refund, send_fcm_batch, publish, delay):
+        refund.side_effect = lambda payment: {'success': True, 'refund_id': f"re_{payment.id}"}
+        enqueue_refunds(self.order_ids[:2])
+        stale, fresh = RefundRequest.objects.order_by('id')
+        RefundRequest.objects.filter(id=stale.id).update(
+            status='processing', updated_at=timezone.now() - REFUND_STALE_AFTER - timedelta(minutes=1)
+        )
+        RefundRequest.objects.filter(id=fresh.id).update(status='processing', updated_at=timezone.now())
+        self.assertEqual(process_refund_requests(), 1)
+        self.assertEqual(RefundRequest.objects.get(id=stale.id).status, 'succeeded')
+        self.assertEqual(RefundRequest.objects.get(id=fresh.id).status, 'processing')
+
+    def test_already_refunded_payment_not_sent_to_stripe(self, refund, send_fcm_batch, publish, delay):
+        enqueue_refunds(self.order_ids[:1])
+        Payment.objects.filter(id=self.payments[0].id).update(status='refunded')
+        process_refund_requests()
+        refund.assert_not_called()
+        self.assertEqual(RefundRequest.objects.get().status, 'succeeded')
+
+    def test_stripe_refund_reuses_idempotency_key_per_payment(self, refund, send_fcm_batch, publish, delay):
+        payment = self.payments[0]
+        with mock.patch('core.utils.stripe_gateway.create_refund', return_value=mock.Mock(id='re_1')) as create_refund:
+            process_stripe_refund(payment)
+            process_stripe_refund(payment)
+        self.assertEqual(
+            [call.kwargs['idempotency_key'] for call in create_refund.call_args_list], [f"refund-{payment.id}"] * 2
+        )
+
+
+def fcm_batch_response(tokens, invalid=(), failed=()):
+    """BatchResponse giả của send_each/send_each_for_multicast: token trong invalid bị gỡ đăng ký, trong failed lỗi tạm thời."""
+    responses = []
+    for token in tokens:
+        if token in invalid:
+            responses.append(mock.Mock(success=False, exception=messaging.UnregisteredError("Token đã bị gỡ đăng ký")))
+        elif token in failed:
+            responses.append(mock.Mock(success=False, exception=firebase_admin.exceptions.UnavailableError("FCM quá tải")))
+        else:
+            responses.append(mock.Mock(success=True, exception=None))
+    return mock.Mock(success_count=sum(response.success for response in responses), responses=responses)
+
+
+class FcmDeliveryTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('fcm_customer')
+        self.other = self.create_user('fcm_other')
+        for user, token in [(self.customer, 'tok-live'), (self.customer, 'tok-dead'), (self.other, 'tok-other')]:
+            DeviceToken.objects.create(user=user, token=token)
+
+    def test_multicast_chunks_and_prunes_invalid_tokens(self):
+        tokens = ['tok-dead'] + [f"tok-{index}" for index in range(FCM_BATCH_LIMIT * 2)]
+
+        def send_each_for_multicast(message):
+            return fcm_batch_response(message.tokens, invalid={'tok-dead'}, failed={'tok-7'})
+
+        with mock.patch('core.utils.messaging.send_each_for_multicast', side_effect=send_each_for_multicast) as send:
+            sent, invalid_tokens = send_fcm_multicast(tokens, "Khuyến mãi", "Giảm 10%", {'campaign_id': 1})
+        self.assertEqual([len(call.args[0].tokens) for call in send.call_args_list], [FCM_BATCH_LIMIT, FCM_BATCH_LIMIT, 1])
+        self.assertEqual(send.call_args.args[0].data, {'campaign_id': '1'})
+        self.assertEqual(sent, len(tokens) - 2)
+        # Lỗi tạm thời không làm mất token, chỉ token bị gỡ đăng ký mới bị xóa
+        self.assertEqual(invalid_tokens, ['tok-dead'])
+        self.assertEqual(set(DeviceToken.objects.values_list('token', flat=True)), {'tok-live', 'tok-other'})
+
+    def test_multicast_without_prune_leaves_tokens(self):
+        with mock.patch('core.utils.messaging.send_each_for_multicast', return_value=fcm_batch_response(['tok-dead'], invalid={'tok-dead'})):
+            self.assertEqual(send_fcm_multicast(['tok-dead'], "A", "B", prune=False), (0, ['tok-dead']))
+        self.assertTrue(DeviceToken.objects.filter(token='tok-dead').exists())
+
+    def test_failed_chunk_does_not_stop_remaining_chunks(self):
+        tokens = [f"tok-{index}" for index in range(FCM_BATCH_LIMIT + 3)]
+        with mock.patch('core.utils.messaging.send_each_for_multicast', side_effect=[
+            firebase_admin.exceptions.UnavailableError("FCM không phản hồi"), fcm_batch_response(tokens[FCM_BATCH_LIMIT:])
+        ]) as send:
+            self.assertEqual(send_fcm_multicast(tokens, "A", "B"), (3, []))
+        self.assertEqual(send.call_count, 2)
+
+    def test_batch_sends_per_user_messages_in_one_call(self):
+        def send_each(messages):
+            return fcm_batch_response([message.token for message in messages], invalid={'tok-dead'})
+
+        with mock.patch('core.utils.messaging.send_each', side_effect=send_each) as send:
+            result = send_fcm_batch([
+                {'user_id': self.customer.id, 'title': "Đơn hàng", 'body': "Đã giao", 'data': {'order_id': 7}},
+                {'user_id': self.other.id, 'title': "Đơn hàng", 'body': "Đã hủy"},
+            ])
+        send.assert_called_once()
+        bodies = {message.token: message.notification.body for message in send.call_args.args[0]}
+        self.assertEqual(bodies, {'tok-live': "Đã giao", 'tok-dead': "Đã giao", 'tok-other': "Đã hủy"})
+        self.assertEqual(result, {'success': True, 'sent': 2, 'invalid_tokens': 1})
+        self.assertFalse(DeviceToken.objects.filter(token='tok-dead').exists())
+
+    def test_send_fcm_v1_is_synchronous(self):
+        with mock.patch('core.utils.messaging.send_each_for_multicast', return_value=fcm_batch_response(['tok-other'])) as send:
+            result = send_fcm_v1(self.other, "Chào mừng", "Xin chào")
+            async_result = async_to_sync(asend_fcm_v1)(self.other, "Chào mừng", "Xin chào")
+        self.assertEqual(result['sent'], 1)
+        self.assertEqual(async_result['sent'], 1)
+        self.assertEqual(send.call_count, 2)
+        nobody = self.create_user('fcm_nobody')
+        self.assertFalse(send_fcm_v1(nobody, "A", "B")['success'])
+
+
+class NotificationBulkActionTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('bulk_notify_customer')
+        self.other = self.create_user('bulk_notify_other')
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.bulk_create(
+                [Notification(user=self.customer, title="Đơn hàng", message=f"Đơn {i}", notification_type='order') for i in range(3)]
+                + [Notification(user=self.customer, title="Khuyến mãi", message=f"Ưu đãi {i}", notification_type='promotion') for i in range(2)]
+                + [Notification(user=self.other, title="Đơn hàng", message="Đơn của người khác", notification_type='order')]
+            )
+        self.own_ids = list(Notification.objects.filter(user=self.customer).order_by('id').values_list('id', flat=True))
+        self.other_id = Notification.objects.get(user=self.other).id
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        self.assertEqual(unread_counter.get(self.customer.id), 5)
+        self.assertEqual(unread_counter.get(self.other.id), 1)
+
+    def post(self, action, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f"/notifications/{action}/", data, format='json')
+
+    def assertOtherUntouched(self):
+        self.assertFalse(Notification.objects.get(id=self.other_id).is_read)
+        self.assertEqual(unread_counter.get(self.other.id), 1)
+
+    def test_mark_read_scoped_to_owner_without_saves(self):
+        receiver = mock.Mock()
+        post_save.connect(receiver, sender=Notification)
+        self.addCleanup(post_save.disconnect, receiver, sender=Notification)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/notifications/mark-read/', {'ids': self.own_ids[:2] + [self.other_id]}, format='json')
+        self.assertEqual(response.data, {'updated_count': 2})
+        receiver.assert_not_called()
+        # Một câu UPDATE duy nhất, không SELECT từng bản ghi (SAVEPOINT của atomic không tính)
+        statements = [query['sql'].split()[0].upper() for query in queries if 'SAVEPOINT' not in query['sql'].upper()]
+        self.assertEqual(statements, ['UPDATE'])
+        # Gọi lại với cùng ids không đếm trùng
+        self.assertEqual(self.post('mark-read', {'ids': self.own_ids[:2]}).data, {'updated_count': 0})
+        self.assertOtherUntouched()
+
+    def test_mark_read_updates_unread_counter(self):
+        self.post('mark-read', {'ids': self.own_ids[:2]})
+        self.assertEqual(unread_counter.get(self.customer.id), 3)
+        self.assertEqual(unread_counter.get(self.customer.id), Notification.objects.filter(user=self.customer, is_read=False).count())
+
+    def test_mark_read_rejects_invalid_ids(self):
+        for ids in [[], ['1'], [True], 5, None]:
+            with self.subTest(ids=ids):
+                self.assertEqual(self.post('mark-read', {'ids': ids}).status_code, 400)
+
+    def test_mark_all_read_with_type_filter(self):
+        response = self.post('mark-all-read', {'notification_type': 'promotion'})
+        self.assertEqual(response.data, {'updated_count': 2})
+        self.assertEqual(unread_counter.get(self.customer.id), 3)
+        response = self.post('mark-all-read', {})
+        self.assertEqual(response.data, {'updated_count': 3})
+        self.assertEqual(unread_counter.get(self.customer.id), 0)
+        self.assertOtherUntouched()
+
+    def test_mark_all_read_rejects_bad_before(self):
+        self.assertEqual(self.post('mark-all-read', {'before': 'hôm qua'}).status_code, 400)
+        self.assertEqual(self.post('mark-all-read', {'before': '2000-01-01'}).data, {'updated_count': 0})
+
+    def test_bulk_delete_scoped_to_owner(self):
+        self.post('mark-read', {'ids': self.own_ids[:1]})
+        response = self.post('bulk-delete', {'ids': self.own_ids[:3] + [self.other_id]})
+        self.assertEqual(response.data, {'deleted_count': 3})
+        self.assertEqual(unread_counter.get(self.customer.id), 2)
+        self.assertTrue(Notification.objects.filter(id=self.other_id).exists())
+        self.assertOtherUntouched()
+
+    def test_bulk_delete_read_only(self):
+        self.post('mark-read', {'ids': self.own_ids[:2]})
+        Notification.objects.filter(id=self.other_id).update(is_read=True)
+        response = self.post('bulk-delete', {'read_only': True})
+        self.assertEqual(response.data, {'deleted_count': 2})
+        self.assertEqual(Notification.objects.filter(user=self.customer).count(), 3)
+        self.assertEqual(unread_counter.get(self.customer.id), 3)
+        self.assertTrue(Notification.objects.filter(id=self.other_id).exists())
+        self.assertEqual(self.post('bulk-delete', {}).status_code, 400)
+
+
+class DeviceTokenRegistryTests(CoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = self.create_user('token_customer')
+        self.other = self.create_user('token_other')
+
+    def register(self, user, token):
+        with self.captureOnCommitCallbacks(execute=True):
+            return device_token_registry.register(user, token)
+
+    def test_tokens_cached_until_register(self):
+        self.register(self.customer, 'tok-a')
+        self.assertEqual(device_token_registry.tokens_for(self.customer.id), ['tok-a'])
+        with self.assertNumQueries(0):
+            self.assertEqual(device_token_registry.tokens_for(self.customer.id), ['tok-a'])
+        self.register(self.customer, 'tok-b')
+        self.assertEqual(sorted(device_token_registry.tokens_for(self.customer.id)), ['tok-a', 'tok-b'])
+
+    def test_empty_token_list_cached(self):
+        self.assertEqual(device_token_registry.tokens_for(self.customer.id), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(device_token_registry.tokens_for(self.customer.id), [])
+
+    def test_reregistering_same_token_does_not_duplicate(self):
+        _, created = self.register(self.customer, 'tok-a')
+        self.assertTrue(created)
+        _, created = self.register(self.customer, 'tok-a')
+        self.assertFalse(created)
+        self.assertEqual(DeviceToken.objects.filter(token='tok-a').count(), 1)
+
+    def test_token_moves_to_new_user(self):
+        self.register(self.customer, 'tok-shared')
+        self.assertEqual(device_token_registry.tokens_for(self.customer.id), ['tok-shared'])
+        self.register(self.other, 'tok-shared')
+        # Cache của cả user cũ cũng bị xóa khi token chuyển chủ
+        self.assertEqual(device_token_registry.tokens_for(self.customer.id), [])
+        self.assertEqual(device_token_registry.tokens_for(self.other.id), ['tok-shared'])
+
+    @override_settings(MAX_DEVICE_TOKENS_PER_USER=3)
+    def test_tokens_per_user_capped_to_newest(self):
+        for index in range(5):
+            self.register(self.customer, f"tok-{index}")
+        self.assertEqual(
+            set(DeviceToken.objects.filter(user=self.customer).values_list('token', flat=True)), {'tok-2', 'tok-3', 'tok-4'}
+        )
+        self.assertEqual(sorted(device_token_registry.tokens_for(self.customer.id)), ['tok-2', 'tok-3', 'tok-4'])
+
+    def test_bulk_delete_invalidates_cache(self):
+        self.register(self.customer, 'tok-a')
+        self.register(self.other, 'tok-b')
+        device_token_registry.tokens_for_users([self.customer.id, self.other.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            DeviceToken.objects.filter(token__in=['tok-a', 'tok-b']).delete()
+        self.assertEqual(
+            device_token_registry.tokens_for_users([self.customer.id, self.other.id]), {self.customer.id: [], self.other.id: []}
+        )
+
+    def test_tokens_for_users_loads_missing_users_in_one_query(self):
+        self.register(self.customer, 'tok-a')
+        self.register(self.other, 'tok-b')
+        device_token_registry.tokens_for(self.customer.id)
+        with self.assertNumQueries(1):
+            tokens = device_token_registry.tokens_for_users([self.customer.id, self.other.id, self.other.id])
+        self.assertEqual(tokens, {self.customer.id: ['tok-a'], self.other.id: ['tok-b']})
+
+    @mock.patch('core.tasks.DEVICE_TOKEN_PRUNE_CHUNK', 2)
+    def test_prune_job_checks_in_batches_and_deletes_dead_tokens(self):
+        for index in range(5):
+            DeviceToken.objects.create(user=self.customer if index % 2 else self.other, token=f"tok-{index}")
+        with mock.patch('core.tasks.find_invalid_device_tokens', side_effect=lambda tokens: [t for t in tokens if t in {'tok-1', 'tok-4'}]) as find:
+            self.assertEqual(prune_invalid_device_tokens(), 2)
+        self.assertEqual([len(call.args[0]) for call in find.call_args_list], [2, 2, 1])
+        self.assertEqual(set(DeviceToken.objects.values_list('token', flat=True)), {'tok-0', 'tok-2', 'tok-3'})
+
+    @mock.patch('core.views.send_welcome_push.delay')
+    def test_fcm_token_endpoint_registers_and_defers_welcome_push(self, delay):
+        client = APIClient()
+        client.force_authenticate(self.customer)
+        self.assertEqual(client.post('/users/fcm_token/', {}, format='json').status_code, 400)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post('/users/fcm_token/', {'token': 'tok-app', 'device_type': 'ios'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        delay.assert_called_once_with('tok-app')
+        self.assertEqual(DeviceToken.objects.get(user=self.customer).device_type, 'ios')
@@ -22,6 +22,11 @@ urlpatterns = [
     path('ping/', views.ping_view, name='ping'),
     path('statistics/', views.system_statistics, name='system-statistics'),
     path('distributor-statistics/', views.distributor_revenue_statistics, name='distributor-statistics'),
+    path('exports/orders/', views.export_orders, name='export-orders'),
+    path('exports/payments/', views.export_payments, name='export-payments'),
+    path('exports/inventory/', views.export_inventory, name='export-inventory'),
+    path('stripe/webhook/', views.stripe_webhook, name='stripe-webhook'),
+    path('payments/<int:pk>/status/', views.payment_status_longpoll, name='payment-status'),
     path('success/', PaymentViewSet.as_view({'get': 'handle_success'}), name='payment-success'),
     path('cancel/', PaymentViewSet.as_view({'get': 'handle_cancel'}), name='payment-cancel'),
 ]
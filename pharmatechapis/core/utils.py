@@ -2,10 +2,14 @@ import aiohttp
 from django.utils import timezone
 import firebase_admin
 from firebase_admin import auth as admin_auth, messaging, credentials, db
-from asgiref.sync import sync_to_async
+from asgiref.sync import sync_to_async, async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from .models import DeviceToken
+from .device_tokens import device_token_registry
+from .stripe_gateway import stripe_gateway
 import hashlib
 import stripe
 import asyncio
@@ -25,6 +29,16 @@ from llama_index.core import Settings
 import logging
 import time
 import random
+import threading
+import socket
+import uuid
+import json
+import csv
+from functools import wraps
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.response import Response
 
 logger = logging.getLogger(__name__)
 
@@ -72,32 +86,121 @@ def save_message_to_firebase(user_id, conversation_id, message, response):
     except Exception as e:
         return {'success': False, 'message': f"Lỗi khi lưu tin nhắn vào Firebase: {str(e)}"}
 
-async def send_fcm_v1(user, title, body, data=None):
+# --- FCM Utilities ---
+FCM_BATCH_LIMIT = 500  # Giới hạn token/message cho mỗi lời gọi send_each của FCM
+FCM_INVALID_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
+def build_fcm_message(token, title, body, data=None):
+    # FCM chỉ nhận giá trị chuỗi trong data
+    return messaging.Message(
+        notification=messaging.Notification(title=title, body=body),
+        token=token,
+        data={key: str(value) for key, value in (data or {}).items()}
+    )
+
+def send_fcm_messages(messages):
+    """Gửi danh sách Message theo lô 500 bằng send_each; trả về (số gửi thành công, token không còn hợp lệ)."""
+    sent = 0
+    invalid_tokens = []
+    for start in range(0, len(messages), FCM_BATCH_LIMIT):
+        chunk = messages[start:start + FCM_BATCH_LIMIT]
+        try:
+            response = messaging.send_each(chunk)
+        except firebase_admin.exceptions.FirebaseError as e:
+            logger.error(f"Lỗi khi gửi lô FCM: {str(e)}")
+            continue
+        sent += response.success_count
+        invalid_tokens.extend(
+            message.token for message, result in zip(chunk, response.responses)
+            if not result.success and isinstance(result.exception, FCM_INVALID_TOKEN_ERRORS)
+        )
+    return sent, invalid_tokens
+
+def prune_device_tokens(tokens):
+    """Xóa các token FCM không còn hợp lệ bằng một câu DELETE."""
+    if tokens:
+        DeviceToken.objects.filter(token__in=tokens).delete()
+
+def send_fcm_multicast(tokens, title, body, data=None, prune=True):
+    """
+    Gửi cùng một thông báo tới nhiều token bằng send_each_for_multicast (500 token mỗi lời gọi).
+    prune=False để không chạm DB (khi gọi từ thread pool), người gọi tự xóa các token không hợp lệ trả về.
+    """
+    data = {key: str(value) for key, value in (data or {}).items()}
+    sent = 0
+    invalid_tokens = []
+    for start in range(0, len(tokens), FCM_BATCH_LIMIT):
+        chunk = tokens[start:start + FCM_BATCH_LIMIT]
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            tokens=chunk,
+            data=data
+        )
+        try:
+            response = messaging.send_each_for_multicast(message)
+        except firebase_admin.exceptions.FirebaseError as e:
+            logger.error(f"Lỗi khi gửi FCM multicast: {str(e)}")
+            continue
+        sent += response.success_count
+        invalid_tokens.extend(
+            token for token, result in zip(chunk, response.responses)
+            if not result.success and isinstance(result.exception, FCM_INVALID_TOKEN_ERRORS)
+        )
+    if prune:
+        prune_device_tokens(invalid_tokens)
+    return sent, invalid_tokens
+
+def send_fcm_v1(user, title, body, data=None):
+    """Gửi push tới mọi thiết bị của user (đồng bộ, dùng được trực tiếp trong Celery task và view)."""
     try:
-        tokens = await sync_to_async(lambda: list(DeviceToken.objects.filter(user=user)))()
+        tokens = device_token_registry.tokens_for(user.pk)
         if not tokens:
             return {'success': False, 'message': 'Không tìm thấy token thiết bị.'}
-        invalid_tokens = []
-        for token in tokens:
-            try:
-                message = messaging.Message(
-                    notification=messaging.Notification(
-                        title=title,
-                        body=body,
-                    ),
-                    token=token.token,
-                    data=data
-                )
-                await sync_to_async(messaging.send)(message)
-            except messaging.FirebaseError as e:
-                if 'not-registered' in str(e):
-                    invalid_tokens.append(token.token)
-        if invalid_tokens:
-            await sync_to_async(DeviceToken.objects.filter(token__in=invalid_tokens).delete)()
-        return {'success': True, 'message': 'Thông báo đã được gửi.'}
+        sent, invalid_tokens = send_fcm_multicast(tokens, title, body, data)
+        return {'success': True, 'message': 'Thông báo đã được gửi.', 'sent': sent, 'invalid_tokens': len(invalid_tokens)}
     except Exception as e:
         return {'success': False, 'message': f"Lỗi khi gửi FCM: {str(e)}"}
 
+async def asend_fcm_v1(user, title, body, data=None):
+    """Phiên bản async của send_fcm_v1 cho WebSocket consumer."""
+    return await sync_to_async(send_fcm_v1)(user, title, body, data)
+
+def send_fcm_batch(pushes):
+    """
+    Gửi nhiều push có nội dung khác nhau: lấy token của mọi user từ cache (một MGET), gửi bằng send_each
+    theo lô 500 message và xóa token không hợp lệ một lần. pushes: [{'user_id', 'title', 'body', 'data'}].
+    """
+    tokens_by_user = device_token_registry.tokens_for_users([push['user_id'] for push in pushes])
+    messages = [
+        build_fcm_message(token, push['title'], push['body'], push.get('data'))
+        for push in pushes
+        for token in tokens_by_user.get(push['user_id'], [])
+    ]
+    sent, invalid_tokens = send_fcm_messages(messages)
+    prune_device_tokens(invalid_tokens)
+    return {'success': True, 'sent': sent, 'invalid_tokens': len(invalid_tokens)}
+
+def find_invalid_device_tokens(tokens):
+    """
+    Kiểm tra token bằng send_each_for_multicast(dry_run=True) theo lô 500: FCM xác thực token
+    nhưng không gửi gì tới thiết bị. Trả về các token đã bị gỡ đăng ký hoặc thuộc project khác.
+    """
+    invalid_tokens = []
+    for start in range(0, len(tokens), FCM_BATCH_LIMIT):
+        chunk = tokens[start:start + FCM_BATCH_LIMIT]
+        # Chỉ có data (không notification) để kể cả khi không dry-run thiết bị cũng không hiển thị gì
+        message = messaging.MulticastMessage(tokens=chunk, data={'type': 'token_check'})
+        try:
+            response = messaging.send_each_for_multicast(message, dry_run=True)
+        except firebase_admin.exceptions.FirebaseError as e:
+            logger.error(f"Lỗi khi kiểm tra token FCM: {str(e)}")
+            continue
+        invalid_tokens.extend(
+            token for token, result in zip(chunk, response.responses)
+            if not result.success and isinstance(result.exception, FCM_INVALID_TOKEN_ERRORS)
+        )
+    return invalid_tokens
+
 def get_messages_from_firebase(conversation_id, user_id, limit=50):
     try:
         ref = db.reference(f'chat_messages/{conversation_id}')
@@ -145,11 +248,9 @@ def extract_main_guidance(response_text):
     return guidance
 
 # --- Stripe Utilities ---
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
 def create_stripe_checkout_session(order, user):
     try:
-        session = stripe.checkout.Session.create(
+        session = stripe_gateway.create_checkout_session(
             payment_method_types=['card'],
             line_items=[
                 {
@@ -158,7 +259,7 @@ def create_stripe_checkout_session(order, user):
                         'product_data': {
                             'name': f"Đơn hàng {order.order_code}",
                         },
-                        'unit_amount': int(order.total_amount),
+                        'unit_amount': int(order.grand_total),
                     },
                     'quantity': 1,
                 },
@@ -182,15 +283,266 @@ def create_stripe_checkout_session(order, user):
 
 def process_stripe_refund(payment):
     try:
-        refund = stripe.Refund.create(
-            payment_intent=payment.transaction_id,
-            amount=int(float(payment.amount) * 100),
+        payment_intent = payment.transaction_id
+        if payment_intent.startswith('cs_'):
+            # transaction_id lưu Checkout Session id, Refund cần PaymentIntent tương ứng
+            payment_intent = stripe_gateway.retrieve_checkout_session(payment_intent).payment_intent
+        refund = stripe_gateway.create_refund(
+            idempotency_key=f"refund-{payment.id}",
+            payment_intent=payment_intent,
+            amount=int(payment.amount),  # VND là đơn vị không có phần thập phân trên Stripe, khớp unit_amount khi tạo session
             reason='requested_by_customer',
         )
         return {'success': True, 'refund_id': refund.id}
     except stripe.error.StripeError as e:
         return {'success': False, 'message': f"Lỗi khi hoàn tiền: {str(e)}"}
 
+# --- Order Code Utilities ---
+ORDER_CODE_EPOCH_MS = 1735689600000  # 2025-01-01 00:00:00 UTC
+ORDER_CODE_WORKER_BITS = 10
+ORDER_CODE_SEQUENCE_BITS = 12
+ORDER_CODE_WORKER_LEASE = 24 * 3600
+
+class OrderCodeGenerator:
+    """
+    Sinh order_code kiểu Snowflake: mili-giây kể từ ORDER_CODE_EPOCH_MS | worker id | số thứ tự.
+    Worker id được cấp cho mỗi process qua Redis (lease có TTL, giá trị là token riêng của process),
+    sau đó mọi mã được sinh hoàn toàn trong bộ nhớ, không cần truy vấn DB. Giá trị tối đa < 2^63
+    nên mã luôn có tối đa 19 chữ số (vừa max_length=20 của Order.order_code).
+    """
+    max_worker_id = (1 << ORDER_CODE_WORKER_BITS) - 1
+    max_sequence = (1 << ORDER_CODE_SEQUENCE_BITS) - 1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = None
+        self._lease_token = None
+        self._lease_renewed_at = 0
+        self._last_ms = -1
+        self._sequence = 0
+
+    def _lease_key(self, worker_id):
+        return f'order_code:worker:{worker_id}'
+
+    def _claim_worker_id(self):
+        """Giành một worker id còn trống bằng SET NX trên Redis, bắt đầu từ bộ đếm chung."""
+        cache.add('order_code:worker_counter', 0, timeout=None)
+        start = cache.incr('order_code:worker_counter')
+        for offset in range(self.max_worker_id + 1):
+            worker_id = (start + offset) & self.max_worker_id
+            if cache.add(self._lease_key(worker_id), self._lease_token, timeout=ORDER_CODE_WORKER_LEASE):
+                return worker_id
+        raise RuntimeError("Không còn worker id trống để sinh mã đơn hàng.")
+
+    def _renew_lease(self):
+        """Gia hạn lease; False nếu lease đã mất (hết hạn, bị Redis xóa hoặc đã thuộc process khác)."""
+        key = self._lease_key(self._worker_id)
+        return cache.get(key) == self._lease_token and cache.touch(key, ORDER_CODE_WORKER_LEASE)
+
+    def _ensure_worker(self):
+        # Process con sau fork (Celery prefork, gunicorn) phải nhận worker id riêng
+        pid = os.getpid()
+        now = time.monotonic()
+        elapsed = now - self._lease_renewed_at
+        if self._pid != pid:
+            lost = True
+            # Token gồm hostname để pid trùng nhau giữa các container không bị coi là cùng process
+            self._lease_token = f"{socket.gethostname()}:{pid}:{uuid.uuid4().hex}"
+        elif elapsed >= ORDER_CODE_WORKER_LEASE * 0.9:
+            # Process ngồi yên gần hết lease: có thể lease đã hết hạn và id đã được cấp cho process khác
+            lost = True
+        elif elapsed > ORDER_CODE_WORKER_LEASE / 2:
+            lost = not self._renew_lease()
+            if lost:
+                logger.warning(f"Order code worker id {self._worker_id} lease lost, claiming a new one")
+        else:
+            return
+        if lost:
+            self._worker_id = self._claim_worker_id()
+            self._pid = pid
+            self._last_ms = -1
+            self._sequence = 0
+        self._lease_renewed_at = now
+
+    def next_code(self):
+        with self._lock:
+            self._ensure_worker()
+            # Dùng đồng hồ logic: không lùi khi đồng hồ hệ thống bị chỉnh ngược,
+            # và mượn mili-giây kế tiếp khi hết số thứ tự thay vì chờ.
+            now_ms = max(int(time.time() * 1000), self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & self.max_sequence
+                if self._sequence == 0:
+                    now_ms = self._last_ms + 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            code = (
+                ((now_ms - ORDER_CODE_EPOCH_MS) << (ORDER_CODE_WORKER_BITS + ORDER_CODE_SEQUENCE_BITS))
+                | (self._worker_id << ORDER_CODE_SEQUENCE_BITS)
+                | self._sequence
+            )
+            return str(code)
+
+order_code_generator = OrderCodeGenerator()
+
+def generate_order_code():
+    """Sinh order_code duy nhất trên mọi process Daphne/Celery."""
+    return order_code_generator.next_code()
+
+# --- Idempotency Utilities ---
+IDEMPOTENCY_LOCK_TIMEOUT = 30
+IDEMPOTENCY_WAIT_TIMEOUT = 10
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+
+def idempotent_request(scope):
+    """
+    Decorator cho action của ViewSet hỗ trợ header Idempotency-Key.
+    Response đầu tiên (status < 500) được lưu trong Redis theo user + key trong
+    IDEMPOTENCY_KEY_TTL giây; request trùng lặp chạy song song sẽ chờ trên một khóa
+    ngắn rồi nhận lại response đã lưu thay vì chạy lại toàn bộ transaction.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(self, request, *args, **kwargs):
+            idempotency_key = request.headers.get('Idempotency-Key')
+            if not idempotency_key:
+                return view_func(self, request, *args, **kwargs)
+            if len(idempotency_key) > 255:
+                return Response({'error': 'Idempotency-Key quá dài (tối đa 255 ký tự).'}, status=status.HTTP_400_BAD_REQUEST)
+
+            key_hash = hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()
+            cache_key = f"idempotency:{scope}:{request.user.pk}:{key_hash}"
+            lock_key = f"{cache_key}:lock"
+            fingerprint = hashlib.sha256(
+                json.dumps(request.data, sort_keys=True, default=str).encode('utf-8')
+            ).hexdigest()
+
+            def replay(stored):
+                if stored['fingerprint'] != fingerprint:
+                    return Response(
+                        {'error': 'Idempotency-Key đã được dùng cho một request khác.'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                    )
+                response = Response(stored['data'], status=stored['status'])
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            stored = cache.get(cache_key)
+            if stored is not None:
+                return replay(stored)
+
+            if not cache.add(lock_key, 1, timeout=IDEMPOTENCY_LOCK_TIMEOUT):
+                # Một request khác cùng key đang xử lý: chờ kết quả của nó
+                deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+                while time.monotonic() < deadline:
+                    time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+                    stored = cache.get(cache_key)
+                    if stored is not None:
+                        return replay(stored)
+                return Response(
+                    {'error': 'Request với Idempotency-Key này đang được xử lý, vui lòng thử lại sau.'},
+                    status=status.HTTP_409_CONFLICT
+                )
+
+            try:
+                response = view_func(self, request, *args, **kwargs)
+                if response.status_code < 500:
+                    cache.set(cache_key, {
+                        'fingerprint': fingerprint,
+                        'status': response.status_code,
+                        'data': response.data,
+                    }, timeout=settings.IDEMPOTENCY_KEY_TTL)
+                return response
+            finally:
+                cache.delete(lock_key)
+        return wrapper
+    return decorator
+
+# --- Channels Utilities ---
+def order_status_group(user_id):
+    return f"order_status_{user_id}"
+
+def send_to_group(group_name, message_type, payload):
+    """Đẩy một sự kiện tới channel-layer group từ code đồng bộ (view, Celery task)."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(group_name, {'type': message_type, 'payload': payload})
+    except Exception as e:
+        logger.error(f"Lỗi khi gửi sự kiện {message_type} tới group {group_name}: {str(e)}")
+
+PAYMENT_STATUS_TTL = 3600
+
+def payment_status_group(user_id):
+    return f"payment_status_{user_id}"
+
+def payment_status_key(payment_id):
+    return f"payment_status:{payment_id}"
+
+def payment_status_payload(payment):
+    return {
+        'payment_id': payment.id,
+        'order_id': payment.order_id,
+        'status': payment.status,
+        'paid_at': payment.paid_at.isoformat() if payment.paid_at else None,
+        'refunded_at': payment.refunded_at.isoformat() if payment.refunded_at else None,
+    }
+
+def publish_payment_status(payment):
+    """Ghi trạng thái thanh toán mới vào Redis (cho long-poll) và đẩy tới group Channels của user."""
+    payload = payment_status_payload(payment)
+    cache.set(payment_status_key(payment.id), payload, timeout=PAYMENT_STATUS_TTL)
+    send_to_group(payment_status_group(payment.user_id), 'payment.status', payload)
+
+# --- Export Utilities ---
+EXPORT_BATCH_SIZE = 2000
+
+class _EchoBuffer:
+    """Buffer giả cho csv.writer: trả lại chuỗi thay vì ghi vào bộ nhớ."""
+    def write(self, value):
+        return value
+
+async def aiterate_in_batches(queryset, fields, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Duyệt queryset theo từng lô khóa chính tăng dần (keyset), chỉ lấy values_list(fields).
+    Bộ nhớ không phụ thuộc số dòng kể cả trên MySQL, nơi driver đọc toàn bộ kết quả
+    của một câu SELECT về client. Là async generator (mỗi lô đọc qua sync_to_async) vì dưới
+    Daphne/ASGI, StreamingHttpResponse gom iterator đồng bộ bằng sync_to_async(list) trước khi gửi.
+    """
+    last_pk = None
+    while True:
+        batch_queryset = queryset.order_by('pk')
+        if last_pk is not None:
+            batch_queryset = batch_queryset.filter(pk__gt=last_pk)
+        rows = await sync_to_async(list)(batch_queryset.values_list('pk', *fields)[:batch_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:]
+        last_pk = rows[-1][0]
+
+def stream_export_response(header, rows, export_format, filename):
+    """Trả về StreamingHttpResponse dạng CSV hoặc NDJSON từ async iterator các tuple (xem aiterate_in_batches)."""
+    if export_format == 'ndjson':
+        async def generate():
+            async for row in rows:
+                yield json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+        response = StreamingHttpResponse(generate(), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="{filename}.ndjson"'
+        return response
+
+    writer = csv.writer(_EchoBuffer())
+    async def generate():
+        yield writer.writerow(header)
+        async for row in rows:
+            yield writer.writerow(row)
+    response = StreamingHttpResponse(generate(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
 # --- Password Reset Utility ---
 def generate_reset_code(uidb64, token):
     combined = f"{uidb64}{token}".encode('utf-8')
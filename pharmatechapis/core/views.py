@@ -5,28 +5,34 @@ from rest_framework.filters import SearchFilter, OrderingFilter
 from django_filters import rest_framework as filters
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Sum, Count, Avg, Exists, OuterRef
+from django.db.models import Sum, Count, Avg, Exists, OuterRef, F, DecimalField, Prefetch
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404
-from django.core.mail import send_mail
 from django.core.cache import cache
 from django.conf import settings
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from .models import User, Product, Cart, CartItem, Order, OrderItem, Payment, DeviceToken, Category, Inventory, Notification, Review, ReviewReply, Discount
+from django.views.decorators.http import require_POST
+from .models import User, Product, Cart, CartItem, Order, OrderItem, Payment, DeviceToken, Category, Inventory, Notification, Review, ReviewReply, Discount, StripeEvent, PromotionCampaign
 from .serializers import (
     UserSerializer, UserDetailSerializer, ProductSerializer, CartSerializer,
     CartItemSerializer, OrderSerializer, OrderItemSerializer, PaymentSerializer,
     DeviceTokenSerializer, AdminProductApprovalSerializer, CategorySerializer, InventorySerializer,
-    PasswordResetSerializer, ChangePasswordSerializer, DiscountSerializer, NotificationSerializer, ReviewSerializer, ReviewReplySerializer
+    PasswordResetSerializer, ChangePasswordSerializer, DiscountSerializer, NotificationSerializer, ReviewSerializer, ReviewReplySerializer,
+    PromotionCampaignSerializer
 )
 from .permissions import (
     IsCustomer, IsDistributor, IsAdmin, IsCartOwner, IsOrderOwner, IsProductOwner, IsInventoryManager, IsCategoryManager, IsPaymentManager, IsConversationViewer, IsNotificationOwner, IsReviewOwner, IsAdminOrDistributor
 )
 from rest_framework.permissions import AllowAny
 from .paginators import ItemPaginator
-from .utils import send_fcm_v1, save_message_to_firebase, generate_reset_code, create_stripe_checkout_session, process_stripe_refund
-from .authentication import CustomOAuth2Authentication
+from .discounts import get_discount_by_code, rank_discounts
+from .stripe_gateway import stripe_gateway
+from .notifications import unread_counter
+from .device_tokens import device_token_registry
+from .utils import send_fcm_v1, save_message_to_firebase, generate_reset_code, create_stripe_checkout_session, process_stripe_refund, idempotent_request, generate_order_code, aiterate_in_batches, stream_export_response, publish_payment_status, payment_status_payload, payment_status_key, payment_status_group
+from .authentication import CustomOAuth2Authentication, authenticate_http_request
 from django.http import JsonResponse, HttpResponse
 import uuid
 import hashlib
@@ -38,15 +44,22 @@ from django.test import RequestFactory
 from .utils import call_gemini_api, save_message_to_firebase, send_fcm_v1
 import pyrebase
 import stripe
-from .tasks import send_payment_confirmation_email, notify_product_approval
+from .tasks import notify_product_approval, apply_session_outcome, place_order_async, publish_order_status, dispatch_order_transition, schedule_stripe_event_processing, enqueue_refunds, fan_out_promotion, queue_email, send_welcome_push
+from celery import chain
+from django.db import transaction
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.dateparse import parse_date
 from django.utils.encoding import force_bytes, force_str
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from decimal import Decimal
 import logging
 import socket
+import asyncio
+import time
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
 from firebase_admin import db
 
 
@@ -79,10 +92,9 @@ def ping_view(request):
 @api_view(['GET'])
 @permission_classes([IsAdmin])
 def system_statistics(request):
-    orders = Order.objects.prefetch_related('items')
-    total_revenue = sum(order.total_amount for order in orders)
+    total_revenue = Order.objects.aggregate(total=Sum('grand_total'))['total'] or Decimal('0.00')
     total_users = User.objects.count()
-    total_orders = orders.count()
+    total_orders = Order.objects.count()
     pending_products = Product.objects.filter(is_approved=False).count()
 
     # ✅ Sửa đoạn này:
@@ -96,7 +108,7 @@ def system_statistics(request):
     valid_discount_count = Discount.objects.filter(is_active=True).count()
     review_count = Review.objects.count()
     avg_rating = Review.objects.aggregate(avg_rating=Avg('rating'))['avg_rating'] or 0
-    unread_notification_count = Notification.objects.filter(is_read=False).count()
+    unread_notification_count = unread_counter.get_total()
 
     return Response({
         'total_users': total_users,
@@ -142,6 +154,186 @@ def distributor_revenue_statistics(request):
         'trending_products': list(trending_products),
     })
 
+# Streaming Exports
+def get_export_params(request):
+    """Đọc bộ lọc chung cho các endpoint export: export_format, date_from, date_to, status, distributor."""
+    params = request.query_params
+    export_format = params.get('export_format', 'csv')
+    if export_format not in ['csv', 'ndjson']:
+        raise serializers.ValidationError({'export_format': "Chỉ hỗ trợ 'csv' hoặc 'ndjson'."})
+
+    dates = {}
+    for name in ['date_from', 'date_to']:
+        value = params.get(name)
+        if value:
+            try:
+                dates[name] = parse_date(value)
+            except ValueError:
+                dates[name] = None
+            if dates[name] is None:
+                raise serializers.ValidationError({name: "Ngày không hợp lệ, định dạng YYYY-MM-DD."})
+
+    # Nhà phân phối chỉ được export dữ liệu của chính mình
+    if request.user.role == 'distributor':
+        distributor_id = request.user.id
+    else:
+        distributor_id = params.get('distributor')
+        if distributor_id:
+            try:
+                distributor_id = int(distributor_id)
+            except ValueError:
+                raise serializers.ValidationError({'distributor': "distributor phải là id số nguyên."})
+
+    return {
+        'export_format': export_format,
+        'date_from': dates.get('date_from'),
+        'date_to': dates.get('date_to'),
+        'status': params.get('status'),
+        'distributor_id': distributor_id,
+    }
+
+def filter_distributor_only_orders(queryset, distributor_id, order_field='pk'):
+    """Giữ các bản ghi có đơn hàng (qua order_field) mà mọi sản phẩm đều thuộc nhà phân phối distributor_id."""
+    return queryset.filter(
+        Exists(OrderItem.objects.filter(order=OuterRef(order_field), product__distributor_id=distributor_id))
+    ).exclude(
+        Exists(OrderItem.objects.filter(order=OuterRef(order_field)).exclude(product__distributor_id=distributor_id))
+    )
+
+def filter_export_dates(queryset, field, export_params):
+    if export_params['date_from']:
+        queryset = queryset.filter(**{f'{field}__date__gte': export_params['date_from']})
+    if export_params['date_to']:
+        queryset = queryset.filter(**{f'{field}__date__lte': export_params['date_to']})
+    return queryset
+
+@api_view(['GET'])
+@permission_classes([IsAdminOrDistributor])
+def export_orders(request):
+    """Export đơn hàng kèm từng dòng sản phẩm (một dòng cho mỗi OrderItem)."""
+    export_params = get_export_params(request)
+    queryset = filter_export_dates(OrderItem.objects.all(), 'order__created_at', export_params)
+    if export_params['status']:
+        queryset = queryset.filter(order__status=export_params['status'])
+    if export_params['distributor_id']:
+        queryset = queryset.filter(product__distributor_id=export_params['distributor_id'])
+
+    header = ['order_id', 'order_code', 'customer', 'order_status', 'order_created_at', 'items_subtotal',
+              'discount_amount', 'grand_total', 'product_id', 'product_name', 'quantity', 'price']
+    fields = ['order_id', 'order__order_code', 'order__user__username', 'order__status', 'order__created_at',
+              'order__items_subtotal', 'order__discount_amount', 'order__grand_total', 'product_id',
+              'product__name', 'quantity', 'price']
+    return stream_export_response(header, aiterate_in_batches(queryset, fields), export_params['export_format'], 'orders')
+
+@api_view(['GET'])
+@permission_classes([IsAdminOrDistributor])
+def export_payments(request):
+    """Export thanh toán."""
+    export_params = get_export_params(request)
+    queryset = filter_export_dates(Payment.objects.all(), 'created_at', export_params)
+    if export_params['status']:
+        queryset = queryset.filter(status=export_params['status'])
+    if export_params['distributor_id']:
+        # amount và khách hàng là của cả đơn: chỉ export đơn gồm toàn hàng của nhà phân phối này
+        queryset = filter_distributor_only_orders(queryset, export_params['distributor_id'], 'order_id')
+
+    header = ['payment_id', 'order_code', 'customer', 'amount', 'payment_method', 'status',
+              'transaction_id', 'paid_at', 'refunded_at', 'created_at']
+    fields = ['id', 'order__order_code', 'user__username', 'amount', 'payment_method', 'status',
+              'transaction_id', 'paid_at', 'refunded_at', 'created_at']
+    return stream_export_response(header, aiterate_in_batches(queryset, fields), export_params['export_format'], 'payments')
+
+@api_view(['GET'])
+@permission_classes([IsAdminOrDistributor])
+def export_inventory(request):
+    """Export tồn kho (lọc ngày theo last_updated)."""
+    export_params = get_export_params(request)
+    queryset = filter_export_dates(Inventory.objects.all(), 'last_updated', export_params)
+    if export_params['distributor_id']:
+        queryset = queryset.filter(distributor_id=export_params['distributor_id'])
+
+    header = ['inventory_id', 'product_id', 'product_name', 'distributor_id', 'distributor', 'quantity', 'last_updated']
+    fields = ['id', 'product_id', 'product__name', 'distributor_id', 'distributor__username', 'quantity', 'last_updated']
+    return stream_export_response(header, aiterate_in_batches(queryset, fields), export_params['export_format'], 'inventory')
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    """Nhận webhook Stripe: xác thực chữ ký, lưu sự kiện vào inbox và trả 200 ngay; Celery xử lý sau."""
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        # Secret rỗng thì HMAC với khóa rỗng ai cũng giả được: từ chối mọi sự kiện thay vì tin payload
+        logger.error("STRIPE_WEBHOOK_SECRET is not configured, rejecting Stripe webhook")
+        return HttpResponse(status=503)
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''), settings.STRIPE_WEBHOOK_SECRET
+        )
+    except ValueError:
+        return HttpResponse(status=400)
+    except stripe.error.SignatureVerificationError:
+        logger.warning("Stripe webhook with invalid signature rejected")
+        return HttpResponse(status=400)
+
+    # event_id là unique nên Stripe gửi lại cùng sự kiện sẽ không tạo bản ghi mới
+    _, created = StripeEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={'event_type': event['type'], 'payload': event.to_dict()}
+    )
+    if created:
+        transaction.on_commit(schedule_stripe_event_processing)
+    return HttpResponse(status=200)
+
+PAYMENT_LONG_POLL_TIMEOUT = 25
+
+async def payment_status_longpoll(request, pk):
+    """
+    Long-poll trạng thái thanh toán, dự phòng cho ws/payments/: tham gia group Channels của chủ
+    thanh toán và chờ (không polling) tới khi có trạng thái khác `since` (mặc định pending) hoặc hết
+    `timeout` giây. View async nên không giữ thread worker khi chờ.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Method not allowed.'}, status=405)
+    user = await sync_to_async(authenticate_http_request)(request)
+    if user is None:
+        return JsonResponse({'error': 'Chưa xác thực.'}, status=401)
+
+    payments = Payment.objects.filter(pk=pk)
+    if user.role != 'admin':
+        payments = payments.filter(user=user)
+    payment = await payments.afirst()
+    if payment is None:
+        return JsonResponse({'error': 'Không tìm thấy thanh toán.'}, status=404)
+
+    since = request.GET.get('since', 'pending')
+    try:
+        timeout = min(float(request.GET.get('timeout', PAYMENT_LONG_POLL_TIMEOUT)), PAYMENT_LONG_POLL_TIMEOUT)
+    except ValueError:
+        timeout = PAYMENT_LONG_POLL_TIMEOUT
+    payload = payment_status_payload(payment)
+    channel_layer = get_channel_layer()
+    if payload['status'] == since and timeout > 0 and channel_layer is not None:
+        group_name = payment_status_group(payment.user_id)
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(group_name, channel_name)
+        try:
+            # Trạng thái có thể đổi giữa lúc đọc DB và lúc vào group: đọc lại key Redis sau khi đã đăng ký
+            payload = await sync_to_async(cache.get, thread_sensitive=False)(payment_status_key(payment.id)) or payload
+            deadline = time.monotonic() + timeout
+            while payload['status'] == since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(channel_layer.receive(channel_name), remaining)
+                except asyncio.TimeoutError:
+                    break
+                # Group của user nhận sự kiện của mọi thanh toán của họ, chỉ lấy đúng thanh toán đang chờ
+                if message.get('payload', {}).get('payment_id') == payment.id:
+                    payload = message['payload']
+        finally:
+            await channel_layer.group_discard(group_name, channel_name)
+    return JsonResponse({**payload, 'changed': payload['status'] != since})
+
 # User ViewSet
 class UserViewSet(viewsets.ViewSet, generics.CreateAPIView, generics.ListAPIView):
     authentication_classes = [CustomOAuth2Authentication]
@@ -239,18 +431,8 @@ class UserViewSet(viewsets.ViewSet, generics.CreateAPIView, generics.ListAPIView
         if not token:
             return Response({'error': 'Thiếu token thiết bị.'}, status=status.HTTP_400_BAD_REQUEST)
         
-        DeviceToken.objects.update_or_create(
-            user=request.user,
-            token=token,
-            defaults={'device_type': device_type, 'updated_at': timezone.now()}
-        )
-        
-        send_fcm_v1(
-            request.user,
-            title="Chào mừng bạn!",
-            body="Đăng nhập thành công. Bạn sẽ nhận thông báo từ hệ thống.",
-            data={"type": "welcome"}
-        )
+        device_token_registry.register(request.user, token, device_type)
+        transaction.on_commit(lambda: send_welcome_push.delay(token))
         return Response({'message': 'Token thiết bị đã được lưu.'}, status=status.HTTP_200_OK)
 
     @action(methods=['post'], detail=False, url_path='password-reset-request')
@@ -274,12 +456,10 @@ class UserViewSet(viewsets.ViewSet, generics.CreateAPIView, generics.ListAPIView
         cache.set(cache_key, {'uidb64': uidb64, 'token': token, 'code': code}, timeout=1800)
 
         # Gửi email chứa mã code
-        send_mail(
+        queue_email(
             subject="Đặt lại mật khẩu",
-            message=f"Kính gửi {user.username},\n\nMã xác nhận đặt lại mật khẩu của bạn là: {code}\n\nVui lòng sử dụng mã này để đặt lại mật khẩu.\n\nTrân trọng!",
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[user.email],
-            fail_silently=False,
+            body=f"Kính gửi {user.username},\n\nMã xác nhận đặt lại mật khẩu của bạn là: {code}\n\nVui lòng sử dụng mã này để đặt lại mật khẩu.\n\nTrân trọng!",
+            to_email=user.email,
         )
         return Response({'message': 'Password reset code sent to email.'}, status=status.HTTP_200_OK)
 
@@ -513,25 +693,109 @@ class OrderViewSet(viewsets.ViewSet, generics.ListCreateAPIView, generics.Retrie
 
     def get_queryset(self):
         if self.request.user.is_authenticated:
-            return self.queryset.filter(user=self.request.user)
+            queryset = self.queryset.filter(user=self.request.user)
+            if self.action in ['list', 'retrieve', 'history']:
+                if self.request.query_params.get('expand') == 'product':
+                    # Tồn kho tính sẵn bằng annotate để ProductSerializer không aggregate riêng cho từng dòng
+                    queryset = queryset.prefetch_related(Prefetch(
+                        'items__product',
+                        queryset=Product.objects.select_related('distributor', 'category').annotate(
+                            stock_total=Coalesce(Sum('inventory__quantity'), 0)
+                        ),
+                    ))
+                else:
+                    queryset = queryset.prefetch_related('items__product')
+            return queryset
         return self.queryset.none()
 
+    @idempotent_request('order-create')
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
         return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['post'], url_path='place-async')
+    @idempotent_request('order-place-async')
+    def place_async(self, request):
+        """Đặt hàng bất đồng bộ: kiểm tra nhanh, trả về 202 và để Celery xử lý phần transaction."""
+        cart_id = request.data.get('cart_id')
+        if not cart_id:
+            return Response({'error': 'cart_id là bắt buộc.'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.get_serializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+
+        order = Order.objects.create(user=request.user, order_code=generate_order_code(), status='placing')
+        discount_code = request.data.get('discount_code')
+        transaction.on_commit(lambda: chain(
+            place_order_async.s(order.id, cart_id, discount_code),
+            publish_order_status.s()
+        ).apply_async())
+
+        return Response({
+            'order_id': order.id,
+            'order_code': order.order_code,
+            'status': order.status,
+        }, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'], url_path='status')
+    def order_status(self, request, pk=None):
+        """Trạng thái đơn hàng rút gọn để client poll trong khi đơn đang được đặt."""
+        order = get_object_or_404(self.get_queryset().only('id', 'order_code', 'status', 'updated_at'), pk=pk)
+        return Response({
+            'order_id': order.id,
+            'order_code': order.order_code,
+            'status': order.status,
+            'updated_at': order.updated_at,
+        })
+
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
         order = self.get_object()
-        if order.status != 'pending':
+        if not order.can_transition_to('cancelled'):
             return Response({'message': 'Order cannot be cancelled.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        order.status = 'cancelled'
-        order.save()
+        with transaction.atomic():
+            # Signal handle_order_cancellation hoàn kho và xếp yêu cầu hoàn tiền trong cùng transaction
+            order.status = 'cancelled'
+            order.save()
         return Response({'message': 'Order cancelled.'})
 
+    @action(detail=False, methods=['post'], url_path='bulk-transition', permission_classes=[IsAdminOrDistributor])
+    def bulk_transition(self, request):
+        """Chuyển trạng thái hàng loạt cho danh sách order_ids (admin, nhà phân phối)."""
+        order_ids = request.data.get('order_ids')
+        target_status = request.data.get('status')
+        if not isinstance(order_ids, list) or not order_ids:
+            return Response({'error': 'order_ids phải là một danh sách không rỗng.'}, status=status.HTTP_400_BAD_REQUEST)
+        # JSON có thể chứa "5" thay vì 5: chuẩn hóa về int để so khớp với id trả về từ DB
+        if not all(isinstance(order_id, (int, str)) and not isinstance(order_id, bool) and str(order_id).isdigit() for order_id in order_ids):
+            return Response({'error': 'order_ids chỉ được chứa số nguyên dương.'}, status=status.HTTP_400_BAD_REQUEST)
+        order_ids = [int(order_id) for order_id in order_ids]
+        # Đích hợp lệ lấy từ Order.STATUS_TRANSITIONS; chỉ admin được hủy đơn
+        allowed_targets = sorted({target for targets in Order.STATUS_TRANSITIONS.values() for target in targets})
+        if request.user.role != 'admin':
+            allowed_targets.remove('cancelled')
+        if target_status not in allowed_targets:
+            return Response({'error': f"status phải là một trong {allowed_targets}."}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = Order.objects.filter(id__in=order_ids)
+        if request.user.role == 'distributor':
+            # Chỉ các đơn mà mọi sản phẩm đều thuộc nhà phân phối này
+            queryset = filter_distributor_only_orders(queryset, request.user.id)
+
+        updated_ids = Order.bulk_transition(queryset, target_status)
+        if updated_ids:
+            transaction.on_commit(lambda: dispatch_order_transition(updated_ids, target_status))
+
+        updated = set(updated_ids)
+        return Response({
+            'status': target_status,
+            'updated_count': len(updated_ids),
+            'updated_ids': updated_ids,
+            'skipped_ids': [order_id for order_id in order_ids if order_id not in updated],
+        }, status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'], url_path='history')
     def history(self, request):
         queryset = self.get_queryset()
@@ -573,6 +837,7 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
         return Response(serializer.data)
 
     @action(detail=False, methods=['post'], url_path='create-stripe-payment')
+    @idempotent_request('create-stripe-payment')
     def create_stripe_payment(self, request):
         """Tạo Stripe Checkout Session cho thanh toán."""
         order_id = request.data.get('order_id')
@@ -594,7 +859,7 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
             payment = Payment.objects.create(
                 order=order,
                 user=request.user,
-                amount=order.total_amount,
+                amount=order.grand_total,
                 payment_method='stripe',
                 status='pending',
                 transaction_id=result['session_id']
@@ -618,20 +883,17 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
             payment = self.get_queryset().get(pk=pk)
             if payment.user != request.user:
                 return Response({'error': 'Không có quyền xác nhận thanh toán này.'}, status=status.HTTP_403_FORBIDDEN)
+            if payment.status == 'completed':
+                # Webhook đã xác nhận thanh toán, không cần gọi lại Stripe
+                return Response({'message': 'Thanh toán đã được xác nhận.'}, status=status.HTTP_200_OK)
 
-            session = stripe.checkout.Session.retrieve(payment.transaction_id)
+            session = stripe_gateway.retrieve_checkout_session(payment.transaction_id)
             if session.payment_status == 'paid':
-                payment.status = 'completed'
-                payment.paid_at = timezone.now()
-                payment.save()
-                send_payment_confirmation_email.delay(
-                    user_id=payment.user.id,
-                    order_code=payment.order.order_code
-                )
+                # Cập nhật dưới khóa hàng: webhook có thể xác nhận cùng lúc, chỉ một bên gửi email
+                apply_session_outcome(payment.transaction_id, 'completed')
                 return Response({'message': 'Thanh toán đã được xác nhận.'}, status=status.HTTP_200_OK)
             else:
-                payment.status = 'failed'
-                payment.save()
+                apply_session_outcome(payment.transaction_id, 'failed')
                 return Response({'error': 'Thanh toán không thành công.'}, status=status.HTTP_400_BAD_REQUEST)
 
         except Payment.DoesNotExist:
@@ -654,6 +916,7 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
                 payment.status = 'refunded'
                 payment.refunded_at = timezone.now()
                 payment.save()
+                publish_payment_status(payment)
                 return Response({'message': 'Hoàn tiền thành công.'}, status=status.HTTP_200_OK)
             return Response({'error': result['message']}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -671,32 +934,27 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
             return Response({'error': 'Thiếu session_id.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
+            confirmed = Payment.objects.select_related('order').filter(transaction_id=session_id, status='completed').first()
+            if confirmed:
+                # Webhook đã cập nhật thanh toán, không cần gọi lại Stripe
+                return Response({
+                    'message': 'Thanh toán thành công.',
+                    'payment_id': confirmed.id,
+                    'order_code': confirmed.order.order_code,
+                    'status': confirmed.status
+                }, status=status.HTTP_200_OK)
+
             # Lấy thông tin Checkout Session
-            session = stripe.checkout.Session.retrieve(session_id, expand=['payment_intent'])
-            payment = Payment.objects.get(transaction_id=session_id)
+            session = stripe_gateway.retrieve_checkout_session(session_id, expand=['payment_intent'])
             payment_intent = session.payment_intent
 
             logger.info(f"Processing /success/ for session_id: {session_id}, "
                         f"session_payment_status: {session.payment_status}, "
-                        f"payment_intent_status: {payment_intent.status if payment_intent else 'N/A'}, "
-                        f"current_payment_status: {payment.status}")
+                        f"payment_intent_status: {payment_intent.status if payment_intent else 'N/A'}")
 
-            # Kiểm tra trạng thái thanh toán
+            # Kiểm tra trạng thái thanh toán; cập nhật Payment và đơn hàng dưới khóa hàng (xem apply_payment_outcomes)
             if session.payment_status == 'paid' or (payment_intent and payment_intent.status == 'succeeded'):
-                if payment.status != 'completed':
-                    payment.status = 'completed'
-                    payment.paid_at = timezone.now()
-                    payment.save()
-                    # Cập nhật trạng thái đơn hàng
-                    payment.order.status = 'completed'
-                    payment.order.save()
-                    send_payment_confirmation_email.delay(
-                        user_id=payment.user.id,
-                        order_code=payment.order.order_code
-                    )
-                    logger.info(f"Payment {payment.id} updated to completed for order {payment.order.order_code}")
-                else:
-                    logger.info(f"Payment {payment.id} already completed, skipping update")
+                payment = apply_session_outcome(session_id, 'completed')
                 return Response({
                     'message': 'Thanh toán thành công.',
                     'payment_id': payment.id,
@@ -704,10 +962,7 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
                     'status': payment.status
                 }, status=status.HTTP_200_OK)
             else:
-                if payment.status != 'failed':
-                    payment.status = 'failed'
-                    payment.save()
-                    logger.info(f"Payment {payment.id} updated to failed")
+                payment = apply_session_outcome(session_id, 'failed')
                 return Response({
                     'error': 'Thanh toán không thành công.',
                     'status': payment.status,
@@ -736,6 +991,7 @@ class PaymentViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAP
             payment = Payment.objects.get(transaction_id=session_id)
             payment.status = 'failed'
             payment.save()
+            publish_payment_status(payment)
             # Cập nhật trạng thái đơn hàng
             payment.order.status = 'cancelled'
             payment.order.save()
@@ -870,11 +1126,9 @@ class DiscountViewSet(viewsets.ViewSet, generics.ListCreateAPIView, generics.Upd
         return [permissions.IsAuthenticated()]
 
     def get_queryset(self):
-        user = self.request.user
         if self.action in ['list', 'retrieve']:
-            now = timezone.now()
-            return Discount.objects.filter(is_active=True, start_date__lte=now, end_date__gte=now)
-        return super().get_queryset()
+            return Discount.objects.currently_active().with_validity()
+        return Discount.objects.with_validity()
 
     @action(detail=False, methods=['post'], url_path='apply')
     def apply_discount(self, request):
@@ -885,7 +1139,7 @@ class DiscountViewSet(viewsets.ViewSet, generics.ListCreateAPIView, generics.Upd
             return Response({'error': 'discount_code và cart_id là bắt buộc.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            discount = Discount.objects.get(code=discount_code)
+            discount = get_discount_by_code(discount_code)
         except Discount.DoesNotExist:
             return Response({'error': 'Mã giảm giá không tồn tại.'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -904,15 +1158,39 @@ class DiscountViewSet(viewsets.ViewSet, generics.ListCreateAPIView, generics.Upd
             return Response({'error': message}, status=status.HTTP_400_BAD_REQUEST)
 
         # Tính discount_amount
-        if discount.discount_type == 'percentage':
-            discount_amount = total_amount * (discount.discount_value / 100)
-            if discount.max_discount_amount:
-                discount_amount = min(discount_amount, discount.max_discount_amount)
-        else:
-            discount_amount = discount.discount_value
+        discount_amount = Discount.compute_amount(
+            discount.discount_type, discount.discount_value, discount.max_discount_amount, total_amount
+        )
 
         return Response({'discount_amount': str(discount_amount)}, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['post'], url_path='best')
+    def best_discounts(self, request):
+        """Đánh giá mọi mã đang hiệu lực (hoặc danh sách codes) với giỏ hàng và xếp hạng theo số tiền giảm."""
+        cart_id = request.data.get('cart_id')
+        codes = request.data.get('codes')
+        if not cart_id:
+            return Response({'error': 'cart_id là bắt buộc.'}, status=status.HTTP_400_BAD_REQUEST)
+        if codes is not None and (not isinstance(codes, list) or not all(isinstance(code, str) for code in codes)):
+            return Response({'error': 'codes phải là danh sách mã giảm giá.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not Cart.objects.filter(id=cart_id, user=request.user).exists():
+            return Response({'error': 'Giỏ hàng không tồn tại.'}, status=status.HTTP_404_NOT_FOUND)
+        total_amount = CartItem.objects.filter(cart_id=cart_id).aggregate(
+            total=Sum(F('quantity') * F('product__price'), output_field=DecimalField(max_digits=12, decimal_places=2))
+        )['total'] or Decimal('0.00')
+
+        applicable, rejected = rank_discounts(total_amount, codes)
+        for item in applicable:
+            item['discount_amount'] = str(item['discount_amount'])
+            item['total_after_discount'] = str(item['total_after_discount'])
+        return Response({
+            'cart_total': str(total_amount),
+            'best': applicable[0] if applicable else None,
+            'applicable': applicable,
+            'rejected': rejected,
+        }, status=status.HTTP_200_OK)
+
 # Notification ViewSet
 class NotificationViewSet(viewsets.ViewSet, generics.ListAPIView, generics.RetrieveAPIView, generics.UpdateAPIView):
     authentication_classes = [CustomOAuth2Authentication]
@@ -925,7 +1203,7 @@ class NotificationViewSet(viewsets.ViewSet, generics.ListAPIView, generics.Retri
 
     def get_permissions(self):
         user = self.request.user
-        if user.role == 'admin':
+        if user.role == 'admin' or self.action == 'promotions':
             return [IsAdmin()]
         return [IsNotificationOwner()]
 
@@ -955,10 +1233,89 @@ class NotificationViewSet(viewsets.ViewSet, generics.ListAPIView, generics.Retri
     def mark_as_read(self, request, pk=None):
         notification = self.get_object()
         notification.is_read = True
-        notification.save()
+        notification.save(update_fields=['is_read', 'updated_at'])
         serializer = self.get_serializer(notification)
         return Response(serializer.data)
 
+    def get_notification_ids(self, request):
+        ids = request.data.get('ids')
+        # bool là lớp con của int: True/False không phải id hợp lệ
+        if not isinstance(ids, list) or not ids or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return None
+        return ids
+
+    @action(detail=False, methods=['post'], url_path='mark-all-read')
+    def mark_all_read(self, request):
+        """Đánh dấu đã đọc mọi thông báo của user (lọc tùy chọn theo notification_type, before) bằng một UPDATE."""
+        queryset = Notification.objects.filter(user=request.user, is_read=False)
+        notification_type = request.data.get('notification_type')
+        if notification_type:
+            queryset = queryset.filter(notification_type=notification_type)
+        before = request.data.get('before')
+        if before:
+            before_date = parse_date(str(before))
+            if not before_date:
+                return Response({'error': 'before phải có định dạng YYYY-MM-DD.'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(created_at__date__lte=before_date)
+        with transaction.atomic():
+            updated = queryset.update(is_read=True, updated_at=timezone.now())
+            if updated:
+                transaction.on_commit(lambda: unread_counter.decrement({request.user.id: updated}))
+        return Response({'updated_count': updated})
+
+    @action(detail=False, methods=['post'], url_path='mark-read')
+    def mark_read(self, request):
+        """Đánh dấu đã đọc danh sách ids của user bằng một UPDATE."""
+        ids = self.get_notification_ids(request)
+        if ids is None:
+            return Response({'error': 'ids phải là một danh sách số nguyên không rỗng.'}, status=status.HTTP_400_BAD_REQUEST)
+        with transaction.atomic():
+            updated = Notification.objects.filter(user=request.user, id__in=ids, is_read=False).update(
+                is_read=True, updated_at=timezone.now()
+            )
+            if updated:
+                transaction.on_commit(lambda: unread_counter.decrement({request.user.id: updated}))
+        return Response({'updated_count': updated})
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """Xóa danh sách ids (hoặc mọi thông báo đã đọc khi read_only=true) của user, không load từng bản ghi."""
+        queryset = Notification.objects.filter(user=request.user)
+        if request.data.get('read_only') is True:
+            queryset = queryset.filter(is_read=True)
+        else:
+            ids = self.get_notification_ids(request)
+            if ids is None:
+                return Response({'error': 'Cần ids (danh sách số nguyên) hoặc read_only=true.'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(id__in=ids)
+        with transaction.atomic():
+            # Tách phần chưa đọc để cập nhật bộ đếm mà không cần SELECT
+            unread_deleted = queryset.filter(is_read=False).delete()[0]
+            read_deleted = queryset.filter(is_read=True).delete()[0]
+            if unread_deleted:
+                transaction.on_commit(lambda: unread_counter.decrement({request.user.id: unread_deleted}))
+        return Response({'deleted_count': unread_deleted + read_deleted})
+
+    @action(detail=False, methods=['get'], url_path='unread-count')
+    def unread_count(self, request):
+        """Số thông báo chưa đọc của user hiện tại (đọc từ bộ đếm Redis, dùng cho badge)."""
+        return Response({'unread_count': unread_counter.get(request.user.id)})
+
+    @action(detail=False, methods=['get', 'post'], url_path='promotions')
+    def promotions(self, request):
+        """Danh sách / tạo chiến dịch thông báo khuyến mãi cho một phân khúc user (chỉ admin)."""
+        if request.method == 'GET':
+            page = self.paginate_queryset(PromotionCampaign.objects.all())
+            serializer = PromotionCampaignSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = PromotionCampaignSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            campaign = serializer.save(created_by=request.user)
+            transaction.on_commit(lambda: fan_out_promotion.delay(campaign.id))
+        return Response(PromotionCampaignSerializer(campaign).data, status=status.HTTP_202_ACCEPTED)
+
 # Review ViewSet
 class ReviewViewSet(viewsets.ViewSet, generics.ListCreateAPIView, generics.RetrieveAPIView, generics.UpdateAPIView, generics.DestroyAPIView):
     authentication_classes = [CustomOAuth2Authentication]
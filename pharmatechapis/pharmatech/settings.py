@@ -79,7 +79,9 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'idempotency-key',
 ]
+CORS_EXPOSE_HEADERS = ['idempotent-replayed']
 CORS_ALLOW_CREDENTIALS = config('CORS_ALLOW_CREDENTIALS', default=True, cast=bool)
 
 # Swagger settings
@@ -181,6 +183,20 @@ VNPAY_RETURN_URL = config('VNPAY_RETURN_URL')
 # Stripe configuration
 STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY')
+STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')  # Để trống thì endpoint webhook trả 503, không nhận sự kiện
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='')  # Ví dụ http://127.0.0.1:12111 khi chạy tools/fake_stripe_server.py
+STRIPE_CONNECT_TIMEOUT = config('STRIPE_CONNECT_TIMEOUT', default=3, cast=float)
+STRIPE_READ_TIMEOUT = config('STRIPE_READ_TIMEOUT', default=10, cast=float)
+STRIPE_MAX_RETRIES = config('STRIPE_MAX_RETRIES', default=2, cast=int)
+STRIPE_POOL_SIZE = config('STRIPE_POOL_SIZE', default=20, cast=int)
+STRIPE_BREAKER_THRESHOLD = config('STRIPE_BREAKER_THRESHOLD', default=5, cast=int)
+STRIPE_BREAKER_RESET_TIMEOUT = config('STRIPE_BREAKER_RESET_TIMEOUT', default=30, cast=int)
+STRIPE_RECONCILE_LOOKBACK_HOURS = config('STRIPE_RECONCILE_LOOKBACK_HOURS', default=72, cast=int)
+REFUND_WORKERS = config('REFUND_WORKERS', default=8, cast=int)  # Số lời gọi Stripe Refund song song trong một lô
+ORDER_PLACING_TIMEOUT_MINUTES = config('ORDER_PLACING_TIMEOUT_MINUTES', default=10, cast=int)  # Đơn 'placing' lâu hơn sẽ bị đánh dấu failed
+PROMOTION_PUSH_WORKERS = config('PROMOTION_PUSH_WORKERS', default=8, cast=int)  # Số lời gọi FCM multicast song song khi gửi khuyến mãi
+MAX_DEVICE_TOKENS_PER_USER = config('MAX_DEVICE_TOKENS_PER_USER', default=10, cast=int)  # Token cũ nhất bị xóa khi vượt giới hạn
+DEVICE_TOKEN_CACHE_TTL = config('DEVICE_TOKEN_CACHE_TTL', default=3600, cast=int)  # Cache danh sách token FCM của mỗi user trên Redis
 
 # Celery configuration
 CELERY_BROKER_URL = config('CELERY_BROKER_URL')
@@ -201,6 +217,19 @@ CACHES = {
     }
 }
 
+# Thời gian lưu response cho header Idempotency-Key (giây)
+IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', default=86400, cast=int)
+
+# Cache tra cứu mã giảm giá (giây): Redis, bản sao trong process, mã không tồn tại
+DISCOUNT_CACHE_TTL = config('DISCOUNT_CACHE_TTL', default=3600, cast=int)
+DISCOUNT_LOCAL_CACHE_TTL = config('DISCOUNT_LOCAL_CACHE_TTL', default=30, cast=int)
+DISCOUNT_MISSING_CACHE_TTL = config('DISCOUNT_MISSING_CACHE_TTL', default=60, cast=int)
+DISCOUNT_ACTIVE_TABLE_TTL = config('DISCOUNT_ACTIVE_TABLE_TTL', default=300, cast=int)
+
+UNREAD_COUNT_TTL = config('UNREAD_COUNT_TTL', default=7 * 24 * 3600, cast=int)  # Bộ đếm thông báo chưa đọc trên Redis
+NOTIFICATION_ONLINE_TTL = config('NOTIFICATION_ONLINE_TTL', default=120, cast=int)  # Key online của user hết hạn nếu socket không gia hạn (giây)
+NOTIFICATION_COALESCE_WINDOW = config('NOTIFICATION_COALESCE_WINDOW', default=300, cast=int)  # Gom thông báo đánh giá mới thành bản tổng hợp (giây)
+
 # Django Channels configuration
 ASGI_APPLICATION = 'pharmatech.asgi.application'
 CHANNEL_LAYERS = {
@@ -225,6 +254,8 @@ EMAIL_PORT = config('EMAIL_PORT', cast=int)
 EMAIL_USE_TLS = config('EMAIL_USE_TLS', cast=bool)
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
+EMAIL_TIMEOUT = config('EMAIL_TIMEOUT', default=30, cast=int)  # Không để worker treo khi SMTP không phản hồi
+EMAIL_RATE_LIMIT_PER_MINUTE = config('EMAIL_RATE_LIMIT_PER_MINUTE', default=60, cast=int)  # Quota gửi email của nhà cung cấp SMTP
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL')
 
 # OAuth2 Client credentials
@@ -377,6 +408,42 @@ CELERY_BEAT_SCHEDULE = {
             # Thêm các URL khác
         ],),
     },
+    'fail-stuck-placing-orders': {
+        'task': 'core.tasks.fail_stuck_placing_orders',
+        'schedule': crontab(minute='*/5'),  # Đánh dấu failed các đơn kẹt ở 'placing' mỗi 5 phút
+    },
+    'deactivate-invalid-discounts': {
+        'task': 'core.tasks.deactivate_invalid_discounts',
+        'schedule': crontab(minute='*/15'),  # Tắt các mã hết hạn/hết lượt mỗi 15 phút
+    },
+    'process-stripe-events': {
+        'task': 'core.tasks.process_stripe_events',
+        'schedule': crontab(minute='*'),  # Quét lại inbox webhook Stripe còn tồn mỗi phút
+    },
+    'reconcile-stripe-payments': {
+        'task': 'core.tasks.reconcile_stripe_payments',
+        'schedule': crontab(minute='*/30'),  # Đối soát thanh toán Stripe còn treo mỗi 30 phút
+    },
+    'process-refund-requests': {
+        'task': 'core.tasks.process_refund_requests',
+        'schedule': crontab(minute='*/5'),  # Thử lại các yêu cầu hoàn tiền lỗi tạm thời mỗi 5 phút
+    },
+    'resume-promotion-campaigns': {
+        'task': 'core.tasks.resume_promotion_campaigns',
+        'schedule': crontab(minute='*/5'),  # Chạy tiếp chiến dịch khuyến mãi bị gián đoạn từ checkpoint
+    },
+    'reconcile-unread-counts': {
+        'task': 'core.tasks.reconcile_unread_counts',
+        'schedule': crontab(minute=0),  # Đối chiếu bộ đếm thông báo chưa đọc với SQL mỗi giờ
+    },
+    'prune-invalid-device-tokens': {
+        'task': 'core.tasks.prune_invalid_device_tokens',
+        'schedule': crontab(hour=3, minute=30),  # Xóa token FCM đã chết (dry-run multicast) lúc 3h30 hàng ngày
+    },
+    'send-queued-emails': {
+        'task': 'core.tasks.send_queued_emails',
+        'schedule': crontab(minute='*'),  # Gửi email trong hàng đợi (kể cả email đến hạn thử lại) mỗi phút
+    },
 }
 
 # Cấu hình LlamaIndex embedding model
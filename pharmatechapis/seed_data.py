@@ -189,7 +189,6 @@ def create_orders(customers, products, discounts):
             )
             num_items = random.randint(1, 4)
             selected_products = random.sample(products, min(num_items, len(products)))
-            total = Decimal('0.00')
             for product in selected_products:
                 quantity = random.randint(1, 10)
                 inventory = Inventory.objects.get(product=product, distributor=product.distributor)
@@ -201,14 +200,16 @@ def create_orders(customers, products, discounts):
                         quantity=quantity,
                         price=price
                     )
-                    total += price * quantity
             order.discount_amount = Decimal('0.00')
+            # Lưu items_subtotal/grand_total từ các OrderItem vừa tạo trước khi áp dụng giảm giá
+            order.recalculate_totals()
             if order.discount:
                 try:
                     order.apply_discount()
                 except ValueError:
                     order.discount = None
                     order.discount_amount = Decimal('0.00')
+                    order.set_totals(order.items_subtotal)
             order.save()
             orders.append(order)
     return orders
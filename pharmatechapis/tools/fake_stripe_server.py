@@ -0,0 +1,189 @@
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Fake Stripe API tối giản cho test và load test (đặt STRIPE_API_BASE=http://127.0.0.1:12111)
+# Hỗ trợ: tạo/lấy/liệt kê Checkout Session, liệt kê PaymentIntent, tạo Refund, idempotency key, độ trễ và tỉ lệ lỗi giả lập.
+# Ví dụ: python tools/fake_stripe_server.py --latency 0.2 --error-rate 0.1
+
+SESSION_PATH = re.compile(r'^/v1/checkout/sessions/(?P<session_id>[\w-]+)$')
+
+def expand_values(query):
+    """Stripe mã hóa danh sách dạng expand[0]=... (hoặc expand[]=...)."""
+    return [value for key, values in query.items() if key.startswith('expand[') for value in values]
+
+class FakeStripeState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.idempotent_responses = {}
+
+state = FakeStripeState()
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Giữ kết nối keep-alive như Stripe thật
+    latency = 0.0
+    error_rate = 0.0
+    auto_pay = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status_code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _simulate(self):
+        """Giả lập độ trễ và lỗi 5xx; trả về True nếu request đã bị trả lỗi."""
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self._send(500, {'error': {'type': 'api_error', 'message': 'Fake Stripe internal error.'}})
+            return True
+        return False
+
+    def _read_params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        return {key: values[-1] for key, values in parse_qs(body).items()}
+
+    def do_GET(self):
+        if self._simulate():
+            return
+        url = urlparse(self.path)
+        if url.path == '/v1/checkout/sessions':
+            return self._send(200, self._list_sessions(parse_qs(url.query)))
+        if url.path == '/v1/payment_intents':
+            return self._send(200, self._list_payment_intents(parse_qs(url.query)))
+        match = SESSION_PATH.match(url.path)
+        if not match:
+            return self._send(404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path.'}})
+        with state.lock:
+            session = state.sessions.get(match.group('session_id'))
+        if session is None:
+            return self._send(404, {'error': {'type': 'invalid_request_error', 'message': 'No such checkout.session.'}})
+        expand = 'payment_intent' in expand_values(parse_qs(url.query))
+        self._send(200, self._render_session(session, expand))
+
+    def _render_payment_intent(self, session):
+        return {
+            'id': session['payment_intent'],
+            'object': 'payment_intent',
+            'created': session['created'],
+            'amount': session['amount_total'],
+            'status': 'succeeded' if session['payment_status'] == 'paid' else 'requires_payment_method',
+        }
+
+    def _render_session(self, session, expand_payment_intent):
+        session = dict(session)
+        if expand_payment_intent and session['payment_intent']:
+            session['payment_intent'] = self._render_payment_intent(session)
+        return session
+
+    def _list_objects(self, objects, url, query):
+        """List API: mới nhất trước, lọc created[gte], phân trang bằng starting_after."""
+        created_gte = int(query.get('created[gte]', ['0'])[0])
+        limit = int(query.get('limit', ['10'])[0])
+        starting_after = query.get('starting_after', [None])[0]
+        objects = [item for item in objects if item['created'] >= created_gte]
+        objects.sort(key=lambda item: (item['created'], item['id']), reverse=True)
+        if starting_after:
+            ids = [item['id'] for item in objects]
+            objects = objects[ids.index(starting_after) + 1:] if starting_after in ids else []
+        return {'object': 'list', 'url': url, 'has_more': len(objects) > limit, 'data': objects[:limit]}
+
+    def _list_sessions(self, query):
+        expand = 'data.payment_intent' in expand_values(query)
+        with state.lock:
+            sessions = [self._render_session(session, expand) for session in state.sessions.values()]
+        return self._list_objects(sessions, '/v1/checkout/sessions', query)
+
+    def _list_payment_intents(self, query):
+        # Fake chỉ có PaymentIntent sinh ra từ Checkout Session đã thanh toán
+        with state.lock:
+            intents = [
+                self._render_payment_intent(session) for session in state.sessions.values() if session['payment_intent']
+            ]
+        return self._list_objects(intents, '/v1/payment_intents', query)
+
+    def do_POST(self):
+        params = self._read_params()
+        idempotency_key = self.headers.get('Idempotency-Key')
+        with state.lock:
+            cached = state.idempotent_responses.get(idempotency_key)
+        if cached:
+            return self._send(*cached)
+        if self._simulate():
+            return
+
+        path = urlparse(self.path).path
+        if path == '/v1/checkout/sessions':
+            response = (200, self._create_session(params))
+        elif path == '/v1/refunds':
+            response = (200, {
+                'id': f"re_fake_{uuid.uuid4().hex[:24]}",
+                'object': 'refund',
+                'amount': int(params.get('amount', 0)),
+                'payment_intent': params.get('payment_intent'),
+                'status': 'succeeded',
+            })
+        else:
+            response = (404, {'error': {'type': 'invalid_request_error', 'message': 'Unknown path.'}})
+
+        if idempotency_key and response[0] == 200:
+            with state.lock:
+                state.idempotent_responses[idempotency_key] = response
+        self._send(*response)
+
+    def _create_session(self, params):
+        session_id = f"cs_fake_{uuid.uuid4().hex[:24]}"
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'created': int(time.time()),
+            'mode': params.get('mode', 'payment'),
+            'url': f"http://{self.headers.get('Host')}/pay/{session_id}",
+            'amount_total': int(params.get('line_items[0][price_data][unit_amount]', 0)),
+            'currency': params.get('line_items[0][price_data][currency]', 'vnd'),
+            'payment_status': 'paid' if self.auto_pay else 'unpaid',
+            'status': 'complete' if self.auto_pay else 'open',
+            'payment_intent': f"pi_fake_{uuid.uuid4().hex[:24]}" if self.auto_pay else None,
+            'metadata': {
+                key[len('metadata['):-1]: value for key, value in params.items() if key.startswith('metadata[')
+            },
+        }
+        with state.lock:
+            state.sessions[session_id] = session
+        return session
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Stripe API server cho môi trường local.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=0.0, help="Độ trễ mỗi request (giây)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Tỉ lệ trả lỗi 500 (0-1)")
+    parser.add_argument('--unpaid', action='store_true', help="Session mới ở trạng thái chưa thanh toán")
+    args = parser.parse_args()
+
+    FakeStripeHandler.latency = args.latency
+    FakeStripeHandler.error_rate = args.error_rate
+    FakeStripeHandler.auto_pay = not args.unpaid
+    server = ThreadingHTTPServer((args.host, args.port), FakeStripeHandler)
+    print(f"Fake Stripe đang chạy tại http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
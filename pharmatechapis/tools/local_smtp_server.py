@@ -0,0 +1,145 @@
+import time
+import random
+import asyncio
+import argparse
+
+# SMTP server giả tối giản để test hàng đợi email ở local (không TLS, không xác thực)
+# Cấu hình .env: EMAIL_HOST=127.0.0.1, EMAIL_PORT=1025, EMAIL_USE_TLS=False
+# Ví dụ: python tools/local_smtp_server.py --latency 0.1 --fail-rate 0.2
+
+class SMTPStats:
+    def __init__(self):
+        self.connections = 0
+        self.messages = 0
+        self.rejected = 0
+        self.started_at = time.monotonic()
+
+    def rate(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        return self.messages * 60 / elapsed
+
+stats = SMTPStats()
+
+class SMTPSession:
+    latency = 0.0
+    fail_rate = 0.0
+    verbose = False
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reset()
+
+    def reset(self):
+        self.mail_from = None
+        self.rcpt_to = []
+
+    async def reply(self, line):
+        self.writer.write(f"{line}\r\n".encode('utf-8'))
+        await self.writer.drain()
+
+    async def read_data(self):
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return None
+            line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+            if line == '.':
+                return lines
+            # Bỏ dấu chấm được nhân đôi (dot-stuffing)
+            lines.append(line[1:] if line.startswith('..') else line)
+
+    async def handle(self):
+        stats.connections += 1
+        peer = self.writer.get_extra_info('peername')
+        print(f"[conn #{stats.connections}] {peer} connected")
+        await self.reply("220 localhost PharmaTech fake SMTP ready")
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                command, _, argument = line.decode('utf-8', errors='replace').strip().partition(' ')
+                command = command.upper()
+                if command == 'EHLO':
+                    await self.reply("250-localhost")
+                    await self.reply("250-8BITMIME")
+                    await self.reply("250 SMTPUTF8")
+                elif command == 'HELO':
+                    await self.reply("250 localhost")
+                elif command == 'MAIL':
+                    self.reset()
+                    self.mail_from = argument
+                    await self.reply("250 OK")
+                elif command == 'RCPT':
+                    self.rcpt_to.append(argument)
+                    await self.reply("250 OK")
+                elif command == 'DATA':
+                    await self.receive_message()
+                elif command == 'RSET':
+                    self.reset()
+                    await self.reply("250 OK")
+                elif command == 'NOOP':
+                    await self.reply("250 OK")
+                elif command == 'QUIT':
+                    await self.reply("221 Bye")
+                    break
+                else:
+                    await self.reply("502 Command not implemented")
+        finally:
+            self.writer.close()
+            print(f"{peer} disconnected")
+
+    async def receive_message(self):
+        if not self.mail_from or not self.rcpt_to:
+            await self.reply("503 Need MAIL and RCPT first")
+            return
+        await self.reply("354 End data with <CR><LF>.<CR><LF>")
+        lines = await self.read_data()
+        if lines is None:
+            return
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            # Lỗi tạm thời như khi nhà cung cấp bóp tốc độ: client phải thử lại sau
+            stats.rejected += 1
+            await self.reply("451 Temporary failure, try again later")
+        else:
+            stats.messages += 1
+            subject = next((line[len('Subject: '):] for line in lines if line.startswith('Subject: ')), '')
+            print(f"[msg #{stats.messages}] {self.mail_from} -> {', '.join(self.rcpt_to)}: {subject} "
+                  f"({stats.rate():.1f}/phút, {stats.rejected} bị từ chối)")
+            if self.verbose:
+                print('\n'.join(lines))
+            await self.reply("250 OK: queued")
+        self.reset()
+
+async def handle_client(reader, writer):
+    await SMTPSession(reader, writer).handle()
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_client, host, port)
+    print(f"Fake SMTP đang chạy tại {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake SMTP server cho môi trường local.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--latency', type=float, default=0.0, help="Độ trễ mỗi email (giây)")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="Tỉ lệ trả lỗi 451 (0-1)")
+    parser.add_argument('--verbose', action='store_true', help="In toàn bộ nội dung email")
+    args = parser.parse_args()
+
+    SMTPSession.latency = args.latency
+    SMTPSession.fail_rate = args.fail_rate
+    SMTPSession.verbose = args.verbose
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print(f"Tổng: {stats.connections} kết nối, {stats.messages} email, {stats.rejected} bị từ chối")
+
+if __name__ == '__main__':
+    main()
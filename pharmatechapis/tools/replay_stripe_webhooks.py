@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import time
+import hmac
+import hashlib
+import argparse
+import requests
+from decouple import config
+
+# Phát lại các sự kiện Stripe mẫu vào endpoint webhook local, ký giống hệt Stripe
+# Ví dụ: python tools/replay_stripe_webhooks.py --session-id cs_test_123 --repeat 2
+
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stripe_webhook_fixtures.json')
+
+def sign_payload(payload, secret, timestamp=None):
+    """Tạo header Stripe-Signature (t=..., v1=HMAC-SHA256 của "t.payload")."""
+    timestamp = timestamp or int(time.time())
+    signed = f"{timestamp}.{payload}".encode('utf-8')
+    signature = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def load_events(path, session_id=None):
+    """Đọc danh sách sự kiện từ file fixture, thay session id nếu được truyền vào."""
+    with open(path, encoding='utf-8') as f:
+        events = json.load(f)
+    if session_id:
+        for event in events:
+            event['data']['object']['id'] = session_id
+    return events
+
+def replay(events, url, secret, repeat=1, tamper=False):
+    """Gửi từng sự kiện (lặp lại `repeat` lần để kiểm tra khử trùng lặp)."""
+    for _ in range(repeat):
+        for event in events:
+            payload = json.dumps(event)
+            signature = sign_payload(payload, secret)
+            if tamper:
+                # Đổi payload sau khi ký để kiểm tra endpoint từ chối chữ ký sai
+                payload = payload.replace('"paid"', '"unpaid"')
+            response = requests.post(
+                url,
+                data=payload,
+                headers={'Content-Type': 'application/json', 'Stripe-Signature': signature},
+                timeout=10,
+            )
+            print(f"{event['id']} {event['type']} -> {response.status_code}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Phát lại webhook Stripe mẫu vào server local.")
+    parser.add_argument('--fixture', default=DEFAULT_FIXTURE)
+    parser.add_argument('--url', default=f"{config('BACKEND_URL', default='http://127.0.0.1:8000')}/stripe/webhook/")
+    parser.add_argument('--session-id', help="Checkout Session id của Payment cần cập nhật")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--tamper', action='store_true')
+    args = parser.parse_args()
+
+    secret = config('STRIPE_WEBHOOK_SECRET', default='')
+    if not secret:
+        print("Thiếu STRIPE_WEBHOOK_SECRET trong .env")
+        sys.exit(1)
+    replay(load_events(args.fixture, args.session_id), args.url, secret, args.repeat, args.tamper)
+
+if __name__ == '__main__':
+    main()